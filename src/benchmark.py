@@ -0,0 +1,875 @@
+import argparse
+import contextlib
+import email.utils
+import http.server
+import io
+import json
+import multiprocessing
+import os
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.error
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+from src.utils import load_whole_config, set_config_file
+from src.scraper_config import get_config_matcher
+from src.fetching import HTTPFetcher
+from src.fetch_policy import FetchPolicy, MAX_RETRY_AFTER
+from src.output_sinks import CSVSink
+from src.url_frontier import URLFrontier, ITEM_SUB, STATUS_DONE
+from src.web_sraping import URLCollector, ProductScraper, WebScraperRunner, init_parser_worker, parse_product_page
+from src.settings import MAIN_URLS_TO_SCRAP_CONFIG, PRODUCT_SUB_URLS_TO_SCRAP_CONFIG, PRODUCT_SCRAPING_CONFIG, \
+                         MAIN_SOURCE_URL, SUB_SOURCE_URL_BEGINNING, FETCHER_CONFIG, MAX_REQUESTS_PER_HOST, \
+                         BENCHMARK_RESULT_FILE, PRE_SLICE_CONTAINER, CONCURRENT_CRAWL, PARSER_WORKER_COUNT, \
+                         OUTPUT_CONFIG, DELTA_CRAWL, INSTRUMENTATION_CONFIG, INSTRUMENTATION_ENABLED, FRONTIER_CONFIG, \
+                         LEASE_TIMEOUT, MAX_RETRIES, POLL_INTERVAL
+
+# the metrics where a higher value is better; for the others (memory) a lower value is better
+HIGHER_IS_BETTER_METRICS = ('pages_per_sec', 'mb_per_sec')
+LOWER_IS_BETTER_METRICS = ('peak_alloc_mb',)
+# the crawl modes of WebScraperRunner, as the settings of config.yml selecting them
+CRAWL_MODES = {'sequential': {CONCURRENT_CRAWL: False, PARSER_WORKER_COUNT: 0},
+               'concurrent': {CONCURRENT_CRAWL: True, PARSER_WORKER_COUNT: 0},
+               'pipeline': {CONCURRENT_CRAWL: True, PARSER_WORKER_COUNT: 2}}
+# the buffer of the frontier workers of verify_frontier(), small enough to write out a few checkpoints
+FRONTIER_MAX_BUFFERED_ROWS = 50
+
+
+class StaticPageFetcher:
+    """StaticPageFetcher serves web pages from memory instead of the network, so that the scrapers can be measured
+    without the time of the downloads."""
+
+    streaming = False
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def fetch(self, url, url_metrics=None):
+        """Returns the body of the page stored for the given URL. There is no download to be measured."""
+        return self.pages[url]
+
+
+class ChunkedPageStream:
+    """ChunkedPageStream gives the body of a page in chunks of the given sizes, as the response stream of HTTPFetcher
+    gives the chunks of a download."""
+
+    def __init__(self, page, chunk_sizes):
+        self.page = page
+        self.chunk_sizes = chunk_sizes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def __iter__(self):
+        position = 0
+        for chunk_size in self.chunk_sizes:
+            if position >= len(self.page):
+                break
+            yield self.page[position:position + chunk_size]
+            position += chunk_size
+
+
+class ChunkedPageFetcher(StaticPageFetcher):
+    """ChunkedPageFetcher streams web pages from memory in chunks of random sizes, so the scrapers are fed the way a
+    streaming download feeds them, with the tags, comments and scripts split at any position."""
+
+    streaming = True
+
+    def __init__(self, pages, chunk_sizes, page_random):
+        super().__init__(pages)
+        self.chunk_sizes = chunk_sizes
+        self.page_random = page_random
+
+    def stream(self, url, url_metrics=None):
+        """Returns the chunks of the page stored for the given URL, each one of a size randomly chosen from
+        chunk_sizes."""
+        page = self.pages[url]
+        chunk_sizes = [self.page_random.choice(self.chunk_sizes) for _ in range(len(page) // min(self.chunk_sizes) + 1)]
+        return ChunkedPageStream(page, chunk_sizes)
+
+
+class SyntheticPageGenerator:
+    """SyntheticPageGenerator generates kolonial-style pages, shaped by the scraping configs of config.yml: the tags
+    and attributes of the containers, the links and the product information are the ones the scrapers look for.
+    Around the container there is the usual noise of a real page (scripts, styles, menus and a footer), so the early
+    exit of the scrapers is measured as well.
+    The pages are deterministic: the same parameters always give the same bytes.
+    """
+
+    def __init__(self, seed=0, filler_size=20000):
+        self.seed = seed
+        self.filler_size = filler_size
+
+    def create_random(self, *page_id):
+        """Returns a random generator of its own for a page, so a page does not depend on the pages generated before."""
+        return random.Random('{}-{}'.format(self.seed, '-'.join(str(part) for part in page_id)))
+
+    def create_head(self, page_random):
+        """Returns the head of a page with a script and a style, which contain tag-like text as well."""
+        script_lines = ['var item{0} = "<div class=\\"item{0}\\">" + {1};'.format(i, page_random.randint(0, 10 ** 6))
+                        for i in range(self.filler_size // 200)]
+        style_lines = ['.class{0} {{ margin: {1}px; }}'.format(i, page_random.randint(0, 99))
+                       for i in range(self.filler_size // 200)]
+        return '<head><title>Kolonial</title><script>{}</script><style>{}</style></head>'.format(
+            '\n'.join(script_lines), '\n'.join(style_lines))
+
+    def create_menu(self, page_random):
+        """Returns a menu with links that the scrapers are not looking for."""
+        links = ['<li><a class="menu-link" href="/menu/{0}">Menu {0}</a></li>'.format(page_random.randint(0, 999))
+                 for _ in range(self.filler_size // 200)]
+        return '<div class="header"><div class="menu"><ul>{}</ul></div></div>'.format(''.join(links))
+
+    def create_footer(self, page_random):
+        """Returns a footer, which comes after the container."""
+        paragraphs = ['<p class="footer-text">Footer text {}</p>'.format(page_random.randint(0, 10 ** 6))
+                      for _ in range(self.filler_size // 100)]
+        return '<div class="footer">{}</div>'.format(''.join(paragraphs))
+
+    def create_page(self, page_random, container_config, container_content):
+        """Returns the whole page, encoded to bytes, with the container of the config around the content."""
+        return ('<!DOCTYPE html><html>{head}<body>{menu}<{tag} {attr}="{value}"><div class="inner">{content}</div>'
+                '</{tag}>{footer}</body></html>').format(
+            head=self.create_head(page_random), menu=self.create_menu(page_random),
+            tag=container_config.container_tag_name, attr=container_config.container_tag_attr_name,
+            value=container_config.container_tag_attr_value, content=container_content,
+            footer=self.create_footer(page_random)).encode('utf-8')
+
+    def create_link_page(self, config_name, hrefs):
+        """Returns a category page with the given links in its container, shaped by the URL collector config.
+        If the config has a filter, every link is preceded by another one that does not pass the filter."""
+        config = get_config_matcher(config_name)
+        page_random = self.create_random(config_name, len(hrefs), *hrefs[:1])
+        links = []
+        for href in hrefs:
+            filter_attr = ''
+            if config.tag_filter_attr_name is not None:
+                filter_attr = ' {}="{}"'.format(config.tag_filter_attr_name, config.tag_filter_attr_value)
+                links.append('<{0} {1}="/other/{2}">Other</{0}>'.format(
+                    config.tag_name_to_search, config.tag_attr_to_search, page_random.randint(0, 999)))
+            links.append('<div class="link"><{0}{1} {2}="{3}">Category</{0}></div>'.format(
+                config.tag_name_to_search, filter_attr, config.tag_attr_to_search, href))
+        return self.create_page(page_random, config, ''.join(links))
+
+    def create_field_text(self, field, page_random, product_number):
+        """Returns a realistic text for a product field."""
+        if field == 'unit_price':
+            return 'kr {},{:02d} per kg'.format(page_random.randint(1, 500), page_random.randint(0, 99))
+        if field == 'price':
+            return 'kr {},{:02d}'.format(page_random.randint(1, 300), page_random.randint(0, 99))
+        return '{} {}'.format(field.replace('_', ' ').capitalize(), product_number)
+
+    def create_product_page(self, product_count, page_number=0):
+        """Returns a product list page with the given number of products, shaped by the product scraping config."""
+        config = get_config_matcher(PRODUCT_SCRAPING_CONFIG)
+        page_random = self.create_random(PRODUCT_SCRAPING_CONFIG, product_count, page_number)
+        field_tags = []
+        for tag, tag_rules in config.product_info_rules.items():
+            for (attr_name, attr_value), (position, field) in tag_rules.items():
+                field_tags.append((position, field, tag, attr_name, attr_value))
+        field_tags.sort()
+        products = []
+        for product_number in range(product_count):
+            fields = ''.join('<{0} {1}="{2}">{3}</{0}>'.format(tag, attr_name, attr_value,
+                                                               self.create_field_text(field, page_random,
+                                                                                      product_number))
+                             for position, field, tag, attr_name, attr_value in field_tags)
+            if config.has_sub_container:
+                products.append('<{0} {1}="{2}"><div class="product">{3}</div></{0}>'.format(
+                    config.sub_container_tag_name, config.sub_container_tag_attr_name,
+                    config.sub_container_tag_attr_value, fields))
+            else:
+                products.append(fields)
+        return self.create_page(page_random, config, ''.join(products))
+
+    def create_site(self, main_categ_count, sub_categ_count, product_count):
+        """Returns a whole site as a dictionary of URL path -> page: the main page, the main category pages with
+        the links of their sub-categories, and the product pages of the sub-categories."""
+        main_hrefs = ['/kategorier/{0}-main-categ-{0}/'.format(i) for i in range(main_categ_count)]
+        site = {'/': self.create_link_page(MAIN_URLS_TO_SCRAP_CONFIG, main_hrefs)}
+        for main_href in main_hrefs:
+            sub_hrefs = ['{0}{1}-sub-categ-{1}/'.format(main_href, j) for j in range(sub_categ_count)]
+            site[main_href] = self.create_link_page(PRODUCT_SUB_URLS_TO_SCRAP_CONFIG, sub_hrefs)
+            for page_number, sub_href in enumerate(sub_hrefs):
+                site[sub_href] = self.create_product_page(product_count, page_number)
+        return site
+
+
+class SyntheticSiteServer:
+    """SyntheticSiteServer serves a synthetic site on a local HTTP server, with keep-alive connections, so that
+    the whole crawl can be measured without the real website.
+    Faults can be injected, to check how the fetcher deals with throttling, failing and slow servers: the requests of
+    a URL path get the faults given for it (a list) one by one, before the page is served. A fault is a dictionary
+    with a status to answer with instead of the page (and the Retry-After header to send with it, if any), and/or
+    a delay in seconds before the answer. The number of requests of every path is counted.
+    """
+
+    def __init__(self, site, faults=None):
+        self.site = site
+        self.faults = {path: list(path_faults) for path, path_faults in (faults or {}).items()}
+        self.request_counts = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def take_fault(self, path):
+        """Counts a request of the path, and returns the next fault of the path, or None if it has no more."""
+        with self.lock:
+            self.request_counts[path] = self.request_counts.get(path, 0) + 1
+            path_faults = self.faults.get(path)
+            return path_faults.pop(0) if path_faults else None
+
+    def start(self):
+        """Starts the server in a background thread and returns its base URL (without the ending slash)."""
+        site = self.site
+        site_server = self
+
+        class SyntheticSiteHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                fault = site_server.take_fault(self.path)
+                if fault is not None and fault.get('delay'):
+                    time.sleep(fault['delay'])
+                if fault is not None and fault.get('status'):
+                    self.send_response(fault['status'])
+                    if fault.get('retry_after') is not None:
+                        self.send_header('Retry-After', fault['retry_after'])
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                page = site.get(self.path)
+                self.send_response(200 if page is not None else 404)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(page or b'')))
+                self.end_headers()
+                self.wfile.write(page or b'')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SyntheticSiteHandler)
+        self.server.handle_error = lambda request, client_address: None  # the scrapers close the pages early
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def stop(self):
+        """Stops the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def measure(function, page_count, byte_count, repeat):
+    """Runs the function repeat times and returns the metrics of the fastest run: pages per second and MB per second.
+    Then it runs the function once more with tracemalloc to get the peak of the allocated memory."""
+    seconds = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        run_seconds = time.perf_counter() - start
+        seconds = run_seconds if seconds is None else min(seconds, run_seconds)
+    tracemalloc.start()
+    try:
+        function()
+        peak_alloc = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'pages': page_count, 'bytes': byte_count, 'seconds': round(seconds, 6),
+            'pages_per_sec': round(page_count / seconds, 3), 'mb_per_sec': round(byte_count / seconds / 1e6, 3),
+            'peak_alloc_mb': round(peak_alloc / 1e6, 3)}
+
+
+def benchmark_url_collector(generator, link_count, page_count=20, repeat=3):
+    """Measures URLCollector.get_urls_to_scrap() on sub-category link pages, without downloading them."""
+    pages = {'link-page-{}'.format(i): generator.create_link_page(
+        PRODUCT_SUB_URLS_TO_SCRAP_CONFIG, ['/kategorier/{}-main/{}-sub/'.format(i, j) for j in range(link_count)])
+        for i in range(page_count)}
+    fetcher = StaticPageFetcher(pages)
+
+    def collect_urls():
+        for url in pages:
+            assert len(URLCollector(url, PRODUCT_SUB_URLS_TO_SCRAP_CONFIG, fetcher).get_urls_to_scrap()) == link_count
+
+    return measure(collect_urls, page_count, sum(len(page) for page in pages.values()), repeat)
+
+
+def benchmark_product_scraper(generator, product_count, page_count=10, repeat=3):
+    """Measures ProductScraper.get_product_scraping_data() on product pages, without downloading them."""
+    pages = {'product-page-{}'.format(i): generator.create_product_page(product_count, i) for i in range(page_count)}
+    fetcher = StaticPageFetcher(pages)
+
+    def scrape_products():
+        for url in pages:
+            product_columns = ProductScraper(url, PRODUCT_SCRAPING_CONFIG, fetcher).get_product_scraping_data()
+            assert all(len(column) == product_count for column in product_columns.values())
+
+    return measure(scrape_products, page_count, sum(len(page) for page in pages.values()), repeat)
+
+
+def benchmark_runner(generator, main_categ_count, sub_categ_count, product_count, repeat=3):
+    """Measures the whole WebScraperRunner workflow against the synthetic site served on a local HTTP server.
+    The runner uses the crawl settings of config.yml, but its URLs are pointed to the local server and the results are
+    written into a temporary directory."""
+    site = generator.create_site(main_categ_count, sub_categ_count, product_count)
+    site_server = SyntheticSiteServer(site)
+    base_url = site_server.start()
+    fetcher = None
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config = dict(load_whole_config())
+        config[MAIN_SOURCE_URL] = base_url + '/'
+        config[SUB_SOURCE_URL_BEGINNING] = base_url
+        config_file = os.path.join(temp_dir, 'config.yml')
+        with open(config_file, 'w') as benchmark_config_file:
+            yaml.safe_dump(config, benchmark_config_file)
+        previous_config_file = set_config_file(config_file)
+        try:
+            fetcher = HTTPFetcher(max_requests_per_host=config[FETCHER_CONFIG].get(MAX_REQUESTS_PER_HOST, 4))
+
+            def run_web_scraping():
+                with contextlib.redirect_stdout(io.StringIO()):
+                    WebScraperRunner.run_web_scraping_and_save_data(
+                        fetcher=fetcher, result_sink=CSVSink(os.path.join(temp_dir, 'result.csv')),
+                        crawl_journal_file=os.path.join(temp_dir, 'crawl_journal.jsonl'))
+
+            return measure(run_web_scraping, len(site), sum(len(page) for page in site.values()), repeat)
+        finally:
+            set_config_file(previous_config_file)
+            if fetcher is not None:
+                fetcher.close()
+            site_server.stop()
+
+
+def benchmark_product_page_scaling(generator, product_counts=(1250, 2500, 5000)):
+    """Measures how long it takes for ProductScraper to collect the products of pages of different sizes.
+    As the products are collected in columns, the time per product should stay about the same as the page grows.
+    Returns a dictionary of product count -> microseconds per product."""
+    results = {}
+    for product_count in product_counts:
+        url = 'product-page-{}'.format(product_count)
+        fetcher = StaticPageFetcher({url: generator.create_product_page(product_count)})
+        start = time.perf_counter()
+        ProductScraper(url, PRODUCT_SCRAPING_CONFIG, fetcher).get_product_scraping_data()
+        results[product_count] = round((time.perf_counter() - start) / product_count * 1e6, 3)
+    return results
+
+
+def benchmark_parser_workers(generator, worker_counts=(1, 2, 4), page_count=64, product_count=500):
+    """Measures the parse throughput of the parser worker processes used by the crawl pipeline, with different
+    numbers of workers. The throughput should grow about linearly with the number of workers, up to the number of
+    CPU cores. Returns a dictionary of worker count -> pages per second."""
+    page = generator.create_product_page(product_count)
+    results = {}
+    for worker_count in worker_counts:
+        with ProcessPoolExecutor(max_workers=worker_count, initializer=init_parser_worker) as executor:
+            list(executor.map(parse_product_page, ['warm-up'] * worker_count, [page] * worker_count))
+            start = time.perf_counter()
+            list(executor.map(parse_product_page, ['product-page'] * page_count, [page] * page_count))
+            results[worker_count] = round(page_count / (time.perf_counter() - start), 3)
+    return results
+
+
+def verify_fetch_policy():
+    """Checks the retries, timeouts and Retry-After handling of the fetch policy against a local server that injects
+    throttling, server errors and delays (see SyntheticSiteServer). Returns the list of the failed checks."""
+    page = b'<html><body>ok</body></html>'
+    http_date = email.utils.formatdate(time.time() + 1, usegmt=True)
+    # path -> (faults, whether the fetch succeeds, number of requests expected, minimum seconds it takes)
+    checks = {'/throttled': ([{'status': 429, 'retry_after': '1'}], True, 2, 1.0),
+              '/throttled-until-date': ([{'status': 503, 'retry_after': http_date}], True, 2, 0.0),
+              '/server-errors': ([{'status': 503}, {'status': 502}, {'status': 500}], True, 4, 0.0),
+              '/slow': ([{'delay': 1.5}], True, 2, 0.5),
+              '/down': ([{'status': 503}] * 5, False, 4, 0.0),
+              '/missing': ([{'status': 404}], False, 1, 0.0),
+              '/retry-after-too-long': ([{'status': 503, 'retry_after': '100000'}], False, 1, 0.0),
+              '/stream-throttled': ([{'status': 429, 'retry_after': '0'}], True, 2, 0.0)}
+    site_server = SyntheticSiteServer({path: page for path in checks},
+                                      {path: faults for path, (faults, _, _, _) in checks.items()})
+    base_url = site_server.start()
+    failures = []
+    try:
+        for path, (_, expected_success, expected_requests, min_seconds) in checks.items():
+            # every check has its own fetcher, so the adaptive rate of one check does not slow down the others
+            fetcher = HTTPFetcher(fetch_policy=FetchPolicy(connect_timeout=2, read_timeout=0.5, max_retries=3,
+                                                           backoff_base=0.05, backoff_max=0.2, initial_rate=50))
+            start = time.perf_counter()
+            try:
+                if path.startswith('/stream'):
+                    with fetcher.stream(base_url + path) as response_stream:
+                        body = b''.join(response_stream)
+                else:
+                    body = fetcher.fetch(base_url + path)
+                success = body == page
+            except (urllib.error.HTTPError, OSError):
+                success = False
+            seconds = time.perf_counter() - start
+            requests = site_server.request_counts.get(path, 0)
+            if success != expected_success or requests != expected_requests or seconds < min_seconds:
+                failures.append('{}: success {}, {} requests, {:.2f} s (expected success {}, {} requests, at least '
+                                '{} s)'.format(path, success, requests, seconds, expected_success,
+                                               expected_requests, min_seconds))
+            if path == '/retry-after-too-long':
+                # the request fails at once, and the host is not paused for longer than MAX_RETRY_AFTER
+                paused_seconds = max(host_pool.host_rate.paused_until - time.monotonic()
+                                     for host_pool in fetcher.host_pools.values())
+                if seconds > 5 or paused_seconds > MAX_RETRY_AFTER:
+                    failures.append('{}: failed in {:.2f} s, host paused for {:.0f} s'.format(path, seconds,
+                                                                                           paused_seconds))
+            fetcher.close()
+    finally:
+        site_server.stop()
+    return failures
+
+
+def create_pre_slice_case(page_random, page_number):
+    """Returns a random page for verify_pre_slice(), shaped by the product scraping and sub-URL configs: the containers
+    and the products are surrounded by the cases where the container scan must not be fooled, like container named
+    tags inside scripts, comments and attribute values, self-closing containers, tags in another case, comments and
+    scripts splitting the product data, and unclosed comments and scripts."""
+    product_config = get_config_matcher(PRODUCT_SCRAPING_CONFIG)
+    link_config = get_config_matcher(PRODUCT_SUB_URLS_TO_SCRAP_CONFIG)
+    container = '<{} {}="{}">'.format(product_config.container_tag_name, product_config.container_tag_attr_name,
+                                      product_config.container_tag_attr_value)
+    sub_container = '<{} {}="{}">'.format(product_config.sub_container_tag_name,
+                                          product_config.sub_container_tag_attr_name,
+                                          product_config.sub_container_tag_attr_value)
+    link_container = '<{} {}="{}">'.format(link_config.container_tag_name, link_config.container_tag_attr_name,
+                                           link_config.container_tag_attr_value)
+    escaped_container = container.replace('"', "'")
+    noises = ['', '<script>document.write("{}")</script>'.format(container.replace('"', '\\"')),
+              '<style>.a{}</style>', '<!-- {} -->'.format(container), '<br/>', ' <style>p {}</style>',
+              '\n<script>var a = "{}";</script>\n'.format(escaped_container), '<DIV>x</DIV>']
+    heads = ['', '<!DOCTYPE html>', '<script>var s = "{}";</script>'.format(escaped_container),
+             '<!-- {} -->'.format(container), '<style>div {}</style>', '<script src="x"></script>', '<!-- unclosed',
+             '<a title="{}">t</a>'.format(escaped_container), container[:-1] + '/>', link_container[:-1] + '/>',
+             container[:-2] + 'x">', container.upper(), '{}<p>x</p></{}>'.format(sub_container,
+                                                                             product_config.sub_container_tag_name)]
+    field_tags = sorted((position, field, tag, attr_name, attr_value)
+                        for tag, tag_rules in product_config.product_info_rules.items()
+                        for (attr_name, attr_value), (position, field) in tag_rules.items())
+    products = []
+    for product_number in range(page_random.randint(0, 6)):
+        fields = []
+        for _, field, tag, attr_name, attr_value in field_tags:
+            text = page_random.choice(['{} {},80', '{} {}<!-- c -->,80', '{} <b>{}</b>',
+                                       '<script>var p=1</script>{} {}', '{} {} <script>var q="<p>"</script>,80',
+                                       '\n<style>p {{}}</style> {} {}'])
+            fields.append('<{0} {1}="{2}">{3}</{0}>'.format(tag, attr_name, attr_value,
+                                                            text.format(field, product_number)))
+        products.append('{}{}{}</{}>'.format(sub_container, page_random.choice(noises), ''.join(fields),
+                                             product_config.sub_container_tag_name))
+    links = ''.join('<{0} {1}="{2}" {3}="/kategorier/{4}/{5}/">l</{0}><script>"<{0} {1}={2} {3}=/x>"</script>'.format(
+        link_config.tag_name_to_search, link_config.tag_filter_attr_name, link_config.tag_filter_attr_value,
+        link_config.tag_attr_to_search, page_number, link_number) for link_number in range(3))
+    product_list = page_random.choice(['{}{}</{}>'.format(container, ''.join(products),
+                                                          product_config.container_tag_name),
+                                       '{}{}</{}>'.format(container.upper(), ''.join(products),
+                                                          product_config.container_tag_name.upper()),
+                                       ''.join(products)])
+    navigation = '{}<div>{}</div></{}>'.format(link_container, links, link_config.container_tag_name)
+    body = page_random.choice([navigation + product_list, product_list + navigation])
+    tail = page_random.choice(['', '<script>unclosed', '{}late</{}>'.format(container,
+                                                                          product_config.container_tag_name)])
+    head = ''.join(page_random.sample(heads, page_random.randint(0, 4)))
+    return '<html><head>{}</head><body>{}{}</body></html>'.format(head, body, tail).encode('utf-8')
+
+
+def verify_pre_slice(page_count=3000, seed=0):
+    """Checks that pre_slice_container does not change what the scrapers find: random pages full of the cases the
+    container scan has to handle (see create_pre_slice_case()) are scraped by ProductScraper and URLCollector with
+    and without pre-slicing, both from memory and streamed in chunks of random sizes (down to a byte), and the
+    products and URLs found must be the same every time. Returns the list of the failed pages."""
+    config = dict(load_whole_config())
+    config_names = {}
+    for config_name in (PRODUCT_SCRAPING_CONFIG, PRODUCT_SUB_URLS_TO_SCRAP_CONFIG):
+        for pre_slice in (False, True):
+            config_names[config_name, pre_slice] = '{}_pre_slice_{}'.format(config_name, pre_slice).lower()
+            config[config_names[config_name, pre_slice]] = dict(config[config_name], **{PRE_SLICE_CONTAINER: pre_slice})
+    page_random = random.Random(seed)
+    source_url = 'http://localhost/kategorier/1/'
+    failures = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        config_file = os.path.join(temp_dir, 'config.yml')
+        with open(config_file, 'w') as verify_config_file:
+            yaml.safe_dump(config, verify_config_file)
+        previous_config_file = set_config_file(config_file)
+        try:
+            for page_number in range(page_count):
+                page = create_pre_slice_case(page_random, page_number)
+                for scraper_class, config_name, get_result in (
+                        (ProductScraper, PRODUCT_SCRAPING_CONFIG, lambda scraper: scraper.get_product_columns()),
+                        (URLCollector, PRODUCT_SUB_URLS_TO_SCRAP_CONFIG, lambda scraper: scraper.url_list)):
+                    results = []
+                    for pre_slice in (False, True):
+                        scraper = scraper_class(source_url, config_names[config_name, pre_slice])
+                        scraper.feed_html_source(page.decode('utf-8'))
+                        results.append(get_result(scraper))
+                        for chunk_sizes in ((1, 2, 3), (7, 40), (1000,)):
+                            fetcher = ChunkedPageFetcher({source_url: page}, chunk_sizes, page_random)
+                            scraper = scraper_class(source_url, config_names[config_name, pre_slice], fetcher)
+                            scraper.feed_source_url()
+                            results.append(get_result(scraper))
+                    if any(result != results[0] for result in results):
+                        failures.append('{} on page {}: {}'.format(scraper_class.__name__, page_number,
+                                                                   page.decode('utf-8')))
+        finally:
+            set_config_file(previous_config_file)
+    return failures
+
+
+def write_crawl_config(base_url, run_dir, crawl_settings):
+    """Writes the config file of a crawl against the site served on base_url into run_dir, and returns its path:
+    the settings of config.yml changed by crawl_settings, without delta crawl and instrumentation."""
+    config = dict(load_whole_config(), **crawl_settings)
+    config[MAIN_SOURCE_URL] = base_url + '/'
+    config[SUB_SOURCE_URL_BEGINNING] = base_url
+    config[OUTPUT_CONFIG] = dict(config[OUTPUT_CONFIG], **{DELTA_CRAWL: False})
+    config[INSTRUMENTATION_CONFIG] = dict(config.get(INSTRUMENTATION_CONFIG) or {}, **{INSTRUMENTATION_ENABLED: False})
+    config_file = os.path.join(run_dir, 'config.yml')
+    with open(config_file, 'w') as run_config_file:
+        yaml.safe_dump(config, run_config_file)
+    return config_file
+
+
+def run_crawl(base_url, run_dir, crawl_settings, resume=False):
+    """Runs the WebScraperRunner crawl against the site served on base_url, with the settings of config.yml changed
+    by crawl_settings (see CRAWL_MODES and write_crawl_config()). The result (result.csv) and the crawl journal
+    (crawl_journal.jsonl) are written into run_dir. Returns the number of products in the result."""
+    previous_config_file = set_config_file(write_crawl_config(base_url, run_dir, crawl_settings))
+    config = load_whole_config()
+    fetcher = HTTPFetcher(max_requests_per_host=config[FETCHER_CONFIG].get(MAX_REQUESTS_PER_HOST, 4))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return WebScraperRunner.run_web_scraping_and_save_data(
+                fetcher=fetcher, resume=resume, result_sink=CSVSink(os.path.join(run_dir, 'result.csv')),
+                crawl_journal_file=os.path.join(run_dir, 'crawl_journal.jsonl'))
+    finally:
+        set_config_file(previous_config_file)
+        fetcher.close()
+
+
+def read_file(file_path):
+    """Returns the bytes of a file, or None if it does not exist."""
+    if not os.path.exists(file_path):
+        return None
+    with open(file_path, 'rb') as read_file:
+        return read_file.read()
+
+
+def verify_crawl_modes(main_categ_count=4, sub_categ_count=5, product_count=50):
+    """Checks that the sequential, concurrent and pipeline crawls (see CRAWL_MODES) of a synthetic site served on
+    a local HTTP server write byte for byte the same result file. Returns the list of the failed checks."""
+    site = SyntheticPageGenerator(filler_size=2000).create_site(main_categ_count, sub_categ_count, product_count)
+    site_server = SyntheticSiteServer(site)
+    base_url = site_server.start()
+    failures = []
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = {}
+            for mode, crawl_settings in CRAWL_MODES.items():
+                run_dir = os.path.join(temp_dir, mode)
+                os.mkdir(run_dir)
+                row_count = run_crawl(base_url, run_dir, crawl_settings)
+                results[mode] = read_file(os.path.join(run_dir, 'result.csv'))
+                if row_count != main_categ_count * sub_categ_count * product_count:
+                    failures.append('{}: {} products instead of {}'.format(
+                        mode, row_count, main_categ_count * sub_categ_count * product_count))
+            for mode, result in results.items():
+                if result != results['sequential']:
+                    failures.append('{}: the result differs from the result of the sequential crawl'.format(mode))
+    finally:
+        site_server.stop()
+    return failures
+
+
+def verify_resume(main_categ_count=3, sub_categ_count=4, product_count=20):
+    """Checks in every crawl mode (see CRAWL_MODES) that a crawl failing in the middle keeps the sub-categories before
+    the failed one, and that the crawl resumed after it gives the same result as a crawl that has not failed, without
+    downloading the kept sub-categories again. The sub-category page in the middle of a synthetic site answers 404
+    once. Returns the list of the failed checks."""
+    site = SyntheticPageGenerator(filler_size=2000).create_site(main_categ_count, sub_categ_count, product_count)
+    sub_paths = [path for path in site if path.count('/') == 4]
+    failed_position = len(sub_paths) // 2
+    failures = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        site_server = SyntheticSiteServer(site)
+        base_url = site_server.start()
+        try:
+            os.mkdir(os.path.join(temp_dir, 'expected'))
+            run_crawl(base_url, os.path.join(temp_dir, 'expected'), CRAWL_MODES['sequential'])
+        finally:
+            site_server.stop()
+        expected_result = read_file(os.path.join(temp_dir, 'expected', 'result.csv'))
+        for mode, crawl_settings in CRAWL_MODES.items():
+            run_dir = os.path.join(temp_dir, mode)
+            os.mkdir(run_dir)
+            site_server = SyntheticSiteServer(site, {sub_paths[failed_position]: [{'status': 404}]})
+            base_url = site_server.start()
+            try:
+                try:
+                    run_crawl(base_url, run_dir, crawl_settings)
+                    failures.append('{}: the crawl has not failed'.format(mode))
+                    continue
+                except urllib.error.HTTPError:
+                    pass
+                with open(os.path.join(run_dir, 'crawl_journal.jsonl')) as journal_file:
+                    journal_entries = sum(1 for _ in journal_file)
+                result_lines = (read_file(os.path.join(run_dir, 'result.csv')) or b'').count(b'\n')
+                if journal_entries != failed_position or result_lines != failed_position * product_count + 1:
+                    failures.append('{}: {} journal entries and {} result lines kept (expected {} and {})'.format(
+                        mode, journal_entries, result_lines, failed_position, failed_position * product_count + 1))
+                run_crawl(base_url, run_dir, crawl_settings, resume=True)
+                if read_file(os.path.join(run_dir, 'result.csv')) != expected_result:
+                    failures.append('{}: the resumed result differs from the result of a crawl without failure'.format(
+                        mode))
+                downloaded_again = [path for path in sub_paths[:failed_position]
+                                    if site_server.request_counts.get(path, 0) > 1]
+                if downloaded_again:
+                    failures.append('{}: the kept sub-categories {} have been downloaded again'.format(
+                        mode, downloaded_again))
+            finally:
+                site_server.stop()
+    return failures
+
+
+def run_frontier_worker(config_file, frontier_file, worker_id, result_file):
+    """Runs a frontier worker of verify_frontier() with the given config file, writing its products into its own CSV
+    file. It is run in a worker process of its own."""
+    set_config_file(config_file)
+    fetcher = HTTPFetcher(max_requests_per_host=load_whole_config()[FETCHER_CONFIG].get(MAX_REQUESTS_PER_HOST, 4))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return WebScraperRunner.run_frontier_worker(worker_id, fetcher, frontier_file,
+                                                        CSVSink(result_file, FRONTIER_MAX_BUFFERED_ROWS))
+    finally:
+        fetcher.close()
+
+
+def read_data_lines(result_files):
+    """Returns the sorted data lines (without the header lines) of the CSV result files that exist."""
+    data_lines = []
+    for result_file in result_files:
+        result = read_file(result_file)
+        if result is not None:
+            data_lines.extend(result.splitlines()[1:])
+    return sorted(data_lines)
+
+
+def verify_frontier(worker_count=3, main_categ_count=3, sub_categ_count=4, product_count=20, lease_timeout=2):
+    """Checks a crawl shared by worker processes through the URL frontier against a synthetic site, where the
+    downloads of two sub-categories hang:
+    - the worker downloading the first one is killed while it holds the lease, the other workers take
+      the sub-category over when the lease has expired, and the killed worker is restarted at the end, which cuts its
+      output back to its last checkpoint,
+    - the worker downloading the second one is suspended until another worker has taken the sub-category over, so it
+      finds out that it has lost the lease only when it is resumed, and has to drop the sub-category from its output.
+    The products of all the workers together must be the same as the products of a single worker, none of them
+    twice. Returns the list of the failed checks."""
+    site = SyntheticPageGenerator(filler_size=2000).create_site(main_categ_count, sub_categ_count, product_count)
+    sub_paths = [path for path in site if path.count('/') == 4]
+    killed_path, suspended_path = sub_paths[len(sub_paths) // 3], sub_paths[len(sub_paths) * 2 // 3]
+    crawl_settings = {FRONTIER_CONFIG: {LEASE_TIMEOUT: lease_timeout, MAX_RETRIES: 3, POLL_INTERVAL: 0.1}}
+    failures = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        single_dir = os.path.join(temp_dir, 'single')
+        os.mkdir(single_dir)
+        site_server = SyntheticSiteServer(site)
+        base_url = site_server.start()
+        try:
+            run_frontier_worker(write_crawl_config(base_url, single_dir, crawl_settings),
+                                os.path.join(single_dir, 'frontier.sqlite'), 'single',
+                                os.path.join(single_dir, 'single.csv'))
+        finally:
+            site_server.stop()
+        expected_lines = read_data_lines([os.path.join(single_dir, 'single.csv')])
+
+        shared_dir = os.path.join(temp_dir, 'shared')
+        os.mkdir(shared_dir)
+        # the hanging downloads are answered only after the leases of their workers have expired
+        site_server = SyntheticSiteServer(site, {path: [{'delay': lease_timeout * 3}]
+                                                 for path in (killed_path, suspended_path)})
+        base_url = site_server.start()
+        config_file = write_crawl_config(base_url, shared_dir, crawl_settings)
+        frontier_file = os.path.join(shared_dir, 'frontier.sqlite')
+        worker_ids = ['worker-{}'.format(number) for number in range(worker_count)]
+        result_files = [os.path.join(shared_dir, worker_id + '.csv') for worker_id in worker_ids]
+        # the workers are started as new processes, not forked from this one, which runs the server threads
+        process_context = multiprocessing.get_context('spawn')
+        frontier = URLFrontier(frontier_file, lease_timeout)
+
+        def wait_for_lease_owner(path, is_waited_for, timeout=60):
+            """Returns the owner of the lease of the sub-category when is_waited_for(owner) is True, or None if
+            it is not so within the timeout."""
+            deadline = time.monotonic() + timeout
+            while time.monotonic() < deadline:
+                lease_owner = frontier.get_lease_owner(ITEM_SUB, path)
+                if is_waited_for(lease_owner):
+                    return lease_owner
+                time.sleep(0.05)
+            return None
+
+        try:
+            frontier.open(reset=True)
+            processes = {worker_id: process_context.Process(target=run_frontier_worker,
+                                                            args=(config_file, frontier_file, worker_id, result_file))
+                         for worker_id, result_file in zip(worker_ids, result_files)}
+            for process in processes.values():
+                process.start()
+            killed_worker_id = wait_for_lease_owner(
+                killed_path, lambda owner: owner is not None and site_server.request_counts.get(killed_path, 0) > 0)
+            if killed_worker_id is not None:
+                processes[killed_worker_id].kill()
+            suspended_worker_id = wait_for_lease_owner(
+                suspended_path, lambda owner: owner not in (None, killed_worker_id)
+                and site_server.request_counts.get(suspended_path, 0) > 0)
+            if suspended_worker_id is not None:
+                os.kill(processes[suspended_worker_id].pid, signal.SIGSTOP)
+                wait_for_lease_owner(suspended_path, lambda owner: owner != suspended_worker_id)
+                os.kill(processes[suspended_worker_id].pid, signal.SIGCONT)
+            for process in processes.values():
+                process.join(120)
+            if killed_worker_id is not None:
+                killed_result_file = result_files[worker_ids.index(killed_worker_id)]
+                restarted_process = process_context.Process(
+                    target=run_frontier_worker, args=(config_file, frontier_file, killed_worker_id, killed_result_file))
+                restarted_process.start()
+                restarted_process.join(120)
+            status_counts = frontier.get_status_counts()
+            shared_lines = read_data_lines(result_files)
+            row_count = frontier.get_row_count()
+        finally:
+            frontier.close()
+            site_server.stop()
+    if killed_worker_id is None or suspended_worker_id is None:
+        failures.append('frontier: the workers downloading {} and {} have not been found'.format(killed_path,
+                                                                                                 suspended_path))
+    if status_counts[STATUS_DONE] != sum(status_counts.values()):
+        failures.append('frontier: not every URL is done: {}'.format(status_counts))
+    for path in (killed_path, suspended_path):
+        if site_server.request_counts.get(path, 0) < 2:
+            failures.append('frontier: {} has not been taken over by another worker'.format(path))
+    duplicated_count = len(shared_lines) - len(set(shared_lines))
+    if duplicated_count:
+        failures.append('frontier: {} products have been written more than once'.format(duplicated_count))
+    if shared_lines != expected_lines:
+        failures.append('frontier: the workers have written {} products, not the {} products of a single '
+                        'worker'.format(len(shared_lines), len(expected_lines)))
+    if row_count != len(expected_lines):
+        failures.append('frontier: the frontier counts {} products, not {}'.format(row_count, len(expected_lines)))
+    return failures
+
+
+def compare_results(results, baseline, tolerance):
+    """Compares the benchmark results with the baseline results. Returns the list of regressions: the metrics that
+    are worse than the baseline by more than the tolerance (a ratio, 0.1 means 10%)."""
+    regressions = []
+    for name, metrics in results['benchmarks'].items():
+        baseline_metrics = baseline.get('benchmarks', {}).get(name)
+        if baseline_metrics is None:
+            continue
+        for metric in HIGHER_IS_BETTER_METRICS:
+            if metrics[metric] < baseline_metrics[metric] * (1 - tolerance):
+                regressions.append('{} {}: {} < {} (baseline)'.format(name, metric, metrics[metric],
+                                                                      baseline_metrics[metric]))
+        for metric in LOWER_IS_BETTER_METRICS:
+            if metrics[metric] > baseline_metrics[metric] * (1 + tolerance):
+                regressions.append('{} {}: {} > {} (baseline)'.format(name, metric, metrics[metric],
+                                                                      baseline_metrics[metric]))
+    return regressions
+
+
+def main():
+    """Runs the benchmarks, saves the results as JSON, and compares them with a baseline if one is given.
+    Exits with 1 if there is any regression. With any of the --verify-... options, the checks chosen are run instead
+    of the benchmarks (the fetch policy, the results of the crawl modes, pre-slicing, the resume after a failure and
+    the frontier workers), and it exits with 1 if any of them fails."""
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the web scraping on synthetic pages.')
+    parser.add_argument('--output', default=BENCHMARK_RESULT_FILE, help='JSON file to save the results into')
+    parser.add_argument('--baseline', help='JSON file of earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed ratio of regression, default 0.1')
+    parser.add_argument('--links', type=int, default=200, help='number of links on a category page')
+    parser.add_argument('--products', type=int, default=500, help='number of products on a product page')
+    parser.add_argument('--main-categs', type=int, default=4, help='number of main categories of the site')
+    parser.add_argument('--sub-categs', type=int, default=5, help='number of sub-categories of a main category')
+    parser.add_argument('--filler-size', type=int, default=20000, help='size of the noise around the container')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs, the fastest one is kept')
+    parser.add_argument('--scaling', action='store_true',
+                        help='also measure the scaling with the page size and with the parser workers')
+    parser.add_argument('--verify-fetch-policy', action='store_true',
+                        help='instead of the benchmarks, check the retries, timeouts and Retry-After handling against '
+                             'a local server injecting 429s, 5xx errors and delays')
+    parser.add_argument('--verify-pre-slice', action='store_true',
+                        help='instead of the benchmarks, check that random tricky pages are scraped the same with and '
+                             'without pre_slice_container, in memory and streamed in chunks')
+    parser.add_argument('--verify-crawl-modes', action='store_true',
+                        help='instead of the benchmarks, check that the sequential, concurrent and pipeline crawls '
+                             'write the same result file')
+    parser.add_argument('--verify-resume', action='store_true',
+                        help='instead of the benchmarks, check in every crawl mode that a crawl failing in the middle '
+                             'is resumed from the last saved sub-category, to the same result')
+    parser.add_argument('--verify-frontier', action='store_true',
+                        help='instead of the benchmarks, check that frontier worker processes, one of them killed and '
+                             'one suspended while holding a lease, write the same products as a single worker')
+    args = parser.parse_args()
+
+    if args.verify_fetch_policy or args.verify_crawl_modes or args.verify_pre_slice or args.verify_resume \
+            or args.verify_frontier:
+        failures = verify_fetch_policy() if args.verify_fetch_policy else []
+        if args.verify_crawl_modes:
+            failures += verify_crawl_modes()
+        if args.verify_pre_slice:
+            failures += verify_pre_slice()
+        if args.verify_resume:
+            failures += verify_resume()
+        if args.verify_frontier:
+            failures += verify_frontier()
+        for failure in failures:
+            print('FAILED ' + failure)
+        if failures:
+            sys.exit(1)
+        print('All the checks have passed.')
+        return
+
+    generator = SyntheticPageGenerator(filler_size=args.filler_size)
+    results = {'parameters': {'links': args.links, 'products': args.products, 'main_categs': args.main_categs,
+                              'sub_categs': args.sub_categs, 'filler_size': args.filler_size},
+               'benchmarks': {}}
+    results['benchmarks']['url_collector'] = benchmark_url_collector(generator, args.links, repeat=args.repeat)
+    results['benchmarks']['product_scraper'] = benchmark_product_scraper(generator, args.products,
+                                                                         repeat=args.repeat)
+    results['benchmarks']['web_scraper_runner'] = benchmark_runner(generator, args.main_categs, args.sub_categs,
+                                                                   args.products, repeat=args.repeat)
+    if args.scaling:
+        results['scaling'] = {'us_per_product': benchmark_product_page_scaling(generator),
+                              'parser_worker_pages_per_sec': benchmark_parser_workers(generator),
+                              'cpu_count': os.cpu_count()}
+    for name, metrics in results['benchmarks'].items():
+        print('{:<20} {:>10.1f} pages/s {:>8.2f} MB/s {:>8.2f} MB peak'.format(
+            name, metrics['pages_per_sec'], metrics['mb_per_sec'], metrics['peak_alloc_mb']))
+    if args.scaling:
+        print(json.dumps(results['scaling'], indent=2))
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('parameters') != results['parameters']:
+            print('The baseline has been measured with other parameters: {}'.format(baseline.get('parameters')))
+        regressions = compare_results(results, baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+        print('No regression compared to the baseline.')
+
+
+if __name__ == "__main__":
+    main()
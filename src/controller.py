@@ -1,11 +1,59 @@
+import argparse
+
 from src.web_sraping import WebScraperRunner
+from src.instrumentation import CrawlInstrumentation
 from src.data_management import ReportCreater
+from src.price_history import PriceHistoryStore, check_pyarrow_installed
+from src.output_sinks import get_result_path
+from src.utils import load_config
+from src.settings import OUTPUT_CONFIG, OUTPUT_SINK, DELTA_CRAWL, PRICE_HISTORY, FRONTIER_RESULT_DIR
 
 
 def main():
-    """Main method which runs everything."""
-    WebScraperRunner.run_web_scraping_and_save_data()
-    ReportCreater.create_product_distribution_report()
+    """Main method which runs everything.
+    With the --resume argument, an interrupted web scraping is continued from the last saved sub-category.
+    With --instrument (or --profile-parse) the run is measured, whatever the instrumentation config is.
+    With --frontier-workers the crawl is shared through the URL frontier by that many worker processes, and with
+    --worker-id this process joins the crawl of the frontier as one worker (for example from another machine).
+    The reports are created from the result written by the output sink set in the config. If the output /
+    price_history config is set, the products of the run are appended to the price history; then the crawl is not
+    started at all if pyarrow is not installed, as the history could not be written. Neither is done after
+    a delta crawl, whose result has only the changes: the charts of the catalogue are kept as they are."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the sub-categories already saved by the previous, interrupted run')
+    parser.add_argument('--instrument', action='store_true',
+                        help='measure every scraped URL and write the run report and the Prometheus metrics file')
+    parser.add_argument('--profile-parse', action='store_true',
+                        help='like --instrument, and also profile the parse stage with cProfile')
+    parser.add_argument('--frontier-workers', type=int, default=0,
+                        help='share the crawl between this many worker processes through the URL frontier')
+    parser.add_argument('--worker-id',
+                        help='run one worker of the crawl shared through the URL frontier, with this ID')
+    args = parser.parse_args()
+    if load_config(OUTPUT_CONFIG).get(PRICE_HISTORY) and not args.worker_id:
+        check_pyarrow_installed()
+    if args.worker_id:
+        # the other workers may still be running, so the reports are created by whoever started the crawl
+        WebScraperRunner.run_frontier_worker(args.worker_id)
+        return
+    if args.frontier_workers:
+        WebScraperRunner.run_frontier_crawl(args.frontier_workers, resume=args.resume)
+        ReportCreater.create_product_distribution_report(FRONTIER_RESULT_DIR)
+        if load_config(OUTPUT_CONFIG).get(PRICE_HISTORY):
+            PriceHistoryStore().append_run(FRONTIER_RESULT_DIR)
+        return
+    instrumentation = None
+    if args.instrument or args.profile_parse:
+        instrumentation = CrawlInstrumentation(profile_parse=args.profile_parse)
+    WebScraperRunner.run_web_scraping_and_save_data(resume=args.resume, instrumentation=instrumentation)
+    output_config = load_config(OUTPUT_CONFIG)
+    if output_config.get(DELTA_CRAWL):
+        return
+    result_path = get_result_path(output_config.get(OUTPUT_SINK, 'csv'))
+    ReportCreater.create_product_distribution_report(result_path)
+    if output_config.get(PRICE_HISTORY):
+        PriceHistoryStore().append_run(result_path)
 
 
 if __name__ == "__main__":
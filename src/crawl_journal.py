@@ -0,0 +1,74 @@
+import json
+import os
+
+
+class CrawlJournal:
+    """CrawlJournal records the sub-categories whose products have already been saved, one JSON line for each.
+    A line holds the main and sub-category URL, the number of products saved, and the checkpoint of the output after
+    the products have been written, so that an interrupted crawl can be resumed from the last saved sub-category.
+    """
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self.done = {}
+        self.last_checkpoint = None
+        self.pending = []
+        self.file = None
+
+    def open(self, resume):
+        """Opens the journal. If we resume the crawl, the sub-categories saved by the previous run are loaded,
+        otherwise the journal is started from scratch."""
+        self.done = {}
+        self.last_checkpoint = None
+        valid_lines = []
+        if resume and os.path.exists(self.journal_file):
+            with open(self.journal_file, encoding='utf-8') as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # the last line may have been cut in half by the failure
+                    self.done[(entry['main_url'], entry['sub_url'])] = entry['rows']
+                    self.last_checkpoint = entry['checkpoint']
+                    valid_lines.append(line.rstrip('\n') + '\n')
+        # a cut line is dropped, so that the new lines are written right after the last valid one
+        self.file = open(self.journal_file, 'w', encoding='utf-8')
+        self.file.writelines(valid_lines)
+        self.file.flush()
+
+    def is_done(self, main_url, sub_url):
+        """Returns True if the products of the sub-category have been saved already."""
+        return (main_url, sub_url) in self.done
+
+    def get_last_checkpoint(self):
+        """Returns the checkpoint of the output after the last saved sub-category, or None if there is none."""
+        return self.last_checkpoint
+
+    def add_pending(self, main_url, sub_url, rows):
+        """Adds a sub-category whose products have been given to the output, but may not have been written out yet.
+        It is recorded by mark_pending_done() when the output has written it out."""
+        self.pending.append((main_url, sub_url, rows))
+
+    def mark_pending_done(self, checkpoint):
+        """Records all the pending sub-categories as saved, with the checkpoint of the output after them.
+        The lines are forced to the disk, so they are not lost even if the process is killed right after."""
+        if not self.pending:
+            return
+        for main_url, sub_url, rows in self.pending:
+            self.file.write(json.dumps({'main_url': main_url, 'sub_url': sub_url, 'rows': rows,
+                                        'checkpoint': checkpoint}) + '\n')
+            self.done[(main_url, sub_url)] = rows
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+        self.last_checkpoint = checkpoint
+
+    def get_row_count(self):
+        """Returns the number of products saved so far, including the ones saved by the resumed run."""
+        return sum(self.done.values())
+
+    def close(self):
+        """Closes the journal file."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
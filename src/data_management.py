@@ -1,20 +1,180 @@
+import glob
+import json
+import os
 import pandas as pd
-import matplotlib.pyplot as plt
 
-from src.settings import RESULT_FILE, REPORT_FILE_MAIN
+from src.price_columns import parse_amounts
+from src.settings import RESULT_FILE, REPORT_FILE_MAIN, REPORT_FILE_SUB, REPORT_CHUNK_SIZE, REPORT_CACHE_SUFFIX, \
+                         MAIN_CATEG_COL, SUB_CATEG_COL, PRICE_COL
 
 # It would be nice to have separate classes for data writing, reading, etc ...
 
+# the statistics kept for each sub-category; they can be added up chunk by chunk and sub-category by main category
+SUM_STATS = ('products', 'priced_products', 'price_sum', 'price_square_sum')
+MIN_STATS = ('price_min',)
+MAX_STATS = ('price_max',)
+# the columns of the result that the reports are computed from
+REPORT_COLUMNS = (MAIN_CATEG_COL, SUB_CATEG_COL, PRICE_COL)
+SUB_CATEG_STATS_COLUMNS = [MAIN_CATEG_COL, SUB_CATEG_COL] + list(SUM_STATS + MIN_STATS + MAX_STATS)
+
 
 class ReportCreater:
-    """The ReportCreater class is responsible for creating reports based on the scraped product data."""
+    """The ReportCreater class is responsible for creating reports based on the scraped product data.
+    The aggregates of the reports are computed in one pass over the result file, chunk by chunk, reading only the
+    category and price columns, so the memory needed does not depend on the size of the result. They are cached in
+    a file next to the result file, and computed again only when the result file has changed.
+    """
+
+    @classmethod
+    def get_result_version(cls, result_path):
+        """Returns the modification time and the size of the result file. For a result directory (Parquet) it is
+        the latest modification time and the total size of its files."""
+        if not os.path.isdir(result_path):
+            result_stat = os.stat(result_path)
+            return [result_stat.st_mtime_ns, result_stat.st_size]
+        mtime, size = os.stat(result_path).st_mtime_ns, 0
+        for dir_path, _, file_names in os.walk(result_path):
+            for file_name in file_names:
+                file_stat = os.stat(os.path.join(dir_path, file_name))
+                mtime, size = max(mtime, file_stat.st_mtime_ns), size + file_stat.st_size
+        return [mtime, size]
+
+    @classmethod
+    def read_result_chunks(cls, result_path, chunk_size=REPORT_CHUNK_SIZE, columns=REPORT_COLUMNS):
+        """Reads the given columns (by default the category and price columns) of the result file (CSV, JSON Lines or
+        a Parquet directory) chunk by chunk, and yields the chunks as DataFrames. The columns that the result does not
+        have are left out. The result can also be a directory of CSV or JSON Lines files.
+        An empty result file (of a run without products, for example a delta crawl without changes) has no chunks."""
+        columns = list(columns)
+        if not os.path.isdir(result_path) and os.path.getsize(result_path) == 0:
+            return
+        # a directory of CSV or JSON Lines files (the outputs of the frontier workers) is read file by file
+        part_files = []
+        if os.path.isdir(result_path):
+            part_files = sorted(glob.glob(os.path.join(result_path, '*.csv')) +
+                                glob.glob(os.path.join(result_path, '*.jsonl')))
+        if part_files:
+            for part_file in part_files:
+                if os.path.getsize(part_file) > 0:  # a worker that has not written any products
+                    yield from cls.read_result_chunks(part_file, chunk_size, columns)
+        elif os.path.isdir(result_path):
+            import pyarrow.dataset  # only needed for Parquet results
+            dataset = pyarrow.dataset.dataset(result_path, format='parquet', partitioning='hive')
+            dataset_columns = [column for column in columns if column in dataset.schema.names]
+            for batch in dataset.to_batches(columns=dataset_columns, batch_size=chunk_size):
+                yield batch.to_pandas()
+        elif result_path.endswith('.jsonl'):
+            for chunk in pd.read_json(result_path, lines=True, chunksize=chunk_size, dtype=False):
+                yield chunk[[column for column in columns if column in chunk]]
+        else:
+            try:
+                header = pd.read_csv(result_path, nrows=0).columns
+            except pd.errors.EmptyDataError:
+                return  # no header line
+            yield from pd.read_csv(result_path, usecols=[column for column in columns if column in header],
+                                   dtype={MAIN_CATEG_COL: 'category', SUB_CATEG_COL: 'category'},
+                                   chunksize=chunk_size)
+
+    @classmethod
+    def aggregate_chunk(cls, chunk):
+        """Returns the statistics of the sub-categories of a chunk of products."""
+        if PRICE_COL not in chunk:
+            prices = pd.Series(float('nan'), index=chunk.index)
+        elif pd.api.types.is_numeric_dtype(chunk[PRICE_COL]):
+            prices = chunk[PRICE_COL].astype('float64')
+        else:
+            prices = parse_amounts(chunk[PRICE_COL])[0].astype('float64')  # the price texts of an untyped result
+        grouped = pd.DataFrame({MAIN_CATEG_COL: chunk[MAIN_CATEG_COL].astype('category'),
+                                SUB_CATEG_COL: chunk[SUB_CATEG_COL].astype('category'),
+                                'price': prices, 'price_square': prices ** 2}) \
+            .groupby([MAIN_CATEG_COL, SUB_CATEG_COL], observed=True)
+        return pd.DataFrame({'products': grouped.size(), 'priced_products': grouped['price'].count(),
+                             'price_sum': grouped['price'].sum(), 'price_square_sum': grouped['price_square'].sum(),
+                             'price_min': grouped['price'].min(), 'price_max': grouped['price'].max()})
+
+    @classmethod
+    def combine_stats(cls, stats, level):
+        """Adds up the statistics that have the same index values on the given level(s)."""
+        aggregations = {stat: 'sum' for stat in SUM_STATS}
+        aggregations.update({stat: 'min' for stat in MIN_STATS})
+        aggregations.update({stat: 'max' for stat in MAX_STATS})
+        return stats.groupby(level=level, observed=True, sort=False).agg(aggregations)
+
+    @classmethod
+    def compute_sub_categ_stats(cls, result_path):
+        """Computes the statistics of every sub-category in one pass over the result file."""
+        chunk_stats = [cls.aggregate_chunk(chunk) for chunk in cls.read_result_chunks(result_path)]
+        if not chunk_stats:
+            return pd.DataFrame(columns=SUB_CATEG_STATS_COLUMNS).set_index([MAIN_CATEG_COL, SUB_CATEG_COL])
+        return cls.combine_stats(pd.concat(chunk_stats), [0, 1])
+
+    @classmethod
+    def load_sub_categ_stats(cls, result_path=RESULT_FILE):
+        """Returns the statistics of every sub-category of the result file. They are served from the cache file next
+        to the result file if the result file has not changed since they were computed."""
+        cache_file = result_path.rstrip('/\\') + REPORT_CACHE_SUFFIX
+        result_version = cls.get_result_version(result_path)
+        if os.path.exists(cache_file):
+            with open(cache_file, encoding='utf-8') as report_cache_file:
+                cache = json.load(report_cache_file)
+            if cache.get('result_version') == result_version:
+                # the columns are given, so the stats of a result without products are read back too
+                return pd.DataFrame(cache['sub_categ_stats'], columns=SUB_CATEG_STATS_COLUMNS) \
+                    .set_index([MAIN_CATEG_COL, SUB_CATEG_COL])
+        sub_categ_stats = cls.compute_sub_categ_stats(result_path)
+        with open(cache_file, 'w', encoding='utf-8') as report_cache_file:
+            json.dump({'result_version': result_version,
+                       'sub_categ_stats': json.loads(sub_categ_stats.reset_index().to_json(orient='records'))},
+                      report_cache_file)
+        return sub_categ_stats
+
+    @classmethod
+    def finish_stats(cls, stats):
+        """Returns the report statistics from the summed up ones: the number of products, and the mean, standard
+        deviation, minimum and maximum of the prices."""
+        priced_products = stats['priced_products'].astype('float64')
+        price_mean = stats['price_sum'] / priced_products
+        price_variance = (stats['price_square_sum'] - stats['price_sum'] * price_mean) / (priced_products - 1)
+        return pd.DataFrame({'products': stats['products'].astype('int64'), 'price_mean': price_mean,
+                             'price_std': price_variance.clip(lower=0) ** 0.5,
+                             'price_min': stats['price_min'], 'price_max': stats['price_max']})
+
+    @classmethod
+    def get_report_aggregates(cls, result_path=RESULT_FILE):
+        """Returns the aggregates of the reports: the statistics of the main categories and of the sub-categories,
+        ordered by the number of products."""
+        sub_categ_stats = cls.load_sub_categ_stats(result_path)
+        main_categ_stats = cls.combine_stats(sub_categ_stats, 0)
+        return {MAIN_CATEG_COL: cls.finish_stats(main_categ_stats).sort_values('products', ascending=False),
+                SUB_CATEG_COL: cls.finish_stats(sub_categ_stats).sort_values('products', ascending=False)}
+
+    @classmethod
+    def render_bar_chart(cls, counts, report_file, figsize):
+        """Saves a bar chart of the counts into the report file. matplotlib is imported only here, so that it is not
+        loaded unless a chart is rendered."""
+        import matplotlib
+        matplotlib.use('Agg')  # the charts are only saved into files
+        import matplotlib.pyplot as plt
+        figure = plt.figure(figsize=figsize)
+        counts.plot(kind='bar', color='blue')
+        plt.tight_layout()
+        plt.savefig(report_file)
+        plt.close(figure)
 
     @classmethod
-    def create_product_distribution_report(cls):
-        """Creates a chart report on the main category product distribution.
-        How many products each main category has.
+    def create_product_distribution_report(cls, result_path=RESULT_FILE):
+        """Creates chart reports on the product distribution: how many products each main category has
+        (REPORT_FILE_MAIN), and how many products each sub-category has (REPORT_FILE_SUB).
+        Returns the aggregates of the reports. More info at get_report_aggregates(). A result without products has
+        nothing to chart, the report files are not rendered then.
         """
-        df = pd.read_csv(RESULT_FILE)
-        df.main_categ.value_counts().plot(kind='bar', color='blue', figsize=(25, 25))
-        plt.savefig(REPORT_FILE_MAIN)
+        aggregates = cls.get_report_aggregates(result_path)
+        if aggregates[MAIN_CATEG_COL].empty:
+            return aggregates
+        cls.render_bar_chart(aggregates[MAIN_CATEG_COL]['products'], REPORT_FILE_MAIN, figsize=(25, 25))
+        sub_categ_counts = aggregates[SUB_CATEG_COL]['products']
+        sub_categ_counts.index = ['{} / {}'.format(main_categ, sub_categ) for main_categ, sub_categ
+                                  in sub_categ_counts.index]
+        cls.render_bar_chart(sub_categ_counts, REPORT_FILE_SUB, figsize=(max(25, len(sub_categ_counts) // 4), 25))
         # plt.show()
+        return aggregates
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+from src.utils import load_config
+from src.scraper_config import get_config_matcher
+from src.settings import PRODUCT_SCRAPING_CONFIG, PRODUCT_NAME_COL, EXTRA_INFO_COL, PRICE_COL, UNIT_PRICE_COL, \
+                         CHANGE_COL, PREVIOUS_PRICE_COL, PREVIOUS_UNIT_PRICE_COL
+
+CHANGE_ADDED = 'added'
+CHANGE_REMOVED = 'removed'
+CHANGE_PRICE_CHANGED = 'price_changed'
+
+
+class DeltaCrawl:
+    """DeltaCrawl keeps the snapshot of the last finished crawl in an SQLite file: for each sub-category URL the hash
+    of its container region and its product information columns. With it a crawl only has to deal with what has
+    changed since the last one:
+    - if the container region of a sub-category page has the same hash as in the snapshot, the page is not parsed,
+      the products of the snapshot are reused,
+    - the products of a sub-category are compared with the ones in the snapshot, keyed by the name and the extra
+      information of the product, and only the added, removed and price-changed products are given to the output.
+    The products of the running crawl are saved into a new snapshot, which replaces the last one when the crawl is
+    finished. So an interrupted crawl, when it is resumed, is still compared with the last finished one.
+    The same DeltaCrawl object can be shared by any number of threads.
+    """
+
+    def __init__(self, state_file):
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.connection = None
+        # the hash covers the product scraping config too, so changing the config makes every page to be parsed again
+        self.config_fingerprint = json.dumps(load_config(PRODUCT_SCRAPING_CONFIG), sort_keys=True).encode('utf-8')
+
+    def open(self, resume):
+        """Opens the state file. If we resume the crawl, the new snapshot saved so far by the interrupted crawl is
+        kept, otherwise it is started from scratch."""
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        self.connection = sqlite3.connect(self.state_file, check_same_thread=False)
+        for table in ('snapshot', 'next_snapshot'):
+            self.connection.execute('CREATE TABLE IF NOT EXISTS {} (sub_url TEXT PRIMARY KEY, main_url TEXT, '
+                                    'content_hash TEXT, product_columns BLOB)'.format(table))
+        if not resume:
+            self.connection.execute('DELETE FROM next_snapshot')
+        self.connection.commit()
+
+    def get_content_hash(self, html_source):
+        """Returns the hash of the container region of a product page, or None if the container is not found."""
+        region = get_config_matcher(PRODUCT_SCRAPING_CONFIG).find_container_region(html_source)
+        if region is None:
+            return None
+        content_hash = hashlib.blake2b(self.config_fingerprint, digest_size=16)
+        content_hash.update(html_source[region[0]:region[1]].encode('utf-8'))
+        return content_hash.hexdigest()
+
+    def get_pages_content_hash(self, html_sources):
+        """Returns the content hash of the pages of a product listing, or None if the container is not found in one
+        of them. For a single page, it is the hash of its container region (see get_content_hash())."""
+        content_hashes = [self.get_content_hash(html_source) for html_source in html_sources]
+        if None in content_hashes:
+            return None
+        if len(content_hashes) == 1:
+            return content_hashes[0]
+        return hashlib.blake2b(' '.join(content_hashes).encode('ascii'), digest_size=16).hexdigest()
+
+    def get_snapshot(self, sub_url):
+        """Returns the content hash and the product information columns of the sub-category in the last snapshot,
+        or (None, None) if it is not in the snapshot."""
+        with self.lock:
+            row = self.connection.execute('SELECT content_hash, product_columns FROM snapshot WHERE sub_url = ?',
+                                          (sub_url,)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], json.loads(zlib.decompress(row[1]))
+
+    def get_unchanged_columns(self, sub_url, content_hash):
+        """Returns the product information columns of the last snapshot if the container region of the sub-category
+        has not changed since then, otherwise None."""
+        if content_hash is None:
+            return None
+        snapshot_hash, product_columns = self.get_snapshot(sub_url)
+        return product_columns if snapshot_hash == content_hash else None
+
+    def save_and_diff(self, main_url, sub_url, content_hash, product_columns):
+        """Saves the products of the sub-category into the new snapshot, and returns the changes compared to
+        the last snapshot, as columns. More info at diff_products()."""
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO next_snapshot VALUES (?, ?, ?, ?)',
+                                    (sub_url, main_url, content_hash,
+                                     zlib.compress(json.dumps(product_columns).encode('utf-8'))))
+            self.connection.commit()
+        snapshot_columns = self.get_snapshot(sub_url)[1]
+        return diff_products(snapshot_columns or {}, product_columns)
+
+    def get_vanished_sub_categories(self):
+        """Returns the (main URL, sub-category URL, product information columns) of the sub-categories that are in
+        the last snapshot, but have not been crawled now. To be called at the end of the crawl: their products have
+        been removed."""
+        with self.lock:
+            rows = self.connection.execute('SELECT main_url, sub_url, product_columns FROM snapshot '
+                                           'WHERE sub_url NOT IN (SELECT sub_url FROM next_snapshot)').fetchall()
+        return [(main_url, sub_url, json.loads(zlib.decompress(product_columns)))
+                for main_url, sub_url, product_columns in rows]
+
+    def finish(self):
+        """Replaces the last snapshot by the new one, at the end of a finished crawl."""
+        with self.lock:
+            self.connection.execute('DELETE FROM snapshot')
+            self.connection.execute('INSERT INTO snapshot SELECT * FROM next_snapshot')
+            self.connection.execute('DELETE FROM next_snapshot')
+            self.connection.commit()
+
+    def close(self):
+        """Closes the state file."""
+        if self.connection is not None:
+            with self.lock:
+                self.connection.close()
+            self.connection = None
+
+
+def get_product_keys(product_columns):
+    """Returns the key of each product: its name, its extra information, and the number of the products with
+    the same name and extra information before it (so products listed more times are kept apart)."""
+    names = product_columns.get(PRODUCT_NAME_COL) or []
+    extra_infos = product_columns.get(EXTRA_INFO_COL) or [None] * len(names)
+    occurrences = {}
+    keys = []
+    for name_and_extra_info in zip(names, extra_infos):
+        occurrence = occurrences.get(name_and_extra_info, 0)
+        occurrences[name_and_extra_info] = occurrence + 1
+        keys.append(name_and_extra_info + (occurrence,))
+    return keys
+
+
+def diff_products(previous_columns, product_columns):
+    """Compares the products of a sub-category with its previous products, keyed by the name and the extra
+    information of the product. Returns the changes as columns: the change (added, removed or price_changed),
+    the product information (the previous one for a removed product), and the previous price and unit price for
+    a product whose price has changed. The unchanged products are left out."""
+    fields = list(product_columns) + [field for field in previous_columns if field not in product_columns]
+    change_columns = {CHANGE_COL: []}
+    change_columns.update((field, []) for field in fields)
+    change_columns[PREVIOUS_PRICE_COL] = []
+    change_columns[PREVIOUS_UNIT_PRICE_COL] = []
+
+    def add_change(change, columns, row, previous_row=None):
+        change_columns[CHANGE_COL].append(change)
+        for field in fields:
+            column = columns.get(field)
+            change_columns[field].append(column[row] if column is not None else None)
+        for previous_col, price_col in ((PREVIOUS_PRICE_COL, PRICE_COL), (PREVIOUS_UNIT_PRICE_COL, UNIT_PRICE_COL)):
+            previous_column = previous_columns.get(price_col)
+            change_columns[previous_col].append(previous_column[previous_row]
+                                                if previous_row is not None and previous_column is not None else None)
+
+    def get_value(columns, field, row):
+        column = columns.get(field)
+        return column[row] if column is not None else None
+
+    previous_rows = {key: row for row, key in enumerate(get_product_keys(previous_columns))}
+    current_keys = get_product_keys(product_columns)
+    for row, key in enumerate(current_keys):
+        previous_row = previous_rows.get(key)
+        if previous_row is None:
+            add_change(CHANGE_ADDED, product_columns, row)
+        elif get_value(product_columns, PRICE_COL, row) != get_value(previous_columns, PRICE_COL, previous_row) or \
+                get_value(product_columns, UNIT_PRICE_COL, row) != \
+                get_value(previous_columns, UNIT_PRICE_COL, previous_row):
+            add_change(CHANGE_PRICE_CHANGED, product_columns, row, previous_row)
+    current_key_set = set(current_keys)
+    for key, previous_row in previous_rows.items():
+        if key not in current_key_set:
+            add_change(CHANGE_REMOVED, previous_columns, previous_row)
+    return change_columns
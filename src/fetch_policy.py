@@ -0,0 +1,154 @@
+import email.utils
+import http.client
+import random
+import threading
+import time
+import urllib.error
+
+# the responses that tell that the server is overloaded or throttling us; the request is retried after a while
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+# the network errors that may not happen again at the next try
+TRANSIENT_ERRORS = (TimeoutError, ConnectionError, http.client.IncompleteRead, http.client.BadStatusLine)
+# a server asking for a longer wait than this is not waited for, the request fails
+MAX_RETRY_AFTER = 300
+RATE_DECREASE_FACTOR = 0.5
+# the latency of a response is rising if it is this many times the average latency of the host, and longer than it by
+# at least LATENCY_RISE_MIN seconds (so the jitter of very short latencies is not taken for a slowing host)
+LATENCY_RISE_FACTOR = 2.0
+LATENCY_RISE_MIN = 0.1
+LATENCY_SMOOTHING = 0.2
+
+
+def get_retry_after(headers):
+    """Returns the number of seconds to wait asked by the Retry-After header (given in seconds or as an HTTP date),
+    or None if there is no valid Retry-After header."""
+    retry_after = headers.get('Retry-After') if headers is not None else None
+    if not retry_after:
+        return None
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return float(retry_after)
+    try:
+        retry_date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if retry_date is None:
+        return None
+    return max(0.0, retry_date.timestamp() - time.time())
+
+
+class AdaptiveHostRate:
+    """AdaptiveHostRate spaces out the requests to one host, so that at most `rate` requests per second are started.
+    The rate is adapted to how the host responds (AIMD, additive increase, multiplicative decrease):
+    - while the responses are healthy, the rate is increased by about additive_increase requests per second every
+      second, up to max_rate,
+    - on an error response, a network error, or a response much slower than the average, the rate is halved, down
+      to min_rate; at most once in a round trip time, so the requests in flight at the same time do not halve it
+      again and again,
+    - if the host asks us to wait (Retry-After), no request is sent to it until then.
+    The same AdaptiveHostRate object is shared by all the threads requesting the host.
+    """
+
+    def __init__(self, initial_rate=4.0, min_rate=0.5, max_rate=50.0, additive_increase=1.0):
+        self.rate = float(initial_rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.additive_increase = float(additive_increase)
+        self.next_request_time = 0.0
+        self.paused_until = 0.0
+        self.last_decrease_time = 0.0
+        self.average_latency = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Waits until the next request to the host can be started."""
+        with self.lock:
+            now = time.monotonic()
+            start_time = max(now, self.next_request_time, self.paused_until)
+            self.next_request_time = start_time + 1.0 / self.rate
+        if start_time > now:
+            time.sleep(start_time - now)
+
+    def record_success(self, latency):
+        """Records a healthy response received in the given number of seconds (the time to its first byte)."""
+        with self.lock:
+            if self.average_latency is not None and \
+                    latency > max(self.average_latency * LATENCY_RISE_FACTOR, self.average_latency + LATENCY_RISE_MIN):
+                self.decrease(time.monotonic())
+            else:
+                # a request is sent every 1 / rate seconds, so the rate grows by additive_increase in about a second
+                self.rate = min(self.max_rate, self.rate + self.additive_increase / self.rate)
+            if self.average_latency is None:
+                self.average_latency = latency
+            else:
+                self.average_latency += (latency - self.average_latency) * LATENCY_SMOOTHING
+
+    def record_failure(self, retry_after=None):
+        """Records an error response or a network error. If the host has asked us to wait, the requests to it are
+        paused for the given number of seconds, at most MAX_RETRY_AFTER: a longer wait is not waited for, the request
+        asking for it fails (see FetchPolicy.get_retry_delay()), and the crawl goes on after MAX_RETRY_AFTER."""
+        with self.lock:
+            now = time.monotonic()
+            self.decrease(now)
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, now + min(retry_after, MAX_RETRY_AFTER))
+
+    def decrease(self, now):
+        """Decreases the rate, unless it has been decreased within the last round trip time.
+        To be called holding the lock."""
+        if now - self.last_decrease_time < max(self.average_latency or 0.0, 1.0 / self.rate):
+            return
+        self.rate = max(self.min_rate, self.rate * RATE_DECREASE_FACTOR)
+        self.last_decrease_time = now
+
+
+class FetchPolicy:
+    """FetchPolicy holds how the fetcher deals with slow and failing servers:
+    - the timeouts of connecting and of waiting for data; a server that does not answer in time is an error,
+    - the retries: a request failing with a network error or with a retryable status (429, 500, 502, 503, 504)
+      is sent again, at most max_retries times, after an exponential backoff with full jitter (a random wait of up
+      to backoff_base * 2 ** retry seconds, at most backoff_max), or after the time asked by the Retry-After header
+      of the response, if it is longer,
+    - the adaptive rate of the requests to each host (see AdaptiveHostRate), if adaptive_rate is on.
+    """
+
+    def __init__(self, connect_timeout=10, read_timeout=30, max_retries=4, backoff_base=0.5, backoff_max=30,
+                 adaptive_rate=True, initial_rate=4.0, min_rate=0.5, max_rate=50.0):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.adaptive_rate = adaptive_rate
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+
+    def create_host_rate(self):
+        """Returns a new AdaptiveHostRate for a host, or None if the adaptive rate is off."""
+        if not self.adaptive_rate:
+            return None
+        return AdaptiveHostRate(self.initial_rate, self.min_rate, self.max_rate)
+
+    def get_backoff(self, retry):
+        """Returns a random wait before the given retry (counted from 0): full jitter on the exponential backoff."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** retry))
+
+    def get_retry_delay(self, retry, exception):
+        """Returns the number of seconds to wait before retrying the request that has failed with the exception,
+        or None if it is not to be retried: the error is not transient, the retries have run out, or the server has
+        asked for a wait longer than MAX_RETRY_AFTER."""
+        if retry >= self.max_retries:
+            return None
+        if isinstance(exception, urllib.error.HTTPError):
+            if exception.code not in RETRY_STATUSES:
+                return None
+            retry_after = get_retry_after(exception.headers)
+            if retry_after is not None:
+                if retry_after > MAX_RETRY_AFTER:
+                    return None
+                return max(retry_after, self.get_backoff(retry))
+        elif not isinstance(exception, TRANSIENT_ERRORS):
+            return None
+        return self.get_backoff(retry)
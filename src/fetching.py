@@ -0,0 +1,502 @@
+import http.client
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import zlib
+
+from src.utils import load_config
+from src.http_cache import HTTPCache
+from src.fetch_policy import FetchPolicy, THROTTLE_STATUSES, get_retry_after
+from src.settings import FETCHER_CONFIG, MAX_REQUESTS_PER_HOST, STREAMING, CHUNK_SIZE, CACHE_ENABLED, CACHE_MAX_AGE, \
+                         CACHE_MAX_SIZE_MB, HTTP_CACHE_FILE, USER_AGENT, CONNECT_TIMEOUT, READ_TIMEOUT, \
+                         FETCH_MAX_RETRIES, BACKOFF_BASE, BACKOFF_MAX, ADAPTIVE_RATE, INITIAL_RATE, MIN_RATE, MAX_RATE
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+NOT_MODIFIED_STATUS = 304
+MAX_REDIRECTS = 10
+ACCEPT_ENCODING = 'gzip, deflate'
+CACHE_STATUSES = {'fresh_hits': 'fresh_hit', 'revalidated_hits': 'revalidated_hit', 'misses': 'miss'}
+
+
+class HostConnectionPool:
+    """HostConnectionPool keeps the persistent (keep-alive) connections opened to one host, so that the following
+    requests to the same host do not have to open a new TCP (and TLS) connection again.
+    It also limits how many requests can be in flight to the host at the same time, and, if it has an
+    AdaptiveHostRate, how many requests are started in a second.
+    Without timeouts, connecting and waiting for data is not limited in time.
+    """
+
+    def __init__(self, scheme, netloc, max_requests, connect_timeout=None, read_timeout=None, host_rate=None):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.host_rate = host_rate
+        self.request_semaphore = threading.BoundedSemaphore(max_requests)
+        self.idle_connections = []
+        self.lock = threading.Lock()
+
+    def create_connection(self):
+        """Creates a new connection to the host."""
+        timeout = self.connect_timeout if self.connect_timeout is not None else socket._GLOBAL_DEFAULT_TIMEOUT
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.netloc, timeout=timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=timeout)
+
+    def connect(self, connection):
+        """Connects a new connection to the host, then sets the timeout of waiting for data on it."""
+        connection.connect()
+        if self.read_timeout is not None:
+            connection.sock.settimeout(self.read_timeout)
+
+    def acquire_connection(self):
+        """Waits until a new request to the host is allowed, then returns an idle connection or a new one.
+        Returns a tuple of the connection and whether it has been reused or not."""
+        self.request_semaphore.acquire()
+        with self.lock:
+            if self.idle_connections:
+                return self.idle_connections.pop(), True
+        return self.create_connection(), False
+
+    def release_connection(self, connection, reusable):
+        """Gives the connection back to the pool if it can be reused, otherwise closes it.
+        Then it lets the next request to the host start."""
+        if reusable:
+            with self.lock:
+                self.idle_connections.append(connection)
+        else:
+            connection.close()
+        self.request_semaphore.release()
+
+    def close(self):
+        """Closes all the idle connections."""
+        with self.lock:
+            for connection in self.idle_connections:
+                connection.close()
+            self.idle_connections = []
+
+
+class ResponseStream:
+    """ResponseStream gives the body of a response chunk by chunk, as the chunks arrive.
+    It is to be used in a with statement. If the body has been read to the end, the connection goes back to the pool.
+    If the reading stops before the end, the connection is closed at once, so the rest of the body is not downloaded,
+    and the number of bytes left out is added to the bytes_skipped metric of the fetcher.
+    A gzip or deflate compressed body is decompressed on the fly; the metrics count the bytes as they were transferred.
+    If it is given the URLMetrics of the URL, the time spent waiting for the chunks and the bytes received are added
+    to them.
+    """
+
+    def __init__(self, fetcher, host_pool, connection, response, url_metrics=None):
+        self.fetcher = fetcher
+        self.host_pool = host_pool
+        self.connection = connection
+        self.response = response
+        self.url_metrics = url_metrics
+        self.bytes_received = 0
+        self.bytes_skipped = None  # stays None if the stream is read to the end or the length is unknown
+        self.closed = False
+        self.completed = False  # set when the stream is closed, if the body has been read to the end
+        self.decompressor = None
+        if response.headers.get('Content-Encoding', '').strip().lower() in ('gzip', 'deflate'):
+            self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)  # accepts both gzip and zlib headers
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        if self.url_metrics is None:
+            return self.read_chunks()
+        return self.read_chunks_measured()
+
+    def read_chunks_measured(self):
+        """Gives the chunks of read_chunks(), adding the time spent waiting for them to the download time of
+        the URL."""
+        chunks = self.read_chunks()
+        while True:
+            start = time.perf_counter()
+            chunk = next(chunks, None)
+            self.url_metrics.download_seconds += time.perf_counter() - start
+            if chunk is None:
+                return
+            yield chunk
+
+    def read_chunks(self):
+        """Gives the chunks of the body, decompressed, as they arrive."""
+        while True:
+            if self.response.length == 0:
+                self.response.read()  # marks the response as closed, so that the connection can be reused
+            chunk = self.response.read1(self.fetcher.chunk_size)
+            if not chunk:
+                if self.decompressor is not None:
+                    chunk = self.decompressor.flush()
+                    if chunk:
+                        yield chunk
+                return
+            self.bytes_received += len(chunk)
+            if self.decompressor is not None:
+                chunk = self.decompressor.decompress(chunk)
+                if not chunk:
+                    continue
+            yield chunk
+
+    def close(self):
+        """Gives the connection back to the pool if the body has been read to the end, otherwise closes it."""
+        if self.closed:
+            return
+        self.closed = True
+        if self.url_metrics is not None:
+            self.url_metrics.bytes_received += self.bytes_received
+        if self.response.length == 0 and not self.response.isclosed():
+            # the whole body has arrived, only the read marking the response closed was left, as the parser stopped
+            # at the last chunk: the connection can be reused
+            self.response.read()
+        if self.response.isclosed():
+            self.completed = True
+            self.fetcher.add_stream_metrics(self.bytes_received, 0, False)
+            self.host_pool.release_connection(self.connection, not self.response.will_close)
+            return
+        # response.length is the number of body bytes not read yet, if the server has sent the Content-Length
+        self.bytes_skipped = self.response.length
+        self.fetcher.add_stream_metrics(self.bytes_received, self.bytes_skipped or 0, True)
+        self.response.close()
+        self.host_pool.release_connection(self.connection, False)
+
+
+class CachingResponseStream(ResponseStream):
+    """CachingResponseStream is a ResponseStream that keeps a copy of the chunks as they are read, and stores the
+    page into the HTTP cache when it is closed, if the body has been read to the end. So a downloaded page is cached
+    without reading more of it than the caller does: a page whose download has been stopped early is not cached, as
+    its body is not complete."""
+
+    def __init__(self, fetcher, host_pool, connection, response, cache, url, url_metrics=None):
+        super(CachingResponseStream, self).__init__(fetcher, host_pool, connection, response, url_metrics)
+        self.cache = cache
+        self.url = url
+        self.chunks = []
+
+    def read_chunks(self):
+        """Gives the chunks of the body like ResponseStream.read_chunks(), and keeps a copy of them."""
+        for chunk in super(CachingResponseStream, self).read_chunks():
+            self.chunks.append(chunk)
+            yield chunk
+
+    def close(self):
+        """Closes the stream like ResponseStream.close(), then stores the page into the cache if its body has been
+        read to the end."""
+        if self.closed:
+            return
+        super(CachingResponseStream, self).close()
+        if self.completed:
+            if self.decompressor is not None:
+                # the end of a compressed body, if the reading stopped before read_chunks() has flushed it
+                self.chunks.append(self.decompressor.flush())
+            self.cache.store(self.url, b''.join(self.chunks), self.response.headers)
+        self.chunks = []
+
+
+class BodyStream:
+    """BodyStream gives a body that is already in memory (for example from the cache) chunk by chunk, the same way
+    as ResponseStream does."""
+
+    def __init__(self, body, chunk_size):
+        self.body = body
+        self.chunk_size = chunk_size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        for position in range(0, len(self.body), self.chunk_size):
+            yield self.body[position:position + self.chunk_size]
+
+    def close(self):
+        """There is nothing to release, it is here to be used like a ResponseStream."""
+        pass
+
+
+class HTTPFetcher:
+    """HTTPFetcher downloads web pages over persistent connections, one connection pool per host.
+    The same HTTPFetcher object can be shared by any number of threads.
+    With streaming on, the scrapers read the pages chunk by chunk by stream() and can stop downloading them when
+    they have found everything they need.
+    If the fetcher has an HTTPCache, the pages are served from the cache while they are fresh, and revalidated by
+    the server (ETag, Last-Modified) when they are not.
+    If the fetcher has a FetchPolicy, the requests have timeouts, the failed ones are retried with a backoff, and
+    the requests to each host follow its adaptive rate. Without one, a request is sent once and waited for as long as
+    it takes.
+    """
+
+    def __init__(self, max_requests_per_host=4, streaming=True, chunk_size=16384, cache=None, fetch_policy=None):
+        self.max_requests_per_host = max_requests_per_host
+        self.streaming = streaming
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.fetch_policy = fetch_policy
+        self.host_pools = {}
+        self.lock = threading.Lock()
+        self.stream_metrics = {'streams': 0, 'aborted_streams': 0, 'bytes_received': 0, 'bytes_skipped': 0}
+        self.cache_metrics = {'fresh_hits': 0, 'revalidated_hits': 0, 'misses': 0}
+        self.policy_metrics = {'retries': 0, 'failed_fetches': 0, 'throttled_responses': 0}
+
+    def add_stream_metrics(self, bytes_received, bytes_skipped, aborted):
+        """Adds the numbers of a finished ResponseStream to the stream metrics."""
+        with self.lock:
+            self.stream_metrics['streams'] += 1
+            self.stream_metrics['aborted_streams'] += int(aborted)
+            self.stream_metrics['bytes_received'] += bytes_received
+            self.stream_metrics['bytes_skipped'] += bytes_skipped
+
+    def get_stream_metrics(self):
+        """Returns a copy of the stream metrics: the number of streams, how many of them have been aborted before
+        the end of the body, and the number of bytes received and skipped.
+        The skipped bytes are known only if the server has sent the Content-Length of the page."""
+        with self.lock:
+            return dict(self.stream_metrics)
+
+    def add_cache_metric(self, name, url_metrics=None):
+        """Increases the given cache metric by 1. If the URLMetrics of the URL is given, the cache status of the URL
+        is set as well."""
+        if url_metrics is not None:
+            url_metrics.cache_status = CACHE_STATUSES[name]
+        with self.lock:
+            self.cache_metrics[name] += 1
+
+    def get_cache_metrics(self):
+        """Returns a copy of the cache metrics: the number of pages served from the cache without asking the server,
+        the ones that the server answered as not modified, and the ones that had to be downloaded."""
+        with self.lock:
+            return dict(self.cache_metrics)
+
+    def add_policy_metric(self, name):
+        """Increases the given fetch policy metric by 1."""
+        with self.lock:
+            self.policy_metrics[name] += 1
+
+    def get_policy_metrics(self):
+        """Returns a copy of the fetch policy metrics: the number of retried requests, the number of fetches that
+        have failed for good after a retry, and the number of responses telling us to slow down (429 or 503)."""
+        with self.lock:
+            return dict(self.policy_metrics)
+
+    def get_host_rates(self):
+        """Returns the current adaptive rate (requests per second) of each host, by host name."""
+        with self.lock:
+            return {host_pool.netloc: round(host_pool.host_rate.rate, 3) for host_pool in self.host_pools.values()
+                    if host_pool.host_rate is not None}
+
+    def get_host_pool(self, scheme, netloc):
+        """Returns the connection pool of the given host, creating it at the first request."""
+        with self.lock:
+            host_pool = self.host_pools.get((scheme, netloc))
+            if host_pool is None:
+                if self.fetch_policy is None:
+                    host_pool = HostConnectionPool(scheme, netloc, self.max_requests_per_host)
+                else:
+                    host_pool = HostConnectionPool(scheme, netloc, self.max_requests_per_host,
+                                                   self.fetch_policy.connect_timeout, self.fetch_policy.read_timeout,
+                                                   self.fetch_policy.create_host_rate())
+                self.host_pools[(scheme, netloc)] = host_pool
+            return host_pool
+
+    def record_response(self, host_pool, response, latency):
+        """Tells the adaptive rate of the host how the response has arrived: a response asking us to slow down (429,
+        503, with its Retry-After) or a server error decreases the rate, a healthy one increases it."""
+        if response.status in THROTTLE_STATUSES:
+            self.add_policy_metric('throttled_responses')
+        if host_pool.host_rate is None:
+            return
+        if response.status in THROTTLE_STATUSES:
+            host_pool.host_rate.record_failure(get_retry_after(response.headers))
+        elif response.status >= 500:
+            host_pool.host_rate.record_failure()
+        else:
+            host_pool.host_rate.record_success(latency)
+
+    def send_request(self, url, extra_headers=None, url_metrics=None):
+        """Sends a GET request to the URL and returns the host pool, the connection and the response, whose body
+        has not been read yet. The connection must be released to the host pool when the body has been read.
+        If a reused keep-alive connection turns out to be closed by the server, the request is sent once more
+        on a new connection.
+        If the host has an adaptive rate, the request waits for its turn, and the response is recorded into the rate.
+        If the URLMetrics of the URL is given, the time of connecting and the time to the first byte of the response
+        are added to it."""
+        split_url = urllib.parse.urlsplit(url)
+        path = urllib.parse.urlunsplit(('', '', split_url.path or '/', split_url.query, ''))
+        host_pool = self.get_host_pool(split_url.scheme, split_url.netloc)
+        headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': ACCEPT_ENCODING}
+        headers.update(extra_headers or {})
+        if host_pool.host_rate is not None:
+            host_pool.host_rate.acquire()
+        while True:
+            connection, reused = host_pool.acquire_connection()
+            try:
+                if url_metrics is None:
+                    if not reused:
+                        host_pool.connect(connection)
+                    start = time.perf_counter()
+                    connection.request('GET', path, headers=headers)
+                    response = connection.getresponse()
+                    latency = time.perf_counter() - start
+                else:
+                    response, latency = self.send_request_measured(host_pool, connection, reused, path, headers,
+                                                                   url_metrics)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                host_pool.release_connection(connection, False)
+                if reused:
+                    continue
+                if host_pool.host_rate is not None:
+                    host_pool.host_rate.record_failure()
+                raise
+            except Exception:
+                host_pool.release_connection(connection, False)
+                if host_pool.host_rate is not None:
+                    host_pool.host_rate.record_failure()
+                raise
+            self.record_response(host_pool, response, latency)
+            return host_pool, connection, response
+
+    def send_request_measured(self, host_pool, connection, reused, path, headers, url_metrics):
+        """Sends the request on the connection like send_request() does, and adds the time of connecting (of a new
+        connection) and the time to the first byte of the response to the URLMetrics.
+        Returns the response and the time to its first byte."""
+        start = time.perf_counter()
+        if not reused:
+            host_pool.connect(connection)
+            connected = time.perf_counter()
+            url_metrics.connect_seconds += connected - start
+            start = connected
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+        latency = time.perf_counter() - start
+        url_metrics.ttfb_seconds += latency
+        return response, latency
+
+    def open_response(self, url, extra_headers=None, url_metrics=None):
+        """Sends a GET request to the URL, following the redirects, and returns the host pool, the connection and
+        the response of the final URL, whose body has not been read yet.
+        The extra headers are sent only to the given URL, not to the ones it redirects to.
+        If the URLMetrics of the URL is given, the timings of all the requests are added to it.
+        Raises urllib.error.HTTPError for error responses, the same way as urllib.request.urlopen() does."""
+        for _ in range(MAX_REDIRECTS + 1):
+            host_pool, connection, response = self.send_request(url, extra_headers, url_metrics)
+            extra_headers = None
+            status, headers = response.status, response.headers
+            if status < 300 or (status < 400 and status not in REDIRECT_STATUSES) or \
+                    (status in REDIRECT_STATUSES and not headers.get('Location')):
+                return host_pool, connection, response
+            # the body of a redirect or an error response is read so that the connection can be reused
+            try:
+                response.read()
+            finally:
+                host_pool.release_connection(connection, response.isclosed() and not response.will_close)
+            if status >= 400:
+                raise urllib.error.HTTPError(url, status, http.client.responses.get(status, ''), headers, None)
+            url = urllib.parse.urljoin(url, headers.get('Location'))
+        raise urllib.error.HTTPError(url, status, 'Too many redirects', headers, None)
+
+    def call_with_retries(self, function, url, url_metrics=None):
+        """Calls the function with the URL (and the URLMetrics), and returns its result. If it fails, and the fetch
+        policy allows to retry it, it is called again after the wait given by the policy, until it succeeds or
+        the retries run out."""
+        if self.fetch_policy is None:
+            return function(url, url_metrics)
+        retry = 0
+        while True:
+            try:
+                return function(url, url_metrics)
+            except Exception as exception:
+                delay = self.fetch_policy.get_retry_delay(retry, exception)
+                if delay is None:
+                    if retry > 0:
+                        self.add_policy_metric('failed_fetches')
+                    raise
+            retry += 1
+            self.add_policy_metric('retries')
+            if url_metrics is not None:
+                url_metrics.retries += 1
+            time.sleep(delay)
+
+    def fetch(self, url, url_metrics=None):
+        """Returns the body of the web page located at the given URL, following the redirects.
+        If the URLMetrics of the URL is given, the download is measured into it.
+        If the download fails, it is retried as the fetch policy allows.
+        Raises urllib.error.HTTPError for error responses, the same way as urllib.request.urlopen() does."""
+        return self.call_with_retries(self.download, url, url_metrics)
+
+    def download(self, url, url_metrics=None):
+        """Downloads the body of the web page located at the given URL, without retrying."""
+        with self.open_stream(url, url_metrics) as response_stream:
+            return b''.join(response_stream)
+
+    def stream(self, url, url_metrics=None):
+        """Returns a ResponseStream of the web page located at the given URL, following the redirects.
+        If there is a cache, it returns a BodyStream of the cached page instead, or a CachingResponseStream of
+        a page that has to be downloaded, which caches the page only if the caller reads it to the end.
+        If the URLMetrics of the URL is given, the download is measured into it.
+        Getting the response is retried as the fetch policy allows; the body, read by the caller, is not.
+        Raises urllib.error.HTTPError for error responses, the same way as urllib.request.urlopen() does."""
+        return self.call_with_retries(self.open_stream, url, url_metrics)
+
+    def open_stream(self, url, url_metrics=None):
+        """Returns the ResponseStream or BodyStream of the web page, see stream(), without retrying."""
+        if self.cache is None:
+            return ResponseStream(self, *self.open_response(url, None, url_metrics), url_metrics)
+        cache_entry = self.cache.get(url)
+        if cache_entry is not None and cache_entry.is_fresh(self.cache.max_age):
+            self.add_cache_metric('fresh_hits', url_metrics)
+            return BodyStream(cache_entry.body, self.chunk_size)
+        validator_headers = cache_entry.get_validator_headers() if cache_entry is not None else None
+        host_pool, connection, response = self.open_response(url, validator_headers, url_metrics)
+        if response.status == NOT_MODIFIED_STATUS and cache_entry is not None:
+            with ResponseStream(self, host_pool, connection, response, url_metrics) as response_stream:
+                b''.join(response_stream)
+            self.add_cache_metric('revalidated_hits', url_metrics)
+            self.cache.refresh(cache_entry, response.headers)
+            return BodyStream(cache_entry.body, self.chunk_size)
+        self.add_cache_metric('misses', url_metrics)
+        return CachingResponseStream(self, host_pool, connection, response, self.cache, url, url_metrics)
+
+    def close(self):
+        """Closes all the idle connections of all the hosts."""
+        with self.lock:
+            for host_pool in self.host_pools.values():
+                host_pool.close()
+
+
+_default_fetcher = None
+_default_fetcher_lock = threading.Lock()
+
+
+def get_default_fetcher():
+    """Returns the HTTPFetcher shared by all the scrapers that have not been given their own fetcher.
+    It is set up from the fetcher config at the first call."""
+    global _default_fetcher
+    with _default_fetcher_lock:
+        if _default_fetcher is None:
+            fetcher_config = load_config(FETCHER_CONFIG) or {}
+            cache = None
+            if fetcher_config.get(CACHE_ENABLED):
+                cache = HTTPCache(HTTP_CACHE_FILE, max_age=fetcher_config.get(CACHE_MAX_AGE, 3600),
+                                  max_size=fetcher_config.get(CACHE_MAX_SIZE_MB, 200) * 1024 * 1024)
+            fetch_policy = FetchPolicy(connect_timeout=fetcher_config.get(CONNECT_TIMEOUT, 10),
+                                       read_timeout=fetcher_config.get(READ_TIMEOUT, 30),
+                                       max_retries=fetcher_config.get(FETCH_MAX_RETRIES, 4),
+                                       backoff_base=fetcher_config.get(BACKOFF_BASE, 0.5),
+                                       backoff_max=fetcher_config.get(BACKOFF_MAX, 30),
+                                       adaptive_rate=fetcher_config.get(ADAPTIVE_RATE, True),
+                                       initial_rate=fetcher_config.get(INITIAL_RATE, 4),
+                                       min_rate=fetcher_config.get(MIN_RATE, 0.5),
+                                       max_rate=fetcher_config.get(MAX_RATE, 50))
+            _default_fetcher = HTTPFetcher(max_requests_per_host=fetcher_config.get(MAX_REQUESTS_PER_HOST, 4),
+                                           streaming=fetcher_config.get(STREAMING, True),
+                                           chunk_size=fetcher_config.get(CHUNK_SIZE, 16384),
+                                           cache=cache, fetch_policy=fetch_policy)
+        return _default_fetcher
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class CacheEntry:
+    """CacheEntry is a cached response: the body of the page and the headers needed to revalidate it."""
+
+    __slots__ = ('url', 'body', 'etag', 'last_modified', 'stored_at')
+
+    def __init__(self, url, body, etag, last_modified, stored_at):
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at
+
+    def is_fresh(self, max_age):
+        """Returns True if the entry is younger than max_age seconds, so it can be used without asking the server."""
+        return time.time() - self.stored_at < max_age
+
+    def get_validator_headers(self):
+        """Returns the request headers to ask the server whether the cached page has changed or not."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class HTTPCache:
+    """HTTPCache is a persistent response cache stored in an SQLite file. The bodies are stored compressed, keyed by
+    the URL, together with their ETag and Last-Modified headers.
+    When the total size of the stored bodies exceeds max_size bytes, the least recently used entries are removed.
+    The same HTTPCache object can be shared by any number of threads.
+    """
+
+    def __init__(self, cache_file, max_age, max_size):
+        self.cache_file = cache_file
+        self.max_age = max_age
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.connection = sqlite3.connect(cache_file, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, body BLOB, etag TEXT, '
+                                'last_modified TEXT, stored_at REAL, last_used REAL, size INTEGER)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.connection.commit()
+
+    def get(self, url):
+        """Returns the CacheEntry of the URL, or None if the URL is not cached."""
+        with self.lock:
+            row = self.connection.execute('SELECT body, etag, last_modified, stored_at FROM responses WHERE url = ?',
+                                          (url,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE responses SET last_used = ? WHERE url = ?', (time.time(), url))
+            self.connection.commit()
+        return CacheEntry(url, zlib.decompress(row[0]), row[1], row[2], row[3])
+
+    def store(self, url, body, headers):
+        """Stores the body of the URL, compressed, with the validator headers of the response.
+        Then it removes the least recently used entries if the cache has become too big."""
+        compressed_body = zlib.compress(body)
+        now = time.time()
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    (url, compressed_body, headers.get('ETag'), headers.get('Last-Modified'),
+                                     now, now, len(compressed_body)))
+            self.evict()
+            self.connection.commit()
+
+    def refresh(self, entry, headers):
+        """Marks the cached entry as fresh again, after the server has answered that it has not changed (304).
+        The validators are updated if the server has sent new ones."""
+        entry.stored_at = time.time()
+        entry.etag = headers.get('ETag') or entry.etag
+        entry.last_modified = headers.get('Last-Modified') or entry.last_modified
+        with self.lock:
+            self.connection.execute('UPDATE responses SET etag = ?, last_modified = ?, stored_at = ?, last_used = ? '
+                                    'WHERE url = ?', (entry.etag, entry.last_modified, entry.stored_at,
+                                                      entry.stored_at, entry.url))
+            self.connection.commit()
+
+    def evict(self):
+        """Removes the least recently used entries until the total size of the cache is within max_size.
+        To be called holding the lock."""
+        total_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        removed_urls = []
+        for url, size in self.connection.execute('SELECT url, size FROM responses ORDER BY last_used'):
+            if total_size <= self.max_size:
+                break
+            removed_urls.append((url,))
+            total_size -= size
+        self.connection.executemany('DELETE FROM responses WHERE url = ?', removed_urls)
+
+    def close(self):
+        """Closes the cache file."""
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,222 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+
+METRIC_PREFIX = 'web_scraping'
+DURATION_STAGES = ('connect', 'ttfb', 'download', 'parse')
+
+
+class URLMetrics:
+    """URLMetrics holds the measurements of one scraped URL: how long it took to connect to the host, to get the first
+    byte of the response (TTFB), to download the body and to parse it, the number of bytes received, the number of tags
+    processed by the parser, the number of products (or URLs) found, and whether the parser stopped early at the end
+    of the container (ScrapingDoneException), and the number of times the download has been retried.
+    The durations are in seconds. Connecting takes 0 seconds if a keep-alive connection has been reused.
+    """
+
+    __slots__ = ('url', 'kind', 'connect_seconds', 'ttfb_seconds', 'download_seconds', 'parse_seconds',
+                 'bytes_received', 'tags_processed', 'products_emitted', 'urls_collected', 'early_exit', 'cache_status',
+                 'retries')
+
+    def __init__(self, url, kind):
+        self.url = url
+        self.kind = kind
+        self.connect_seconds = 0.0
+        self.ttfb_seconds = 0.0
+        self.download_seconds = 0.0
+        self.parse_seconds = 0.0
+        self.bytes_received = 0
+        self.tags_processed = 0
+        self.products_emitted = 0
+        self.urls_collected = 0
+        self.early_exit = False
+        self.cache_status = None  # fresh_hit, revalidated_hit or miss, if the fetcher has a cache
+        self.retries = 0
+
+    def add_parse_metrics(self, parse_metrics):
+        """Adds the parse measurements of another URLMetrics object of the same URL, for example the one measured in
+        a parser worker process."""
+        self.parse_seconds += parse_metrics.parse_seconds
+        self.tags_processed += parse_metrics.tags_processed
+        self.products_emitted += parse_metrics.products_emitted
+        self.urls_collected += parse_metrics.urls_collected
+        self.early_exit = self.early_exit or parse_metrics.early_exit
+
+    def to_dict(self):
+        """Returns the measurements as a dictionary."""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class CrawlInstrumentation:
+    """CrawlInstrumentation collects the URLMetrics of all the URLs scraped in a run, and exports them at the end of
+    the run as a JSON run report and as a Prometheus text format file (for the textfile collector of node_exporter).
+    If profile_parse is True, the parse stage is also profiled by cProfile (one profiler for each thread, they are
+    merged at the end), and the profile can be dumped into a file to be read by pstats or snakeviz.
+    The same CrawlInstrumentation object can be shared by any number of threads.
+    """
+
+    def __init__(self, profile_parse=False):
+        self.profile_parse = profile_parse
+        self.url_metrics = []
+        self.profiles = []
+        self.profile_stats = []
+        self.thread_local = threading.local()
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.start_time = time.perf_counter()
+
+    def create_url_metrics(self, url, kind):
+        """Returns a new URLMetrics object for the URL, which is going to be part of the run report."""
+        url_metrics = URLMetrics(url, kind)
+        with self.lock:
+            self.url_metrics.append(url_metrics)
+        return url_metrics
+
+    def get_parse_profiler(self):
+        """Returns the cProfile profiler of the current thread, or None if the parse stage is not profiled."""
+        if not self.profile_parse:
+            return None
+        profiler = getattr(self.thread_local, 'profiler', None)
+        if profiler is None:
+            profiler = self.thread_local.profiler = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profiler)
+        return profiler
+
+    def get_profile_stats(self):
+        """Returns the raw statistics of the parse profilers of this object, one dictionary for each thread, which
+        can be pickled and added to another CrawlInstrumentation object by add_profile_stats()."""
+        profile_stats = []
+        for profiler in self.profiles:
+            profiler.create_stats()
+            profile_stats.append(profiler.stats)
+        return profile_stats
+
+    def add_profile_stats(self, profile_stats):
+        """Adds the raw profile statistics given by get_profile_stats() of another CrawlInstrumentation object,
+        for example the one of a parser worker process."""
+        with self.lock:
+            self.profile_stats.extend(profile_stats)
+
+    def get_summary(self):
+        """Returns the totals of the measurements for each kind of scraper, with the median and the 95th percentile
+        of the durations."""
+        summary = {}
+        with self.lock:
+            url_metrics_list = list(self.url_metrics)
+        for kind in sorted({url_metrics.kind for url_metrics in url_metrics_list}):
+            kind_metrics = [url_metrics for url_metrics in url_metrics_list if url_metrics.kind == kind]
+            kind_summary = {'urls': len(kind_metrics),
+                            'bytes_received': sum(url_metrics.bytes_received for url_metrics in kind_metrics),
+                            'tags_processed': sum(url_metrics.tags_processed for url_metrics in kind_metrics),
+                            'products_emitted': sum(url_metrics.products_emitted for url_metrics in kind_metrics),
+                            'urls_collected': sum(url_metrics.urls_collected for url_metrics in kind_metrics),
+                            'early_exits': sum(url_metrics.early_exit for url_metrics in kind_metrics)}
+            for stage in DURATION_STAGES:
+                durations = sorted(getattr(url_metrics, stage + '_seconds') for url_metrics in kind_metrics)
+                kind_summary[stage + '_seconds'] = {'total': round(sum(durations), 6),
+                                                    'p50': round(durations[len(durations) // 2], 6),
+                                                    'p95': round(durations[int(len(durations) * 0.95)], 6)}
+            summary[kind] = kind_summary
+        return summary
+
+    def write_run_report(self, report_file, run_info=None):
+        """Writes the JSON run report: the information of the run given by the runner (number of rows, stream and
+        cache metrics, ...), the summary of the measurements, and the measurements of every URL."""
+        with self.lock:
+            url_metrics_list = list(self.url_metrics)
+        report = {'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(self.started_at)),
+                  'duration_seconds': round(time.perf_counter() - self.start_time, 6)}
+        report.update(run_info or {})
+        report['summary'] = self.get_summary()
+        report['urls'] = [url_metrics.to_dict() for url_metrics in url_metrics_list]
+        write_file_atomically(report_file, json.dumps(report, indent=2))
+
+    def write_prometheus_file(self, prometheus_file, run_info=None):
+        """Writes the totals of the measurements in the Prometheus text format. The numeric values of run_info are
+        written as gauges."""
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(METRIC_PREFIX, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(METRIC_PREFIX, name, metric_type))
+            for labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(key, label_value) for key, label_value in labels)
+                lines.append('{}_{}{} {}'.format(METRIC_PREFIX, name, '{' + label_text + '}' if label_text else '',
+                                                 value))
+
+        summary = self.get_summary()
+        add_metric('urls_total', 'counter', 'Number of URLs scraped.',
+                   [((('kind', kind),), kind_summary['urls']) for kind, kind_summary in summary.items()])
+        add_metric('stage_seconds_total', 'counter', 'Time spent in each stage of scraping the URLs.',
+                   [((('kind', kind), ('stage', stage)), kind_summary[stage + '_seconds']['total'])
+                    for kind, kind_summary in summary.items() for stage in DURATION_STAGES])
+        for name, help_text in (('bytes_received', 'Number of bytes received.'),
+                                ('tags_processed', 'Number of start tags processed by the parser.'),
+                                ('products_emitted', 'Number of products found.'),
+                                ('urls_collected', 'Number of URLs collected.'),
+                                ('early_exits', 'Number of pages whose parsing stopped at the end of the container.')):
+            add_metric(name + '_total', 'counter', help_text,
+                       [((('kind', kind),), kind_summary[name]) for kind, kind_summary in summary.items()])
+        add_metric('run_duration_seconds', 'gauge', 'Duration of the run.',
+                   [((), round(time.perf_counter() - self.start_time, 6))])
+        for name, value in (run_info or {}).items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                add_metric('run_' + name, 'gauge', 'Run information: {}.'.format(name), [((), value)])
+            elif isinstance(value, dict):
+                numbers = [(key, number) for key, number in value.items() if isinstance(number, (int, float))]
+                add_metric('run_' + name, 'gauge', 'Run information: {}.'.format(name),
+                           [((('name', key),), number) for key, number in numbers])
+        write_file_atomically(prometheus_file, '\n'.join(lines) + '\n')
+
+    def write_parse_profile(self, profile_file):
+        """Dumps the merged profile of the parse stage, to be read by pstats. Returns False if there is no profile."""
+        all_stats = [stats for stats in self.get_profile_stats() + self.profile_stats if stats]
+        if not all_stats:
+            return False
+        merged_stats = pstats.Stats(ProfileStats(all_stats[0]))
+        for stats in all_stats[1:]:
+            merged_stats.add(ProfileStats(stats))
+        merged_stats.dump_stats(profile_file)
+        return True
+
+
+class ProfileStats:
+    """ProfileStats wraps raw profile statistics, so that pstats.Stats can load them like a profiler."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        """The statistics are already created, it is here to be loaded like a profiler."""
+        pass
+
+
+def write_file_atomically(file_path, text):
+    """Writes the text into a temporary file and then renames it, so that the readers (for example the Prometheus
+    textfile collector) never see a half-written file."""
+    file_dir = os.path.dirname(file_path)
+    if file_dir:
+        os.makedirs(file_dir, exist_ok=True)
+    temp_file_path = file_path + '.tmp'
+    with open(temp_file_path, 'w', encoding='utf-8') as temp_file:
+        temp_file.write(text)
+    os.replace(temp_file_path, file_path)
+
+
+_instrumentation = None
+
+
+def set_instrumentation(instrumentation):
+    """Sets the CrawlInstrumentation that the scrapers record their measurements into, or None to turn
+    the instrumentation off."""
+    global _instrumentation
+    _instrumentation = instrumentation
+
+
+def get_instrumentation():
+    """Returns the CrawlInstrumentation of the current run, or None if the instrumentation is off."""
+    return _instrumentation
@@ -0,0 +1,288 @@
+import base64
+import glob
+import os
+import pandas as pd
+
+from src.settings import RESULT_FILE, RESULT_JSONL_FILE, RESULT_PARQUET_DIR, DELTA_RESULT_FILE, \
+                         DELTA_RESULT_JSONL_FILE, DELTA_RESULT_PARQUET_DIR, FRONTIER_RESULT_DIR, MAIN_CATEG_COL
+
+
+class OutputSink:
+    """OutputSink is the base class of the outputs that the scraped products are written into.
+    The products arrive in batches (DataFrames), as the sub-categories are finished. They are buffered until there are
+    at least max_buffered_rows of them, then they are written out together, so the memory needed does not depend on
+    the size of the catalogue.
+    The checkpoint of a sink describes what has been written out so far; opening the sink with a checkpoint continues
+    the output from there and drops anything written after it.
+    If the sink has a transform function, it is applied to the buffered products in one go before they are written
+    out, so a vectorized transform works on many products at once.
+    If writing out (or transforming) the buffered products fails, the sink is failed: those products are lost, so
+    nothing written after the last checkpoint is to be trusted.
+    The sub-classes implement how the output is started, continued and written.
+    """
+
+    def __init__(self, max_buffered_rows=5000, transform=None):
+        self.max_buffered_rows = max_buffered_rows
+        self.transform = transform
+        self.buffer = []
+        self.buffered_rows = 0
+        self.failed = False
+
+    def open(self, checkpoint=None):
+        """Starts a new output, or continues it from the checkpoint. To be implemented in sub-classes."""
+        raise NotImplementedError
+
+    def write_batch(self, product_df):
+        """Writes out a DataFrame of products. To be implemented in sub-classes."""
+        raise NotImplementedError
+
+    def get_checkpoint(self):
+        """Returns the checkpoint of what has been written out so far. To be implemented in sub-classes."""
+        raise NotImplementedError
+
+    def close_output(self):
+        """Closes the output. To be implemented in sub-classes."""
+        pass
+
+    def write(self, product_df):
+        """Adds a batch of products to the buffer, and writes the buffer out if it is full.
+        Returns True if all the products received so far have been written out, so the checkpoint covers them."""
+        if not product_df.empty:
+            self.buffer.append(product_df)
+            self.buffered_rows += len(product_df)
+        if self.buffered_rows >= self.max_buffered_rows:
+            self.flush()
+        return not self.buffer
+
+    def flush(self):
+        """Writes out the buffered products."""
+        if self.buffer:
+            product_df = self.buffer[0] if len(self.buffer) == 1 else pd.concat(self.buffer)
+            self.buffer = []
+            self.buffered_rows = 0
+            try:
+                if self.transform is not None:
+                    product_df = self.transform(product_df)
+                self.write_batch(product_df)
+            except Exception:
+                self.failed = True
+                raise
+
+    def close(self):
+        """Writes out the buffered products and closes the output."""
+        self.flush()
+        self.close_output()
+
+
+class FileSink(OutputSink):
+    """FileSink is the base class of the sinks that write all the products into one text file.
+    The checkpoint is the size of the file."""
+
+    def __init__(self, result_file, max_buffered_rows=5000, transform=None):
+        super(FileSink, self).__init__(max_buffered_rows, transform)
+        self.result_file = result_file
+        self.file = None
+
+    def open(self, checkpoint=None):
+        """Opens the result file. Without a checkpoint, a new file is started. With a checkpoint, the file is cut
+        back to the size it had at the checkpoint, so anything written after the last saved batch is dropped."""
+        if checkpoint is None:
+            self.file = open(self.result_file, 'w', encoding='utf-8', newline='')
+            return
+        self.file = open(self.result_file, 'r+', encoding='utf-8', newline='')
+        self.file.truncate(checkpoint['size'])
+        self.file.seek(checkpoint['size'])
+
+    def write_batch(self, product_df):
+        """Appends the products to the file and forces them to the disk."""
+        self.write_to_file(product_df)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def write_to_file(self, product_df):
+        """Writes the products into the open file. To be implemented in sub-classes."""
+        raise NotImplementedError
+
+    def get_checkpoint(self):
+        """Returns the checkpoint of the file: its size."""
+        return {'size': self.file.tell()}
+
+    def close_output(self):
+        """Closes the result file."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class CSVSink(FileSink):
+    """CSVSink writes the products into a CSV file. The columns of the first batch are the columns of the file,
+    and the following batches are written in the same column order. A later batch with a column that the file does
+    not have cannot be written, as the header line cannot be changed any more."""
+
+    def __init__(self, result_file, max_buffered_rows=5000, transform=None):
+        super(CSVSink, self).__init__(result_file, max_buffered_rows, transform)
+        self.columns = None
+
+    def open(self, checkpoint=None):
+        """Opens the CSV file, see FileSink.open(). The columns of the file are restored from the checkpoint."""
+        self.columns = checkpoint['columns'] if checkpoint is not None else None
+        super(CSVSink, self).open(checkpoint)
+
+    def write_to_file(self, product_df):
+        """Appends the products to the CSV file, with the header line if this is the first batch."""
+        if self.columns is None:
+            self.columns = [str(column) for column in product_df.columns]
+            product_df.to_csv(self.file)
+        else:
+            check_columns(product_df, self.columns)
+            product_df.reindex(columns=self.columns).to_csv(self.file, header=False)
+
+    def get_checkpoint(self):
+        """Returns the checkpoint of the CSV file: its size and its columns."""
+        checkpoint = super(CSVSink, self).get_checkpoint()
+        checkpoint['columns'] = self.columns
+        return checkpoint
+
+
+class JSONLinesSink(FileSink):
+    """JSONLinesSink writes the products into a JSON Lines file, one JSON object for each product."""
+
+    def __init__(self, result_file, max_buffered_rows=5000, transform=None):
+        super(JSONLinesSink, self).__init__(result_file, max_buffered_rows, transform)
+
+    def write_to_file(self, product_df):
+        """Appends the products to the JSON Lines file.
+        The float32 columns are written by the shortest decimal text of their values (5.8 and not 5.8000001907),
+        as the CSV files have them."""
+        float32_columns = [column for column, dtype in product_df.dtypes.items() if dtype == 'float32']
+        if float32_columns:
+            product_df = product_df.copy(deep=False)
+            for column in float32_columns:
+                product_df[column] = product_df[column].to_numpy().astype(str).astype('float64')
+        json_lines = product_df.to_json(orient='records', lines=True, force_ascii=False)
+        if not json_lines.endswith('\n'):  # older pandas versions do not end the last line
+            json_lines += '\n'
+        self.file.write(json_lines)
+
+
+class ParquetSink(OutputSink):
+    """ParquetSink writes the products into Parquet files partitioned by the main category, in the directory layout
+    that pandas and pyarrow read as a partitioned dataset (main_categ=<name>/part-<number>.parquet).
+    Every flush writes one new part file into each main category it has products of, so the readers of the dataset
+    can skip the main categories they do not need.
+    All the part files have the schema taken from the first batch (see create_schema()), so the dataset can be read
+    as a whole even if a later batch has a column with no value at all.
+    The checkpoint is the number of the next part file and the schema. Writing Parquet files requires the pyarrow
+    package.
+    """
+
+    def __init__(self, result_dir, max_buffered_rows=5000, transform=None):
+        super(ParquetSink, self).__init__(max_buffered_rows, transform)
+        self.result_dir = result_dir
+        self.part_number = 0
+        self.schema = None
+
+    def get_part_files(self):
+        """Returns the list of (part number, file path) of all the part files in the result directory."""
+        part_files = []
+        for part_file in glob.glob(os.path.join(self.result_dir, MAIN_CATEG_COL + '=*', 'part-*.parquet')):
+            part_files.append((int(os.path.basename(part_file)[len('part-'):-len('.parquet')]), part_file))
+        return part_files
+
+    def open(self, checkpoint=None):
+        """Prepares the result directory. Without a checkpoint all the previous part files are removed, with
+        a checkpoint only the ones written after it. The schema of the part files is restored from the checkpoint."""
+        self.part_number = checkpoint['part_number'] if checkpoint is not None else 0
+        self.schema = None
+        if checkpoint is not None and checkpoint.get('schema') is not None:
+            import pyarrow
+            self.schema = pyarrow.ipc.read_schema(pyarrow.py_buffer(base64.b64decode(checkpoint['schema'])))
+        os.makedirs(self.result_dir, exist_ok=True)
+        for part_number, part_file in self.get_part_files():
+            if part_number >= self.part_number:
+                os.remove(part_file)
+
+    def create_schema(self, product_df):
+        """Returns the schema of the part files, as pyarrow infers it from the first batch of products, without the
+        main category. A column with no value in the batch would be inferred as a null column, which cannot hold
+        the values of the later batches, so it becomes a string column; and the categoricals get 32-bit indices, so
+        a later batch with more categories fits in as well."""
+        import pyarrow
+        fields = []
+        for field in pyarrow.Schema.from_pandas(product_df.drop(columns=MAIN_CATEG_COL), preserve_index=False):
+            if pyarrow.types.is_dictionary(field.type):
+                value_type = pyarrow.string() if pyarrow.types.is_null(field.type.value_type) \
+                    else field.type.value_type
+                field = field.with_type(pyarrow.dictionary(pyarrow.int32(), value_type))
+            elif pyarrow.types.is_null(field.type):
+                field = field.with_type(pyarrow.string())
+            fields.append(field)
+        return pyarrow.schema(fields)
+
+    def write_batch(self, product_df):
+        """Writes the products into a new part file of each of their main categories, with the schema of the
+        dataset."""
+        if self.schema is None:
+            self.schema = self.create_schema(product_df)
+        check_columns(product_df, [MAIN_CATEG_COL] + self.schema.names)
+        for main_categ, main_categ_df in product_df.groupby(MAIN_CATEG_COL, observed=True, sort=False):
+            partition_dir = os.path.join(self.result_dir, '{}={}'.format(MAIN_CATEG_COL, main_categ))
+            os.makedirs(partition_dir, exist_ok=True)
+            part_file = os.path.join(partition_dir, 'part-{:06d}.parquet'.format(self.part_number))
+            # the main category is stored in the name of the directory, so it is not repeated in the file
+            main_categ_df.drop(columns=MAIN_CATEG_COL).to_parquet(part_file, index=False, schema=self.schema)
+        self.part_number += 1
+
+    def get_checkpoint(self):
+        """Returns the checkpoint of the dataset: the number of the next part file, and the schema of the part files
+        (serialized by pyarrow, in base64), or None before the first batch."""
+        schema = None
+        if self.schema is not None:
+            schema = base64.b64encode(self.schema.serialize().to_pybytes()).decode('ascii')
+        return {'part_number': self.part_number, 'schema': schema}
+
+
+def check_columns(product_df, columns):
+    """Raises a ValueError if the products have a column that is not among the columns of the output, as it could
+    only be dropped."""
+    unknown_columns = [str(column) for column in product_df.columns if str(column) not in columns]
+    if unknown_columns:
+        raise ValueError('The products have columns that the output does not have: {}'.format(
+            ', '.join(unknown_columns)))
+
+
+def get_result_path(sink_name, delta=False):
+    """Returns the result file (or directory) that the output sink of the given name writes into."""
+    if sink_name == 'csv':
+        return DELTA_RESULT_FILE if delta else RESULT_FILE
+    if sink_name == 'jsonl':
+        return DELTA_RESULT_JSONL_FILE if delta else RESULT_JSONL_FILE
+    if sink_name == 'parquet':
+        return DELTA_RESULT_PARQUET_DIR if delta else RESULT_PARQUET_DIR
+    raise ValueError('Unknown output sink: {}. It should be one of: csv, jsonl, parquet'.format(sink_name))
+
+
+def get_worker_result_path(sink_name, worker_id):
+    """Returns the result file (or directory) that the output sink of the given name writes into in a frontier
+    worker. Every worker has its own one in the frontier result directory; the Parquet directories of the workers are
+    named as partitions (worker=<id>), so the whole result directory is read as one partitioned dataset."""
+    if sink_name == 'csv':
+        return os.path.join(FRONTIER_RESULT_DIR, worker_id + '.csv')
+    if sink_name == 'jsonl':
+        return os.path.join(FRONTIER_RESULT_DIR, worker_id + '.jsonl')
+    if sink_name == 'parquet':
+        return os.path.join(FRONTIER_RESULT_DIR, 'worker=' + worker_id)
+    raise ValueError('Unknown output sink: {}. It should be one of: csv, jsonl, parquet'.format(sink_name))
+
+
+def create_output_sink(sink_name, max_buffered_rows=5000, delta=False, transform=None, result_path=None):
+    """Returns a new output sink of the given name: csv, jsonl or parquet, with the given transform function.
+    If delta is True, the sink writes into the delta result files, which hold only the changes of a delta crawl.
+    A result path can be given instead of the one of the sink in the settings."""
+    if result_path is None:
+        result_path = get_result_path(sink_name, delta)
+    if sink_name == 'csv':
+        return CSVSink(result_path, max_buffered_rows, transform)
+    if sink_name == 'jsonl':
+        return JSONLinesSink(result_path, max_buffered_rows, transform)
+    return ParquetSink(result_path, max_buffered_rows, transform)
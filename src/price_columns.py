@@ -0,0 +1,85 @@
+import pandas as pd
+
+from src.settings import MAIN_CATEG_COL, SUB_CATEG_COL, PRICE_COL, UNIT_PRICE_COL, PREVIOUS_PRICE_COL, \
+                         PREVIOUS_UNIT_PRICE_COL, CURRENCY_COL, UNIT_COL, CHANGE_COL
+
+# the currency in front of the amount, the amount with a decimal comma and maybe spaces or dots between the thousands
+# (for example 'kr 1 234,50' or 'kr 5,-'), and the unit of a unit price ('per kg', 'per 100 g', 'per stk')
+# the price may follow some text ('Tilbud kr 9,90'), then the currency is the word right before the amount
+# the no-break space is put into the patterns as a character, as the regular expressions of pyarrow do not know \u,
+# and \s of pyarrow matches only the ASCII spaces
+THOUSANDS_SEPARATORS = ' \u00a0.'
+SPACES = '\\s\u00a0'
+PRICE_PATTERN = r'^(?:.*?[{0}])??[{0}]*([^\d{0},.-]+)?[{0}]*(-?\d(?:[{1}]?\d)*(?:,\d*)?).*$'.format(
+    SPACES, THOUSANDS_SEPARATORS)
+# a dot followed by exactly two digits at the end of the amount is a decimal point ('kr 12.50'), not a thousands
+# separator
+DECIMAL_DOT_PATTERN = r'\.(\d\d)$'
+UNIT_PATTERN = r'^.*per[{0}]+(\d+(?:,\d+)?)?[{0}]*([a-zA-Z]+)[{0}]*$'.format(SPACES)
+CURRENCY_CODES = {'kr': 'NOK', 'kr.': 'NOK', 'nok': 'NOK', '€': 'EUR', 'eur': 'EUR', '$': 'USD', 'usd': 'USD'}
+# unit -> (normalized unit, how many of the unit make one normalized unit)
+UNIT_CONVERSIONS = {'kg': ('kg', 1), 'g': ('kg', 1000), 'hg': ('kg', 10),
+                    'l': ('l', 1), 'liter': ('l', 1), 'dl': ('l', 10), 'cl': ('l', 100), 'ml': ('l', 1000),
+                    'stk': ('stk', 1), 'stykk': ('stk', 1), 'pk': ('stk', 1)}
+CATEGORICAL_COLUMNS = (MAIN_CATEG_COL, SUB_CATEG_COL, CURRENCY_COL, UNIT_COL, CHANGE_COL)
+
+
+def extract_groups(texts, pattern):
+    """Returns the two groups of the pattern in each text, or NA where the pattern does not match.
+    It is done by vectorized matching and replacing instead of str.extract(), which goes through the texts one by one
+    in Python even if they are stored by pyarrow."""
+    matches = texts.str.match(pattern).fillna(False).astype(bool)
+    return [texts.str.replace(pattern, '\\{}'.format(group), regex=True).where(matches) for group in (1, 2)]
+
+
+def parse_amounts(price_texts):
+    """Returns the amounts of the price texts as float32, and their currencies. The texts are parsed in bulk by
+    the vectorized string methods of pandas; a text that is not a price becomes NaN."""
+    currencies, amounts = extract_groups(price_texts.astype('string'), PRICE_PATTERN)
+    amounts = amounts.str.replace(DECIMAL_DOT_PATTERN, ',\\1', regex=True)
+    amounts = amounts.str.replace('[{}]'.format(THOUSANDS_SEPARATORS), '', regex=True)
+    amounts = amounts.str.replace(',', '.', regex=False)
+    amounts = pd.to_numeric(amounts, errors='coerce').astype('float32')
+    currencies = currencies.str.lower()
+    currencies = currencies.map(CURRENCY_CODES).fillna(currencies.str.upper()).replace('', pd.NA)
+    return amounts, currencies
+
+
+def parse_unit_prices(unit_price_texts):
+    """Returns the unit prices of the unit price texts as float32, converted to the normalized unit (kg, l or stk),
+    and their normalized units. For example 'kr 2,50 per 100 g' becomes 25.0 per kg."""
+    unit_price_texts = unit_price_texts.astype('string')
+    amounts = parse_amounts(unit_price_texts)[0]
+    quantities, units = extract_groups(unit_price_texts, UNIT_PATTERN)
+    units = units.str.lower()
+    quantities = pd.to_numeric(quantities.str.replace(',', '.', regex=False), errors='coerce').fillna(1)
+    normalized_units = units.map({unit: conversion[0] for unit, conversion in UNIT_CONVERSIONS.items()})
+    factors = units.map({unit: conversion[1] for unit, conversion in UNIT_CONVERSIONS.items()})
+    # a unit that cannot be normalized is kept as it is, with the price of one unit
+    normalized_units = normalized_units.fillna(units)
+    factors = pd.to_numeric(factors, errors='coerce').fillna(1).astype('float64') / quantities.astype('float64')
+    return (amounts * factors).astype('float32'), normalized_units
+
+
+def add_typed_price_columns(product_df):
+    """Converts the price texts of the products into typed, compact columns, in bulk:
+    - price and unit_price (and previous_price, previous_unit_price of a delta crawl) become float32 numbers,
+    - currency is the currency code of the price (NOK for 'kr'),
+    - unit is the normalized unit of the unit price (kg, l or stk), the unit price is converted to it,
+    - the category, currency, unit and change columns become categoricals.
+    Returns the new DataFrame; the columns that the products do not have are left out."""
+    product_df = product_df.copy(deep=False)
+    if PRICE_COL in product_df:
+        product_df[PRICE_COL], currencies = parse_amounts(product_df[PRICE_COL])
+        product_df.insert(product_df.columns.get_loc(PRICE_COL) + 1, CURRENCY_COL, currencies)
+    if UNIT_PRICE_COL in product_df:
+        product_df[UNIT_PRICE_COL], units = parse_unit_prices(product_df[UNIT_PRICE_COL])
+        product_df.insert(product_df.columns.get_loc(UNIT_PRICE_COL) + 1, UNIT_COL, units)
+    if PREVIOUS_PRICE_COL in product_df:
+        product_df[PREVIOUS_PRICE_COL] = parse_amounts(product_df[PREVIOUS_PRICE_COL])[0]
+    if PREVIOUS_UNIT_PRICE_COL in product_df:
+        product_df[PREVIOUS_UNIT_PRICE_COL] = parse_unit_prices(product_df[PREVIOUS_UNIT_PRICE_COL])[0]
+    for categ_col in CATEGORICAL_COLUMNS:
+        if categ_col in product_df and not isinstance(product_df[categ_col].dtype, pd.CategoricalDtype):
+            product_df[categ_col] = product_df[categ_col].astype('category')
+    return product_df
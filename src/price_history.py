@@ -0,0 +1,271 @@
+import base64
+import datetime
+import glob
+import hashlib
+import json
+import os
+import pandas as pd
+
+from src.data_management import ReportCreater, SUM_STATS, MIN_STATS, MAX_STATS
+from src.price_columns import add_typed_price_columns
+from src.settings import PRICE_HISTORY_DIR, PRICE_HISTORY_MANIFEST, REPORT_CHUNK_SIZE, MAIN_CATEG_COL, SUB_CATEG_COL, \
+                         PRODUCT_NAME_COL, EXTRA_INFO_COL, PRICE_COL, UNIT_PRICE_COL, CURRENCY_COL, UNIT_COL, \
+                         RUN_DATE_COL, RUN_ID_COL
+
+# the columns of a history file; the run date and the main category are in the names of the partition directories,
+# and the run ID in the manifest, so they are not repeated in the files
+HISTORY_COLUMNS = (SUB_CATEG_COL, PRODUCT_NAME_COL, EXTRA_INFO_COL, PRICE_COL, CURRENCY_COL, UNIT_PRICE_COL, UNIT_COL)
+HISTORY_PRICE_COLUMNS = (PRICE_COL, UNIT_PRICE_COL)
+RUN_DATE_FORMAT = '%Y-%m-%d'
+RUN_ID_FORMAT = '%Y%m%dT%H%M%S'
+# the product name filters are sized for about 1% of false positives
+FILTER_BITS_PER_NAME = 10
+FILTER_HASH_COUNT = 7
+
+
+class ProductNameFilter:
+    """ProductNameFilter is a Bloom filter of the product names of a history file: it tells for sure that a product
+    is not in the file, or that it may be in it. It takes about 10 bits per product, so it is kept in the manifest of
+    the partition, and a product history query opens only the files that may have the product.
+    """
+
+    def __init__(self, bit_count, hash_count=FILTER_HASH_COUNT, bits=None):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.bits = bits if bits is not None else bytearray((bit_count + 7) // 8)
+
+    @classmethod
+    def from_names(cls, names):
+        """Returns a new filter of the given product names."""
+        names = set(names)
+        name_filter = cls(max(64, len(names) * FILTER_BITS_PER_NAME))
+        for name in names:
+            for position in name_filter.get_positions(name):
+                name_filter.bits[position // 8] |= 1 << (position % 8)
+        return name_filter
+
+    @classmethod
+    def from_dict(cls, filter_dict):
+        """Returns the filter saved by to_dict()."""
+        return cls(filter_dict['bit_count'], filter_dict['hash_count'],
+                   bytearray(base64.b64decode(filter_dict['bits'])))
+
+    def to_dict(self):
+        """Returns the filter as a dictionary that can be saved as JSON."""
+        return {'bit_count': self.bit_count, 'hash_count': self.hash_count,
+                'bits': base64.b64encode(bytes(self.bits)).decode('ascii')}
+
+    def get_positions(self, name):
+        """Returns the bit positions of a name (double hashing of one 128 bit hash)."""
+        digest = hashlib.blake2b(str(name).encode('utf-8'), digest_size=16).digest()
+        first_hash, second_hash = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return [(first_hash + i * second_hash) % self.bit_count for i in range(self.hash_count)]
+
+    def may_contain(self, name):
+        """Returns False if the name is surely not in the filter, True if it may be."""
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self.get_positions(name))
+
+
+class PriceHistoryStore:
+    """PriceHistoryStore keeps the products of every finished run, so the prices can be followed from run to run
+    without keeping and reading again the whole result files of the runs.
+    The products of a run are appended as Parquet files partitioned by the date of the run and the main category,
+    in the directory layout that pandas and pyarrow read as a partitioned dataset:
+    run_date=<date>/main_categ=<name>/run-<run ID>.parquet. The prices are stored typed (float32, with their currency
+    and unit, see add_typed_price_columns()), whatever the output of the run was.
+    Every partition has a manifest (_manifest.json) listing its files, one for each run of that day. A file is
+    described by its run ID, number of rows, a filter of its product names (see ProductNameFilter) and the price
+    statistics of its sub-categories. The manifest is replaced only when the file is written completely, and the
+    queries read only the files listed in the manifests, so a run interrupted while being appended is not seen.
+    - A product history query reads only the partitions of the dates (and main category) asked for, only the files
+      that may have the product, and only the columns asked for.
+    - The category statistics of the last days are computed from the manifests alone, no history file is read.
+    Writing and reading the files requires the pyarrow package.
+    """
+
+    def __init__(self, history_dir=PRICE_HISTORY_DIR):
+        self.history_dir = history_dir
+
+    def get_partition_dir(self, run_date, main_categ):
+        """Returns the directory of the partition of a run date and a main category."""
+        return os.path.join(self.history_dir, '{}={}'.format(RUN_DATE_COL, run_date),
+                            '{}={}'.format(MAIN_CATEG_COL, main_categ))
+
+    def load_manifest(self, partition_dir):
+        """Returns the manifest of a partition, or None if the partition has none."""
+        manifest_file = os.path.join(partition_dir, PRICE_HISTORY_MANIFEST)
+        if not os.path.exists(manifest_file):
+            return None
+        with open(manifest_file, encoding='utf-8') as manifest_json_file:
+            return json.load(manifest_json_file)
+
+    def save_manifest(self, partition_dir, manifest):
+        """Saves the manifest of a partition: it is written into a temporary file first, which replaces the old
+        manifest in one step, so the readers see either the old or the new manifest."""
+        manifest_file = os.path.join(partition_dir, PRICE_HISTORY_MANIFEST)
+        with open(manifest_file + '.tmp', 'w', encoding='utf-8') as manifest_tmp_file:
+            json.dump(manifest, manifest_tmp_file)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    @classmethod
+    def prepare_chunk(cls, chunk):
+        """Returns a chunk of the result with the columns of the history files: the prices typed, the texts as
+        strings, and the columns that the result does not have as empty ones."""
+        if PRICE_COL in chunk and not pd.api.types.is_numeric_dtype(chunk[PRICE_COL]):
+            chunk = add_typed_price_columns(chunk)  # the price texts of an untyped result
+        history_df = pd.DataFrame(index=chunk.index)
+        for column in HISTORY_COLUMNS:
+            if column in HISTORY_PRICE_COLUMNS:
+                history_df[column] = chunk[column].astype('float32') if column in chunk else float('nan')
+            else:
+                history_df[column] = chunk[column].astype('string') if column in chunk else pd.NA
+        return history_df.astype({column: 'string' for column in HISTORY_COLUMNS
+                                  if column not in HISTORY_PRICE_COLUMNS})
+
+    @classmethod
+    def get_schema(cls):
+        """Returns the pyarrow schema of the history files."""
+        import pyarrow
+        return pyarrow.schema([(column, pyarrow.float32() if column in HISTORY_PRICE_COLUMNS else pyarrow.string())
+                               for column in HISTORY_COLUMNS])
+
+    def append_run(self, result_path, run_time=None, chunk_size=REPORT_CHUNK_SIZE):
+        """Appends the products of the result file (CSV, JSON Lines or a Parquet directory, see
+        ReportCreater.read_result_chunks()) of a finished run to the history, with the given run time (datetime,
+        now by default). The result is read chunk by chunk, and every main category is written into its own
+        partition as the chunks arrive. Appending the same run again replaces it.
+        Returns the run ID."""
+        import pyarrow
+        import pyarrow.parquet
+        run_time = run_time if run_time is not None else datetime.datetime.now()
+        run_date, run_id = run_time.strftime(RUN_DATE_FORMAT), run_time.strftime(RUN_ID_FORMAT)
+        schema = self.get_schema()
+        file_name = 'run-{}.parquet'.format(run_id)
+        # main category -> [ParquetWriter, row count, product names, statistics of the chunks]
+        partitions = {}
+        try:
+            for chunk in ReportCreater.read_result_chunks(result_path, chunk_size,
+                                                          (MAIN_CATEG_COL,) + HISTORY_COLUMNS):
+                history_df = self.prepare_chunk(chunk)
+                chunk_stats = ReportCreater.aggregate_chunk(pd.concat([chunk[MAIN_CATEG_COL], history_df], axis=1))
+                for main_categ, main_categ_df in history_df.groupby(chunk[MAIN_CATEG_COL].astype('string'),
+                                                                    sort=False):
+                    partition = partitions.get(main_categ)
+                    if partition is None:
+                        partition_dir = self.get_partition_dir(run_date, main_categ)
+                        os.makedirs(partition_dir, exist_ok=True)
+                        partition = partitions[main_categ] = \
+                            [pyarrow.parquet.ParquetWriter(os.path.join(partition_dir, file_name), schema), 0, set(), []]
+                    partition[0].write_table(pyarrow.Table.from_pandas(main_categ_df, schema=schema,
+                                                                       preserve_index=False))
+                    partition[1] += len(main_categ_df)
+                    partition[2].update(main_categ_df[PRODUCT_NAME_COL].dropna())
+                    partition[3].append(chunk_stats.xs(main_categ, level=MAIN_CATEG_COL, drop_level=False))
+        finally:
+            for partition in partitions.values():
+                partition[0].close()
+        for main_categ, (_, row_count, names, stats) in partitions.items():
+            partition_dir = self.get_partition_dir(run_date, main_categ)
+            sub_categ_stats = ReportCreater.combine_stats(pd.concat(stats), SUB_CATEG_COL)
+            manifest = self.load_manifest(partition_dir) or {RUN_DATE_COL: run_date, MAIN_CATEG_COL: main_categ,
+                                                             'files': []}
+            manifest['files'] = [file_entry for file_entry in manifest['files'] if file_entry[RUN_ID_COL] != run_id]
+            manifest['files'].append({'file': file_name, RUN_ID_COL: run_id, 'rows': row_count,
+                                      'product_filter': ProductNameFilter.from_names(names).to_dict(),
+                                      'sub_categ_stats': json.loads(sub_categ_stats.reset_index()
+                                                                    .to_json(orient='records'))})
+            manifest['files'].sort(key=lambda file_entry: file_entry[RUN_ID_COL])
+            self.save_manifest(partition_dir, manifest)
+        return run_id
+
+    def get_partitions(self, start_date=None, end_date=None, main_categ=None):
+        """Returns the manifests of the partitions between the start and end dates (inclusive, 'YYYY-MM-DD' strings
+        or dates), of the given main category or of all of them. Only the names of the directories are looked at to
+        choose the partitions, and only the manifests of the chosen ones are read."""
+        start_date, end_date = format_run_date(start_date), format_run_date(end_date)
+        manifests = []
+        for date_dir in sorted(glob.glob(os.path.join(self.history_dir, RUN_DATE_COL + '=*'))):
+            run_date = os.path.basename(date_dir)[len(RUN_DATE_COL) + 1:]
+            if (start_date is not None and run_date < start_date) or (end_date is not None and run_date > end_date):
+                continue
+            if main_categ is not None:
+                partition_dirs = [os.path.join(date_dir, '{}={}'.format(MAIN_CATEG_COL, main_categ))]
+            else:
+                partition_dirs = sorted(glob.glob(os.path.join(date_dir, MAIN_CATEG_COL + '=*')))
+            for partition_dir in partition_dirs:
+                manifest = self.load_manifest(partition_dir)
+                if manifest is not None:
+                    manifest['dir'] = partition_dir
+                    manifests.append(manifest)
+        return manifests
+
+    def get_product_history(self, product_name, start_date=None, end_date=None, main_categ=None,
+                            columns=(SUB_CATEG_COL, EXTRA_INFO_COL, PRICE_COL, CURRENCY_COL, UNIT_PRICE_COL, UNIT_COL)):
+        """Returns the prices of the product of the given name in every run between the start and end dates, as
+        a DataFrame with the run ID, the run date, the main category, the product name and the given columns,
+        ordered by the run. Only the files that may have the product are read (see ProductNameFilter), only the given
+        columns, and only the rows of the product (see get_partitions() for how the partitions are chosen)."""
+        import pyarrow.parquet
+        read_columns = [PRODUCT_NAME_COL] + [column for column in columns if column != PRODUCT_NAME_COL]
+        run_dfs = []
+        for manifest in self.get_partitions(start_date, end_date, main_categ):
+            for file_entry in manifest['files']:
+                if not ProductNameFilter.from_dict(file_entry['product_filter']).may_contain(product_name):
+                    continue
+                run_df = pyarrow.parquet.read_table(os.path.join(manifest['dir'], file_entry['file']),
+                                                    columns=read_columns,
+                                                    filters=[(PRODUCT_NAME_COL, '==', product_name)]).to_pandas()
+                if run_df.empty:
+                    continue  # a false positive of the filter
+                run_df.insert(0, MAIN_CATEG_COL, manifest[MAIN_CATEG_COL])
+                run_df.insert(0, RUN_DATE_COL, manifest[RUN_DATE_COL])
+                run_df.insert(0, RUN_ID_COL, file_entry[RUN_ID_COL])
+                run_dfs.append(run_df)
+        if not run_dfs:
+            return pd.DataFrame(columns=[RUN_ID_COL, RUN_DATE_COL, MAIN_CATEG_COL] + read_columns)
+        return pd.concat(run_dfs, ignore_index=True).sort_values([RUN_ID_COL, MAIN_CATEG_COL], ignore_index=True,
+                                                                 kind='stable')
+
+    def get_category_stats(self, days=30, end_date=None, level=MAIN_CATEG_COL):
+        """Returns the statistics of the categories (main categories, or sub-categories if the level is
+        SUB_CATEG_COL) in every run of the last given number of days, up to the end date (today by default): the
+        number of products, and the mean, standard deviation, minimum and maximum of the prices (see
+        ReportCreater.finish_stats()), indexed by the run ID, the run date and the category.
+        They are computed from the statistics kept in the manifests, so no history file is read."""
+        end_date = datetime.datetime.strptime(format_run_date(end_date), RUN_DATE_FORMAT).date() \
+            if end_date is not None else datetime.date.today()
+        start_date = end_date - datetime.timedelta(days=days - 1)
+        stats_rows = []
+        for manifest in self.get_partitions(start_date, end_date):
+            for file_entry in manifest['files']:
+                for sub_categ_stats in file_entry['sub_categ_stats']:
+                    stats_row = {RUN_ID_COL: file_entry[RUN_ID_COL], RUN_DATE_COL: manifest[RUN_DATE_COL],
+                                 MAIN_CATEG_COL: manifest[MAIN_CATEG_COL]}
+                    stats_row.update(sub_categ_stats)
+                    stats_rows.append(stats_row)
+        index_columns = [RUN_ID_COL, RUN_DATE_COL, MAIN_CATEG_COL]
+        if level == SUB_CATEG_COL:
+            index_columns.append(SUB_CATEG_COL)
+        stats = pd.DataFrame(stats_rows, columns=index_columns[:3] + [SUB_CATEG_COL] +
+                             list(SUM_STATS + MIN_STATS + MAX_STATS))
+        stats = stats.astype({stat: 'float64' for stat in SUM_STATS[1:] + MIN_STATS + MAX_STATS})
+        stats = ReportCreater.combine_stats(stats.set_index(index_columns), index_columns)
+        return ReportCreater.finish_stats(stats).sort_index()
+
+
+def format_run_date(run_date):
+    """Returns a run date given as a date (or datetime) as a 'YYYY-MM-DD' string. A string or None is returned as
+    it is."""
+    if isinstance(run_date, (datetime.date, datetime.datetime)):
+        return run_date.strftime(RUN_DATE_FORMAT)
+    return run_date
+
+
+def check_pyarrow_installed():
+    """Raises an ImportError telling what to do if the pyarrow package, which writes and reads the price history, is
+    not installed. It is called before the crawl, so that a long crawl does not fail only when it has finished."""
+    try:
+        import pyarrow  # only imported to see that it is there
+    except ImportError:
+        raise ImportError('The price history (output / price_history in the config) needs the pyarrow package: '
+                          'install it by "pip install -r requirements.txt", or turn the price history off') from None
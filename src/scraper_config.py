@@ -0,0 +1,269 @@
+import html
+import re
+import threading
+from types import MappingProxyType
+
+from src.utils import load_whole_config
+from src.settings import CONTAINER_TAG_NAME, CONTAINER_TAG_ATTR_NAME, CONTAINER_TAG_ATTR_VALUE, \
+                         TAG_NAME_TO_SEARCH, TAG_ATTR_TO_SEARCH, TAG_ATTR_VALUE_PATTERN, \
+                         TAG_FILTER_ATTR_NAME, TAG_FILTER_ATTR_VALUE, HAS_SUB_CONTAINER, SUB_CONTAINER_TAG_NAME, \
+                         SUB_CONTAINER_TAG_ATTR_NAME, SUB_CONTAINER_TAG_ATTR_VALUE, \
+                         PRODUCT_INFORMATION_CONFIG, \
+                         PRODUCT_INFORMATION_TAG_NAME, PRODUCT_INFORMATION_ATTR_NAME, PRODUCT_INFORMATION_ATTR_VALUE, \
+                         NEXT_PAGE_TAG_NAME, NEXT_PAGE_ATTR_NAME, NEXT_PAGE_ATTR_VALUE, MAX_PAGES, PRE_SLICE_CONTAINER
+
+# the rest of a start tag after its name, up to the closing '>' (which may be in a quoted attribute value)
+START_TAG_REST_PATTERN = re.compile(r'''(?:[^>"']|"[^"]*"|'[^']*')*>''')
+ATTR_PATTERN = re.compile(r'''([^\s/>"'=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>]*))?''')
+# comments, script and style elements, with the beginning of one that has not been closed (yet) in group 4
+SCRIPT_STYLE_PATTERN = re.compile(r'<!--.*?-->|(<(script|style)\b[^>]*>).*?(</\2\s*>)|(<!--|<(?:script|style)\b)',
+                                  re.DOTALL | re.IGNORECASE)
+NEXT_PAGE_LINK_ATTR = 'href'
+
+CONTAINER_FOUND = 'found'
+CONTAINER_NOT_FOUND = 'not_found'
+CONTAINER_AMBIGUOUS = 'ambiguous'
+
+
+def has_attr_value(attrs, attr_name, attr_value):
+    """Returns True if the tag attributes contain the given attribute with the given (stripped) value."""
+    for attr in attrs:
+        if attr[0] == attr_name and attr[1] is not None and attr[1].strip() == attr_value:
+            return True
+    return False
+
+
+def compile_tag_token_pattern(*tag_names):
+    """Returns the regular expression finding the starting and ending tags of the given names in an HTML source.
+    Comments and script / style elements are matched as a whole, so the tags in them are not found, the same way as
+    HTMLParser does not see them as tags. Group 1 is set for a script or style, group 2 is '/' for an ending tag and
+    '' for a starting tag, group 3 is the name of the tag, and group 4 is set for the beginning of a comment, script
+    or style that is not closed in the source (yet)."""
+    return re.compile(r'<!--.*?-->|<(script|style)\b[^>]*>.*?</\1\s*>|<(/?)({})(?=[\s/>])|(<!--|<(?:script|style)\b)'
+                      .format('|'.join(re.escape(tag_name) for tag_name in tag_names)), re.DOTALL | re.IGNORECASE)
+
+
+def strip_script_bodies(html_source):
+    """Returns the HTML source with the bodies of its script and style elements left out (the elements themselves are
+    kept, empty, so the parser sees the same tags), and the length of the source that has been stripped: up to
+    the first script, style or comment that is not closed in the source (yet), or the whole source.
+    The parser passes the body of a script or style to handle_data() like any text, so it would be taken as
+    the data of a product field that has no text before it. Only the bodies following some text are left out:
+    the field of the text before has taken its data already. A script or style inside a tag (in an attribute
+    value) is not an element, it is kept as it is."""
+    parts = []
+    position = 0
+    for token in SCRIPT_STYLE_PATTERN.finditer(html_source):
+        if token.group(4) is not None:
+            parts.append(html_source[position:token.start()])
+            return ''.join(parts), token.start()
+        if token.group(1) is not None and html_source[token.start() - 1] != '>' and \
+                html_source.rfind('<', 0, token.start()) < html_source.rfind('>', 0, token.start()):
+            parts.append(html_source[position:token.start()])
+            parts.append(token.group(1))
+            parts.append(token.group(3))
+            position = token.end()
+    parts.append(html_source[position:])
+    return ''.join(parts), len(html_source)
+
+
+def parse_attrs(attr_text):
+    """Returns the attributes of a starting tag as a list of (name, value) pairs, like HTMLParser gives them."""
+    attrs = []
+    for name, value in ATTR_PATTERN.findall(attr_text):
+        if value[:1] in ('"', "'"):
+            value = value[1:-1]
+        attrs.append((name.lower(), html.unescape(value) if value else None))
+    return attrs
+
+
+class ScraperConfigMatcher:
+    """ScraperConfigMatcher is the compiled, read-only version of a web scraping config.
+    Everything that the scrapers need to decide about a tag is computed here once, so that handling a starting tag
+    does not have to look up the config again and again. The product information setup is turned into a dictionary
+    from the tag name to the (attribute name, attribute value) pairs that identify a product field, so finding
+    the product field of a tag is a dictionary lookup instead of going through the whole setup.
+    The same object is shared by all the scrapers using the same config.
+    """
+
+    __slots__ = ('container_tag_name', 'container_tag_attr_name', 'container_tag_attr_value', 'has_sub_container',
+                 'sub_container_tag_name', 'sub_container_tag_attr_name', 'sub_container_tag_attr_value',
+                 'tag_name_to_search', 'tag_attr_to_search', 'tag_attr_value_pattern',
+                 'tag_filter_attr_name', 'tag_filter_attr_value', 'product_fields', 'product_info_rules',
+                 'container_token_pattern', 'next_page_tag_name', 'next_page_attr_name', 'next_page_attr_value',
+                 'max_pages', 'next_page_token_pattern', 'pre_slice_container', 'container_scan_pattern',
+                 'container_scan_values')
+
+    def __init__(self, config):
+        set_attr = super(ScraperConfigMatcher, self).__setattr__
+        set_attr('container_tag_name', config.get(CONTAINER_TAG_NAME))
+        set_attr('container_tag_attr_name', config.get(CONTAINER_TAG_ATTR_NAME))
+        set_attr('container_tag_attr_value', config.get(CONTAINER_TAG_ATTR_VALUE))
+        set_attr('has_sub_container', bool(config.get(HAS_SUB_CONTAINER)))
+        set_attr('sub_container_tag_name', config.get(SUB_CONTAINER_TAG_NAME))
+        set_attr('sub_container_tag_attr_name', config.get(SUB_CONTAINER_TAG_ATTR_NAME))
+        set_attr('sub_container_tag_attr_value', config.get(SUB_CONTAINER_TAG_ATTR_VALUE))
+        set_attr('tag_name_to_search', config.get(TAG_NAME_TO_SEARCH))
+        set_attr('tag_attr_to_search', config.get(TAG_ATTR_TO_SEARCH))
+        set_attr('tag_attr_value_pattern', config.get(TAG_ATTR_VALUE_PATTERN))
+        set_attr('tag_filter_attr_name', config.get(TAG_FILTER_ATTR_NAME))
+        set_attr('tag_filter_attr_value', config.get(TAG_FILTER_ATTR_VALUE))
+        product_information = config.get(PRODUCT_INFORMATION_CONFIG) or {}
+        set_attr('product_fields', tuple(product_information))
+        # tag name -> {(attribute name, attribute value): (position of the field in the config, field name)}
+        # the position is kept because if more fields match the same tag, the last one in the config wins
+        product_info_rules = {}
+        for position, (product_info, setup) in enumerate(product_information.items()):
+            tag_rules = product_info_rules.setdefault(setup.get(PRODUCT_INFORMATION_TAG_NAME), {})
+            tag_rules[(setup.get(PRODUCT_INFORMATION_ATTR_NAME), setup.get(PRODUCT_INFORMATION_ATTR_VALUE))] = \
+                (position, product_info)
+        set_attr('product_info_rules', MappingProxyType({tag: MappingProxyType(tag_rules)
+                                                         for tag, tag_rules in product_info_rules.items()}))
+        set_attr('container_token_pattern',
+                 compile_tag_token_pattern(self.container_tag_name) if self.container_tag_name else None)
+        # the next page links are followed only if there are more pages to scrape than the first one
+        set_attr('next_page_tag_name', config.get(NEXT_PAGE_TAG_NAME))
+        set_attr('next_page_attr_name', config.get(NEXT_PAGE_ATTR_NAME))
+        set_attr('next_page_attr_value', config.get(NEXT_PAGE_ATTR_VALUE))
+        set_attr('max_pages', max(1, int(config.get(MAX_PAGES) or 1)))
+        set_attr('next_page_token_pattern', compile_tag_token_pattern(self.next_page_tag_name)
+                 if self.next_page_tag_name and self.max_pages > 1 else None)
+        # the parsing starts at the container instead of the beginning of the page (see scan_container_start())
+        set_attr('pre_slice_container', bool(config.get(PRE_SLICE_CONTAINER)) and self.container_tag_name is not None)
+        set_attr('container_scan_pattern', compile_tag_token_pattern(self.container_tag_name, self.sub_container_tag_name)
+                 if self.pre_slice_container and self.has_sub_container and self.sub_container_tag_name
+                 else self.container_token_pattern)
+        # a tag of the scan has one of these attribute values in its source if it is the (sub-)container
+        set_attr('container_scan_values', tuple(str(value) for value in (
+            self.container_tag_attr_value, self.sub_container_tag_attr_value if self.has_sub_container else None)
+            if value is not None))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ScraperConfigMatcher is read-only')
+
+    def is_container_tag(self, attrs):
+        """Returns True if the attributes of a container named tag identify the container."""
+        return has_attr_value(attrs, self.container_tag_attr_name, self.container_tag_attr_value)
+
+    def is_sub_container_tag(self, attrs):
+        """Returns True if the attributes of a sub-container named tag identify a sub-container."""
+        return has_attr_value(attrs, self.sub_container_tag_attr_name, self.sub_container_tag_attr_value)
+
+    def find_container_region(self, html_source):
+        """Finds the container element in the HTML source without parsing the whole page: only the tags with
+        the name of the container tag are looked at. Returns the (start, end) positions of the container element,
+        from its starting tag to the end of its ending tag, or None if the container is not found or not closed."""
+        if self.container_token_pattern is None:
+            return None
+        start = None
+        depth = 0
+        for token in self.container_token_pattern.finditer(html_source):
+            if token.group(2) is None:
+                continue  # a comment, a script or a style
+            tag_rest = START_TAG_REST_PATTERN.match(html_source, token.end())
+            if tag_rest is None:
+                return None
+            if token.group(2):
+                if start is not None:
+                    if depth == 0:
+                        return start, tag_rest.end()
+                    depth -= 1
+                continue
+            if tag_rest.group().endswith('/>'):
+                continue  # a self-closing tag is opened and closed at once
+            if start is not None:
+                depth += 1
+            elif self.is_container_tag(parse_attrs(tag_rest.group()[:-1])):
+                start = token.start()
+        return None
+
+    def scan_container_start(self, html_source, position=0):
+        """Looks for the starting tag of the container in the HTML source from the given position, without parsing
+        the source: only the tags with the name of the container (or sub-container) tag are looked at. Returns a pair:
+        - CONTAINER_FOUND and the position of the starting tag, if it has been found,
+        - CONTAINER_AMBIGUOUS and the position of the tag, if the part of the source before the container may matter
+          or the parser may not see the tag as we do: the container tag is inside another tag or is self-closing,
+          or a sub-container comes before the container (its data is collected as well). The whole source is to be
+          parsed then,
+        - CONTAINER_NOT_FOUND and the position that the scan is to be continued from, when more of the source has
+          arrived: the beginning of a tag, comment, script or style that is not complete in the source yet."""
+        for token in self.container_scan_pattern.finditer(html_source, position):
+            if token.group(4) is not None:
+                return CONTAINER_NOT_FOUND, token.start()  # it may hide a tag we look for when it is complete
+            if token.group(2) != '':
+                position = token.end()  # a comment, a script, a style or an ending tag
+                continue
+            tag_rest = START_TAG_REST_PATTERN.match(html_source, token.end())
+            if tag_rest is None:
+                return CONTAINER_NOT_FOUND, token.start()
+            tag_rest_source = tag_rest.group()
+            if '&' not in tag_rest_source and \
+                    not any(value in tag_rest_source for value in self.container_scan_values):
+                position = tag_rest.end()  # the attribute values cannot match without character references
+                continue
+            tag_name = token.group(3).lower()
+            attrs = parse_attrs(tag_rest_source[:-1])
+            if tag_name == self.container_tag_name and self.is_container_tag(attrs):
+                if tag_rest_source.endswith('/>') or \
+                        html_source.rfind('<', 0, token.start()) > html_source.rfind('>', 0, token.start()):
+                    return CONTAINER_AMBIGUOUS, token.start()
+                return CONTAINER_FOUND, token.start()
+            if self.has_sub_container and tag_name == self.sub_container_tag_name and self.is_sub_container_tag(attrs):
+                return CONTAINER_AMBIGUOUS, token.start()
+            position = tag_rest.end()
+        # a tag name may have been cut at the end of the source
+        return CONTAINER_NOT_FOUND, max(position, html_source.rfind('<', position))
+
+    def follows_next_page(self):
+        """Returns True if the next page links are to be followed, so a listing has more pages to be scraped."""
+        return self.next_page_token_pattern is not None
+
+    def find_next_page_href(self, html_source):
+        """Finds the next page link in the HTML source, looking only at the tags with the name of the next page tag.
+        Returns the URL of the first one whose attribute matches the config, as it is in the page, or None."""
+        if self.next_page_token_pattern is None:
+            return None
+        for token in self.next_page_token_pattern.finditer(html_source):
+            if token.group(2) != '':
+                continue  # a comment, a script, a style or an ending tag
+            tag_rest = START_TAG_REST_PATTERN.match(html_source, token.end())
+            if tag_rest is None:
+                return None
+            attrs = parse_attrs(tag_rest.group()[:-1])
+            if has_attr_value(attrs, self.next_page_attr_name, self.next_page_attr_value):
+                for attr in attrs:
+                    if attr[0] == NEXT_PAGE_LINK_ATTR and attr[1]:
+                        return attr[1]
+        return None
+
+    def get_product_field(self, tag, attrs):
+        """Returns the name of the product field that the tag contains, or None if it is not a product field tag."""
+        tag_rules = self.product_info_rules.get(tag)
+        if tag_rules is None:
+            return None
+        found_rule = None
+        for attr in attrs:
+            if attr[1] is None:
+                continue
+            rule = tag_rules.get((attr[0], attr[1].strip()))
+            if rule is not None and (found_rule is None or rule[0] > found_rule[0]):
+                found_rule = rule
+        return found_rule[1] if found_rule is not None else None
+
+
+_matcher_cache = {}
+_matcher_cache_lock = threading.Lock()
+
+
+def get_config_matcher(config_param):
+    """Returns the compiled ScraperConfigMatcher of the given web scraping config, or None if the config is empty.
+    The matcher is compiled once and shared, until the config file is reloaded because it has changed."""
+    whole_config = load_whole_config()
+    with _matcher_cache_lock:
+        cached = _matcher_cache.get(config_param)
+        if cached is not None and cached[0] is whole_config:
+            return cached[1]
+        config = whole_config[config_param]
+        matcher = ScraperConfigMatcher(config) if config is not None else None
+        _matcher_cache[config_param] = (whole_config, matcher)
+        return matcher
@@ -15,6 +15,7 @@ HAS_SUB_CONTAINER = 'has_sub_container'
 SUB_CONTAINER_TAG_NAME = 'sub_container_tag_name'
 SUB_CONTAINER_TAG_ATTR_NAME = 'sub_container_tag_attr_name'
 SUB_CONTAINER_TAG_ATTR_VALUE = 'sub_container_tag_attr_value'
+PRE_SLICE_CONTAINER = 'pre_slice_container'
 
 # config name constants for web_scraping, specifically for product scraping
 PRODUCT_SCRAPING_CONFIG = 'product_scraping'
@@ -22,6 +23,10 @@ PRODUCT_INFORMATION_CONFIG = 'product_information'
 PRODUCT_INFORMATION_TAG_NAME = 'tag_name'
 PRODUCT_INFORMATION_ATTR_NAME = 'attr_name'
 PRODUCT_INFORMATION_ATTR_VALUE = 'attr_value'
+NEXT_PAGE_TAG_NAME = 'next_page_tag_name'
+NEXT_PAGE_ATTR_NAME = 'next_page_attr_name'
+NEXT_PAGE_ATTR_VALUE = 'next_page_attr_value'
+MAX_PAGES = 'max_pages'
 
 # constants for controller
 MAIN_URL_COLLECTION_NEEDED = 'main_url_collection_needed'
@@ -30,11 +35,85 @@ MAIN_URLS_TO_SCRAP_CONFIG = 'main_urls_to_scrap'
 PRODUCT_SUB_URL_COLL_NEEDED = 'product_sub_url_coll_needed'
 SUB_SOURCE_URL_BEGINNING = 'sub_source_url_beginning'
 PRODUCT_SUB_URLS_TO_SCRAP_CONFIG = 'product_sub_urls_to_scrap'
+CONCURRENT_CRAWL = 'concurrent_crawl'
+CRAWL_WORKER_COUNT = 'crawl_worker_count'
+PARSER_WORKER_COUNT = 'parser_worker_count'
+MAX_QUEUED_PAGES = 'max_queued_pages'
+OUTPUT_CONFIG = 'output'
+OUTPUT_SINK = 'sink'
+MAX_BUFFERED_ROWS = 'max_buffered_rows'
+DELTA_CRAWL = 'delta_crawl'
+TYPED_PRICES = 'typed_prices'
+PRICE_HISTORY = 'price_history'
+
+# config name constants for the URL frontier
+FRONTIER_CONFIG = 'frontier'
+LEASE_TIMEOUT = 'lease_timeout'
+MAX_RETRIES = 'max_retries'
+POLL_INTERVAL = 'poll_interval'
+
+# config name constants for fetching
+FETCHER_CONFIG = 'fetcher'
+MAX_REQUESTS_PER_HOST = 'max_requests_per_host'
+STREAMING = 'streaming'
+CHUNK_SIZE = 'chunk_size'
+CACHE_ENABLED = 'cache_enabled'
+CACHE_MAX_AGE = 'cache_max_age'
+CACHE_MAX_SIZE_MB = 'cache_max_size_mb'
+CONNECT_TIMEOUT = 'connect_timeout'
+READ_TIMEOUT = 'read_timeout'
+FETCH_MAX_RETRIES = 'max_retries'
+BACKOFF_BASE = 'backoff_base'
+BACKOFF_MAX = 'backoff_max'
+ADAPTIVE_RATE = 'adaptive_rate'
+INITIAL_RATE = 'initial_rate'
+MIN_RATE = 'min_rate'
+MAX_RATE = 'max_rate'
+
+# config name constants for instrumentation
+INSTRUMENTATION_CONFIG = 'instrumentation'
+INSTRUMENTATION_ENABLED = 'enabled'
+PROFILE_PARSE = 'profile_parse'
+
+# constants for fetching
+USER_AGENT = 'KolonialWebScraping'
+HTTP_CACHE_FILE = '../files/http_cache.sqlite'
 
 # constants for data management
 RESULT_FILE = '../files/result.csv'
+RESULT_JSONL_FILE = '../files/result.jsonl'
+RESULT_PARQUET_DIR = '../files/result_parquet'
+CRAWL_JOURNAL_FILE = '../files/crawl_journal.jsonl'
+RUN_REPORT_FILE = '../files/run_report.json'
+PROMETHEUS_FILE = '../files/web_scraping.prom'
+PARSE_PROFILE_FILE = '../files/parse_profile.pstats'
+DELTA_STATE_FILE = '../files/delta_state.sqlite'
+DELTA_RESULT_FILE = '../files/result_delta.csv'
+DELTA_RESULT_JSONL_FILE = '../files/result_delta.jsonl'
+DELTA_RESULT_PARQUET_DIR = '../files/result_delta_parquet'
+FRONTIER_STATE_FILE = '../files/frontier.sqlite'
+FRONTIER_RESULT_DIR = '../files/result_frontier'
+PRICE_HISTORY_DIR = '../files/price_history'
+PRICE_HISTORY_MANIFEST = '_manifest.json'
 MAIN_CATEG_COL = 'main_categ'
 SUB_CATEG_COL = 'sub_categ'
+PRODUCT_NAME_COL = 'product_name'
+EXTRA_INFO_COL = 'extra_info'
+PRICE_COL = 'price'
+UNIT_PRICE_COL = 'unit_price'
+CHANGE_COL = 'change'
+PREVIOUS_PRICE_COL = 'previous_price'
+PREVIOUS_UNIT_PRICE_COL = 'previous_unit_price'
+CURRENCY_COL = 'currency'
+UNIT_COL = 'unit'
+RUN_DATE_COL = 'run_date'
+RUN_ID_COL = 'run_id'
 
 REPORT_FILE_MAIN = '../files/main_categ_dist_report.png'
 REPORT_FILE_SUB = '../files/sub_categ_dist_report.png'
+# the report aggregates are read from the result file in chunks of this many rows, and cached in a file next to it
+REPORT_CHUNK_SIZE = 50000
+REPORT_CACHE_SUFFIX = '.report.json'
+
+# constants for benchmarks
+BENCHMARK_RESULT_FILE = '../files/benchmark_result.json'
@@ -0,0 +1,56 @@
+import threading
+import urllib.parse
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def canonicalize_url(url, base_url):
+    """Returns the canonical form of a URL found on the page at base_url, so that the same page reached by different
+    links has the same URL: it is made absolute (urljoin), the scheme and the host are lowercased, the default port
+    is left out, the fragment is dropped, and the query parameters are sorted.
+    A URL that stays relative (as base_url is relative too) is canonicalized the same way, without a scheme and
+    a host. Returns None for a URL that is not a web page (mailto:, javascript:, ...)."""
+    split_url = urllib.parse.urlsplit(urllib.parse.urljoin(base_url, url.strip()))
+    scheme = split_url.scheme.lower()
+    if scheme and scheme not in DEFAULT_PORTS:
+        return None
+    netloc = (split_url.hostname or '').lower()
+    if ':' in netloc:
+        netloc = '[{}]'.format(netloc)  # an IPv6 address
+    if split_url.port is not None and split_url.port != DEFAULT_PORTS.get(scheme):
+        netloc += ':{}'.format(split_url.port)
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(split_url.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((scheme, netloc, split_url.path or '/', query, ''))
+
+
+def get_site_relative_url(url, site_url):
+    """Returns the canonical URL without its scheme and host (for example '/kategorier/20-frukt-og-gront/') if it is
+    on the same site as site_url, otherwise the whole URL. urljoin(site_url, ...) gives the URL back."""
+    split_url = urllib.parse.urlsplit(url)
+    split_site_url = urllib.parse.urlsplit(canonicalize_url(site_url, site_url) or site_url)
+    if (split_url.scheme, split_url.netloc) != (split_site_url.scheme, split_site_url.netloc):
+        return url
+    return urllib.parse.urlunsplit(('', '', split_url.path, split_url.query, ''))
+
+
+class SeenURLSet:
+    """SeenURLSet remembers the URLs that have already been taken in a crawl, so that every page is processed once,
+    however many times and from however many pages it is linked. The URLs are to be canonicalized before.
+    The same SeenURLSet object can be shared by any number of threads.
+    """
+
+    def __init__(self):
+        self.urls = set()
+        self.lock = threading.Lock()
+
+    def add(self, url):
+        """Adds the URL, and returns True if it has not been seen before."""
+        with self.lock:
+            if url in self.urls:
+                return False
+            self.urls.add(url)
+            return True
+
+    def __len__(self):
+        with self.lock:
+            return len(self.urls)
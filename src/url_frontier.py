@@ -0,0 +1,265 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+ITEM_ROOT = 'root'
+ITEM_MAIN = 'main'
+ITEM_SUB = 'sub'
+
+STATUS_PENDING = 'pending'
+STATUS_LEASED = 'leased'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+class URLFrontier:
+    """URLFrontier is the shared list of the URLs of a crawl, kept in an SQLite file, so that any number of worker
+    processes (on this machine, or on others sharing the file) can split the crawl between them.
+    An item of the frontier is a URL to be processed: the main source URL (root), whose main category URLs are
+    collected, a main category URL (main), whose sub-category URLs are collected, or a sub-category URL (sub),
+    whose products are scraped. An item is pending, leased by a worker, done, or failed.
+    A worker claims a pending item, which gets leased to it for lease_timeout seconds. If the worker does not finish
+    the item in time (for example because it has crashed), the lease expires and the item becomes pending again.
+    An item that has failed (or whose lease has expired) more than max_retries times is failed for good.
+    The sub-categories are done when the output of the worker has written their products out: the worker saves
+    the checkpoint of its output together with them, so a restarted worker continues its output from there, and
+    the products of its unfinished sub-categories are dropped, as they are scraped again. If the worker has lost
+    the lease of any of the sub-categories written out together, none of them is done, and the worker drops them from
+    its output the same way, so a sub-category is never in the output of two workers.
+    While a worker is alive, its leases are renewed by a LeaseHeartbeat, so a URL that takes long is not given to
+    another worker.
+    Every change is made in its own transaction. A URLFrontier object has one connection to the frontier file, so it
+    is not shared between threads or processes: every worker opens its own.
+    """
+
+    def __init__(self, state_file, lease_timeout=300, max_retries=3):
+        self.state_file = state_file
+        self.lease_timeout = lease_timeout
+        self.max_retries = max_retries
+        self.connection = None
+
+    def open(self, reset=False):
+        """Opens the frontier file. If reset is True, the previous crawl is dropped, and a new one is started."""
+        state_dir = os.path.dirname(self.state_file)
+        if state_dir:
+            os.makedirs(state_dir, exist_ok=True)
+        # the transactions are started explicitly (BEGIN IMMEDIATE), so that claiming an item is atomic even
+        # between processes
+        self.connection = sqlite3.connect(self.state_file, timeout=60, isolation_level=None)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS frontier (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'kind TEXT, url TEXT, main_url TEXT, status TEXT, retries INTEGER DEFAULT 0, '
+                                'lease_owner TEXT, lease_expires REAL, last_error TEXT, UNIQUE (kind, url))')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS frontier_status ON frontier (status, id)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, checkpoint TEXT, '
+                                'rows INTEGER DEFAULT 0)')
+        if reset:
+            with self.transaction():
+                self.connection.execute('DELETE FROM frontier')
+                self.connection.execute('DELETE FROM workers')
+
+    def transaction(self):
+        """Returns a context manager of a write transaction, which locks the frontier file for the other processes
+        until it is committed."""
+        return FrontierTransaction(self.connection)
+
+    def seed(self, root_url):
+        """Adds the main source URL to the frontier, if the frontier is empty, so that the crawl starts from it."""
+        with self.transaction():
+            if self.connection.execute('SELECT COUNT(*) FROM frontier').fetchone()[0] == 0:
+                self.connection.execute('INSERT INTO frontier (kind, url, main_url, status) VALUES (?, ?, NULL, ?)',
+                                        (ITEM_ROOT, root_url, STATUS_PENDING))
+
+    def register_worker(self, worker_id):
+        """Registers a worker, and returns the checkpoint of its output saved by its last run (or None).
+        The items still leased to the worker (by its last, crashed run) are made pending again."""
+        with self.transaction():
+            self.connection.execute('INSERT OR IGNORE INTO workers (worker_id) VALUES (?)', (worker_id,))
+            self.connection.execute('UPDATE frontier SET status = ?, lease_owner = NULL, lease_expires = NULL '
+                                    'WHERE status = ? AND lease_owner = ?', (STATUS_PENDING, STATUS_LEASED, worker_id))
+            checkpoint = self.connection.execute('SELECT checkpoint FROM workers WHERE worker_id = ?',
+                                                 (worker_id,)).fetchone()[0]
+        return json.loads(checkpoint) if checkpoint is not None else None
+
+    def release_expired_leases(self, now):
+        """Makes the items with an expired lease pending again, or failed if they have run out of retries.
+        To be called inside a transaction."""
+        self.connection.execute('UPDATE frontier SET retries = retries + 1, last_error = ?, lease_owner = NULL, '
+                                'lease_expires = NULL, status = CASE WHEN retries + 1 > ? THEN ? ELSE ? END '
+                                'WHERE status = ? AND lease_expires < ?',
+                                ('lease expired', self.max_retries, STATUS_FAILED, STATUS_PENDING, STATUS_LEASED, now))
+
+    def extend_leases(self, worker_id, now):
+        """Extends the leases of all the items leased to the worker to lease_timeout seconds from now. To be called
+        inside a transaction."""
+        self.connection.execute('UPDATE frontier SET lease_expires = ? WHERE status = ? AND lease_owner = ?',
+                                (now + self.lease_timeout, STATUS_LEASED, worker_id))
+
+    def renew_leases(self, worker_id):
+        """Renews the leases of all the items leased to the worker, as the worker is still alive."""
+        with self.transaction():
+            self.extend_leases(worker_id, time.time())
+
+    def claim(self, worker_id):
+        """Leases the next pending item to the worker, and returns it as (kind, url, main_url), or None if there is
+        no pending item at the moment. The leases of the other items that the worker holds are renewed, as
+        the worker is still alive."""
+        now = time.time()
+        with self.transaction():
+            self.release_expired_leases(now)
+            self.extend_leases(worker_id, now)
+            row = self.connection.execute('SELECT id, kind, url, main_url FROM frontier WHERE status = ? '
+                                          'ORDER BY id LIMIT 1', (STATUS_PENDING,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute('UPDATE frontier SET status = ?, lease_owner = ?, lease_expires = ? WHERE id = ?',
+                                    (STATUS_LEASED, worker_id, now + self.lease_timeout, row[0]))
+        return row[1:]
+
+    def add_children(self, worker_id, kind, url, child_kind, child_urls, main_url=None):
+        """Marks an item whose URLs have been collected as done, and adds the collected URLs to the frontier as
+        pending items of the child kind, in the same transaction. The URLs already in the frontier are not added
+        again. Returns False if the item is not leased to the worker any more, then nothing is changed."""
+        with self.transaction():
+            if not self.mark_done(worker_id, [(kind, url)]):
+                return False
+            self.connection.executemany('INSERT OR IGNORE INTO frontier (kind, url, main_url, status) '
+                                        'VALUES (?, ?, ?, ?)',
+                                        [(child_kind, child_url, main_url if main_url is not None else child_url,
+                                          STATUS_PENDING) for child_url in child_urls])
+        return True
+
+    def complete(self, worker_id, items, checkpoint, rows):
+        """Marks the items as done, and saves the checkpoint of the output of the worker and the number of rows
+        written, in the same transaction. To be called when the output has written out the products of the items.
+        If any of the items is not leased to the worker any more (its lease has expired, and it may have been
+        claimed by another worker), nothing is marked done and nothing is saved: the items still leased to the worker
+        become pending again, and the worker is to drop all the items from its output by going back to its last saved
+        checkpoint. Returns True if the items are done."""
+        with self.transaction():
+            leased_items = [(kind, url) for kind, url in items if self.is_leased(worker_id, kind, url)]
+            if len(leased_items) < len(items):
+                self.connection.executemany('UPDATE frontier SET status = ?, lease_owner = NULL, '
+                                            'lease_expires = NULL WHERE kind = ? AND url = ? AND status = ? '
+                                            'AND lease_owner = ?',
+                                            [(STATUS_PENDING, kind, url, STATUS_LEASED, worker_id)
+                                             for kind, url in leased_items])
+                return False
+            self.mark_done(worker_id, items)
+            self.connection.execute('UPDATE workers SET checkpoint = ?, rows = rows + ? WHERE worker_id = ?',
+                                    (json.dumps(checkpoint), rows, worker_id))
+        return True
+
+    def is_leased(self, worker_id, kind, url):
+        """Returns True if the item is leased to the worker."""
+        return self.connection.execute('SELECT COUNT(*) FROM frontier WHERE kind = ? AND url = ? AND status = ? '
+                                       'AND lease_owner = ?', (kind, url, STATUS_LEASED, worker_id)).fetchone()[0] > 0
+
+    def get_checkpoint(self, worker_id):
+        """Returns the checkpoint of the output of the worker saved last, or None if there is none."""
+        row = self.connection.execute('SELECT checkpoint FROM workers WHERE worker_id = ?', (worker_id,)).fetchone()
+        return json.loads(row[0]) if row is not None and row[0] is not None else None
+
+    def mark_done(self, worker_id, items):
+        """Marks the items leased to the worker as done, and returns their number. To be called inside
+        a transaction."""
+        done_count = 0
+        for kind, url in items:
+            done_count += self.connection.execute('UPDATE frontier SET status = ?, lease_owner = NULL, '
+                                                  'lease_expires = NULL WHERE kind = ? AND url = ? AND status = ? '
+                                                  'AND lease_owner = ?',
+                                                  (STATUS_DONE, kind, url, STATUS_LEASED, worker_id)).rowcount
+        return done_count
+
+    def fail(self, worker_id, kind, url, error):
+        """Records the failure of an item leased to the worker. The item becomes pending again to be retried, or
+        failed if it has run out of retries."""
+        with self.transaction():
+            self.connection.execute('UPDATE frontier SET retries = retries + 1, last_error = ?, lease_owner = NULL, '
+                                    'lease_expires = NULL, status = CASE WHEN retries + 1 > ? THEN ? ELSE ? END '
+                                    'WHERE kind = ? AND url = ? AND status = ? AND lease_owner = ?',
+                                    (str(error), self.max_retries, STATUS_FAILED, STATUS_PENDING, kind, url,
+                                     STATUS_LEASED, worker_id))
+
+    def get_status_counts(self):
+        """Returns the number of the items in each status."""
+        rows = self.connection.execute('SELECT status, COUNT(*) FROM frontier GROUP BY status').fetchall()
+        status_counts = {status: 0 for status in (STATUS_PENDING, STATUS_LEASED, STATUS_DONE, STATUS_FAILED)}
+        status_counts.update(rows)
+        return status_counts
+
+    def is_finished(self):
+        """Returns True if every item of the frontier is done or failed, so there is nothing left to do."""
+        status_counts = self.get_status_counts()
+        return status_counts[STATUS_PENDING] == 0 and status_counts[STATUS_LEASED] == 0
+
+    def get_lease_owner(self, kind, url):
+        """Returns the ID of the worker that the item is leased to, or None if the item is not leased."""
+        row = self.connection.execute('SELECT lease_owner FROM frontier WHERE kind = ? AND url = ? AND status = ?',
+                                      (kind, url, STATUS_LEASED)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_failed_items(self):
+        """Returns the (kind, URL, last error) of the failed items."""
+        return self.connection.execute('SELECT kind, url, last_error FROM frontier WHERE status = ? ORDER BY id',
+                                       (STATUS_FAILED,)).fetchall()
+
+    def get_row_count(self):
+        """Returns the number of products written by all the workers."""
+        return self.connection.execute('SELECT COALESCE(SUM(rows), 0) FROM workers').fetchone()[0]
+
+    def close(self):
+        """Closes the frontier file."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class LeaseHeartbeat:
+    """LeaseHeartbeat renews the leases of a worker in a background thread, every third of the lease timeout, so
+    the URL the worker is busy with keeps its lease however long it takes. If the worker process dies, so does
+    the heartbeat, and the leases expire. The thread has its own connection to the frontier file."""
+
+    def __init__(self, frontier, worker_id):
+        self.frontier = URLFrontier(frontier.state_file, frontier.lease_timeout, frontier.max_retries)
+        self.worker_id = worker_id
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Starts renewing the leases."""
+        self.thread.start()
+
+    def run(self):
+        """Renews the leases until the heartbeat is stopped. A failed renewal is tried again at the next beat."""
+        self.frontier.open()
+        try:
+            while not self.stop_event.wait(self.frontier.lease_timeout / 3):
+                try:
+                    self.frontier.renew_leases(self.worker_id)
+                except sqlite3.Error as error:
+                    print('The leases could not be renewed: {}'.format(error))
+        finally:
+            self.frontier.close()
+
+    def stop(self):
+        """Stops renewing the leases."""
+        self.stop_event.set()
+        self.thread.join()
+
+
+class FrontierTransaction:
+    """FrontierTransaction is the context manager of a write transaction of the frontier file. The transaction
+    is committed at the end of the block, or rolled back if the block raises an exception."""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        return False
@@ -1,12 +1,42 @@
+import os
+import threading
 import yaml
 
 from src.settings import CONFIG_FILE
 
+_config_file = CONFIG_FILE
+_config_cache = {}
+_config_cache_lock = threading.Lock()
+
+
+def set_config_file(config_file):
+    """To use another config file instead of the default one, for example a generated one in the benchmarks.
+    Returns the config file that was used before, so that it can be set back.
+    """
+    global _config_file
+    previous_config_file = _config_file
+    _config_file = config_file
+    return previous_config_file
+
+
+def load_whole_config():
+    """To load the whole config file as a dictionary.
+    The file is parsed only once and then it is served from a cache, until the modification time of the file changes.
+    """
+    config_file_path = _config_file
+    config_file_mtime = os.stat(config_file_path).st_mtime_ns
+    with _config_cache_lock:
+        cached = _config_cache.get(config_file_path)
+        if cached is not None and cached[0] == config_file_mtime:
+            return cached[1]
+        with open(config_file_path) as config_file:
+            config = yaml.safe_load(config_file)
+        _config_cache[config_file_path] = (config_file_mtime, config)
+        return config
+
 
 def load_config(config_param):
     """To load a config parameter from the config file.
     Returns a single value or a dictionary.
     """
-    with open(CONFIG_FILE) as config_file:
-        config = yaml.safe_load(config_file)
-    return config[config_param]
+    return load_whole_config()[config_param]
@@ -1,18 +1,34 @@
 from html.parser import HTMLParser
-import urllib.request
-import copy
+import codecs
+import os
+import queue
+import shutil
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import pandas as pd
 
 from src.utils import load_config
-from src.settings import CONTAINER_TAG_NAME, CONTAINER_TAG_ATTR_NAME, CONTAINER_TAG_ATTR_VALUE, \
-                         TAG_NAME_TO_SEARCH, TAG_ATTR_TO_SEARCH, TAG_ATTR_VALUE_PATTERN, \
-                         TAG_FILTER_ATTR_NAME, TAG_FILTER_ATTR_VALUE, HAS_SUB_CONTAINER, SUB_CONTAINER_TAG_NAME, \
-                         SUB_CONTAINER_TAG_ATTR_NAME, SUB_CONTAINER_TAG_ATTR_VALUE, \
-                         PRODUCT_INFORMATION_CONFIG, \
-                         PRODUCT_INFORMATION_TAG_NAME, PRODUCT_INFORMATION_ATTR_NAME, PRODUCT_INFORMATION_ATTR_VALUE, \
-                         MAIN_URL_COLLECTION_NEEDED, MAIN_SOURCE_URL, MAIN_URLS_TO_SCRAP_CONFIG, \
+from src.scraper_config import get_config_matcher, has_attr_value, strip_script_bodies, CONTAINER_FOUND, \
+    CONTAINER_NOT_FOUND
+from src.fetching import get_default_fetcher
+from src.crawl_journal import CrawlJournal
+from src.delta_crawl import DeltaCrawl, diff_products
+from src.output_sinks import create_output_sink, get_worker_result_path
+from src.url_frontier import URLFrontier, LeaseHeartbeat, ITEM_ROOT, ITEM_MAIN, ITEM_SUB
+from src.url_canonicalization import canonicalize_url, get_site_relative_url, SeenURLSet
+from src.price_columns import add_typed_price_columns
+from src.instrumentation import CrawlInstrumentation, get_instrumentation, set_instrumentation
+from src.settings import MAIN_URL_COLLECTION_NEEDED, MAIN_SOURCE_URL, MAIN_URLS_TO_SCRAP_CONFIG, \
                          PRODUCT_SUB_URL_COLL_NEEDED, SUB_SOURCE_URL_BEGINNING, PRODUCT_SUB_URLS_TO_SCRAP_CONFIG, \
-                         PRODUCT_SCRAPING_CONFIG, RESULT_FILE, MAIN_CATEG_COL, SUB_CATEG_COL
+                         PRODUCT_SCRAPING_CONFIG, MAIN_CATEG_COL, SUB_CATEG_COL, \
+                         CONCURRENT_CRAWL, CRAWL_WORKER_COUNT, CRAWL_JOURNAL_FILE, \
+                         OUTPUT_CONFIG, OUTPUT_SINK, MAX_BUFFERED_ROWS, PARSER_WORKER_COUNT, MAX_QUEUED_PAGES, \
+                         INSTRUMENTATION_CONFIG, INSTRUMENTATION_ENABLED, PROFILE_PARSE, RUN_REPORT_FILE, \
+                         PROMETHEUS_FILE, PARSE_PROFILE_FILE, DELTA_CRAWL, DELTA_STATE_FILE, TYPED_PRICES, \
+                         FRONTIER_CONFIG, LEASE_TIMEOUT, MAX_RETRIES, POLL_INTERVAL, FRONTIER_STATE_FILE, \
+                         FRONTIER_RESULT_DIR
 
 
 class ScrapingDoneException(Exception):
@@ -25,16 +41,33 @@ class BasicWebScraper(HTMLParser):
     """BasicWebScraper extends from the HTMLParser class from the basic library.
     A BasicWebScraper object takes care of basic web scraping and it is to be extended to further specific classes
     to collect URLs or product information.
+    If the instrumentation is on, the scraper records the timings and the counters of its URL into a URLMetrics object.
+    Otherwise url_metrics is None and nothing is measured.
     """
 
-    def __init__(self, url, config):
+    def __init__(self, url, config, fetcher=None):
         super(BasicWebScraper, self).__init__()
-        self.config = load_config(config)
+        self.config = get_config_matcher(config)  # compiled once and shared by all scrapers of the same config
         self.source_url = url
+        self.fetcher = fetcher
         self.inside_container = False
         self.inside_sub_container = False
         self.cont_tag_counter = 0
         self.sub_cont_tag_counter = 0
+        self.tag_counter = 0
+        self.url_metrics = None
+        self.parse_profiler = None
+        instrumentation = get_instrumentation()
+        if instrumentation is not None:
+            self.url_metrics = instrumentation.create_url_metrics(url, type(self).__name__)
+            self.parse_profiler = instrumentation.get_parse_profiler()
+
+    def get_fetcher(self):
+        """Returns the fetcher that downloads the pages. If the scraper has not been given one, it is the default
+        fetcher, which is only set up when the first page is to be downloaded."""
+        if self.fetcher is None:
+            self.fetcher = get_default_fetcher()
+        return self.fetcher
 
     def get_source_url(self):
         """Returns the source URL that we are scraping."""
@@ -52,7 +85,7 @@ class BasicWebScraper(HTMLParser):
         """Sets the inside_sub_container variable, or if the the config does not have a sub-container, it sets the
         original inside_container variable. Then there is no need to use the inside_sub_container, but for simpler
         coding we will use this method."""
-        if self.config.get(HAS_SUB_CONTAINER):
+        if self.config.has_sub_container:
             self.inside_sub_container = value
         else:
             self.inside_container = value
@@ -60,7 +93,7 @@ class BasicWebScraper(HTMLParser):
     def is_inside_sub_container(self):
         """Returns True if we are inside the sub-container element. Otherwise False.
         Also returns True if we do not have a sub-container, but we are in the container element."""
-        if self.config.get(HAS_SUB_CONTAINER):
+        if self.config.has_sub_container:
             return self.inside_sub_container
         else:
             return self.inside_container
@@ -110,31 +143,28 @@ class BasicWebScraper(HTMLParser):
         # if we are already inside, then we increase the cont_tag_counter. more info at increase_cont_tag_counter()
         # if we are not in the container yet, we check the attributes and they match,
         # we set the inside_container variable to True, so that we will know it later
-        if tag == self.config.get(CONTAINER_TAG_NAME):
+        self.tag_counter += 1
+        config = self.config
+        if tag == config.container_tag_name:
             if self.is_inside_container():
                 self.increase_cont_tag_counter()
-                if not self.config.get(HAS_SUB_CONTAINER):
+                if not config.has_sub_container:
                     return
-            else:
-                for attr in attrs:
-                    if attr[0] == self.config.get(CONTAINER_TAG_ATTR_NAME) and \
-                            attr[1].strip() == self.config.get(CONTAINER_TAG_ATTR_VALUE):
-                        self.set_inside_container(True)
-                        return
+            elif config.is_container_tag(attrs):
+                self.set_inside_container(True)
+                return
         # if the config has sub-container setup, then:
         # if this tag is equal to the sub-container tag, first we check if we are already inside or not
         # if we are already inside, we increase the sub_cont_tag_counter. more info at increase_sub_cont_tag_counter()
         # if we are not in the sub-container yet, we check the attributes and they match,
         # we set the inside_sub_container variable to True, so that we will know it later
-        if self.config.get(HAS_SUB_CONTAINER):
-            if tag == self.config.get(SUB_CONTAINER_TAG_NAME):
+        if config.has_sub_container:
+            if tag == config.sub_container_tag_name:
                 if self.is_inside_sub_container():
                     self.increase_sub_cont_tag_counter()
                     return
-                for attr in attrs:
-                    if attr[0] == self.config.get(SUB_CONTAINER_TAG_ATTR_NAME) and \
-                            attr[1].strip() == self.config.get(SUB_CONTAINER_TAG_ATTR_VALUE):
-                        self.set_inside_sub_container(True)
+                if config.is_sub_container_tag(attrs):
+                    self.set_inside_sub_container(True)
 
     def handle_endtag(self, tag):
         """Overrides method from HTMLParser. This is called when we find an ending tag.
@@ -148,9 +178,10 @@ class BasicWebScraper(HTMLParser):
         # if the config has sub-container setup, then:
         # if we are inside the sub-container and we find a tag with the same tag name, we finish collection data for
         # the given product
-        if self.config.get(HAS_SUB_CONTAINER):
+        config = self.config
+        if config.has_sub_container:
             if self.is_inside_sub_container():
-                if tag == self.config.get(SUB_CONTAINER_TAG_NAME):
+                if tag == config.sub_container_tag_name:
                     if self.get_sub_cont_tag_counter() == 0:
                         self.set_inside_sub_container(False)
                         self.exit_sub_container()  # to be implemented in sub-classes. here it does nothing
@@ -159,19 +190,126 @@ class BasicWebScraper(HTMLParser):
         # if we are inside the container and we find a tag with the same tag name, we decide whether to exit the process
         # or just to decrease the cont_tag_counter variable as the ending tag is not for our container tag
         if self.is_inside_container():
-            if tag == self.config.get(CONTAINER_TAG_NAME):
+            if tag == config.container_tag_name:
                 if self.get_cont_tag_counter() == 0:
-                    if not self.config.get(HAS_SUB_CONTAINER):
+                    if not config.has_sub_container:
                         self.exit_sub_container()  # to be implemented in sub-classes. here it does nothing
                     raise ScrapingDoneException()
                 else:
                     self.decrease_cont_tag_counter()
 
     def get_html_by_url(self, url):
-        """Returns the HTML source of a web page located at the given URL."""
-        with urllib.request.urlopen(url) as response:
-            html_source = response.read().decode('utf-8')
-        return html_source
+        """Returns the HTML source of a web page located at the given URL.
+        The page is downloaded by the fetcher, which reuses the keep-alive connections to the host."""
+        if self.url_metrics is None:
+            return self.get_fetcher().fetch(url).decode('utf-8')
+        return self.get_fetcher().fetch(url, self.url_metrics).decode('utf-8')
+
+    def feed_measured(self, html_source):
+        """Runs the feed() method of the HTMLParser class, adding the time spent to the parse time of the URL.
+        If the parse stage is profiled, the profiler of the thread is running during the feed."""
+        start = time.perf_counter()
+        if self.parse_profiler is not None:
+            self.parse_profiler.enable()
+        try:
+            self.feed(html_source)
+        finally:
+            if self.parse_profiler is not None:
+                self.parse_profiler.disable()
+            self.url_metrics.parse_seconds += time.perf_counter() - start
+
+    def record_parse_metrics(self, early_exit):
+        """Records the counters of the finished parse into the URLMetrics of the URL. The sub-classes add their own
+        counters."""
+        self.url_metrics.tags_processed += self.tag_counter
+        self.url_metrics.early_exit = early_exit
+
+    def slice_container(self, html_source):
+        """Returns the part of the HTML source to be parsed when the container is pre-sliced: from the starting tag of
+        the container, with the bodies of the script and style elements left out (see strip_script_bodies()).
+        Nothing that matters to us is before the container, or in a script or style, so the parser has less to go
+        through, and the result is the same. If the container cannot be found safely by the scan (see
+        scan_container_start()), the whole HTML source is returned, to be parsed as usual."""
+        status, start = self.config.scan_container_start(html_source)
+        if status != CONTAINER_FOUND:
+            return html_source
+        container_source = html_source[start:]
+        stripped_source, end = strip_script_bodies(container_source)
+        return stripped_source + container_source[end:]
+
+    def feed_html_source(self, html_source):
+        """Runs the feed() method of the HTMLParser class on the HTML source, until the end of the container
+        (ScrapingDoneException). If the container is pre-sliced (pre_slice_container in the config), only the part
+        of the source from the container is parsed (see slice_container())."""
+        feed = self.feed if self.url_metrics is None else self.feed_measured
+        if self.config.pre_slice_container:
+            html_source = self.slice_container(html_source)
+        early_exit = False
+        try:
+            feed(html_source)
+        except ScrapingDoneException:
+            early_exit = True
+        if self.url_metrics is not None:
+            self.record_parse_metrics(early_exit)
+
+    def feed_source_url(self):
+        """Downloads the page of the source URL and runs the feed() method of the HTMLParser class on it, until the end
+        of the container (ScrapingDoneException).
+        If the fetcher is streaming, the page is fed chunk by chunk as it arrives, and the download is stopped as soon
+        as we leave the container, so the rest of the page is not downloaded at all.
+        If the container is pre-sliced, the chunks are kept until the starting tag of the container has arrived, and
+        the parsing starts there, without the bodies of the script and style elements (see slice_container()).
+        If the scan cannot find the container safely, the whole page is fed.
+        """
+        fetcher = self.get_fetcher()
+        if not fetcher.streaming:
+            self.feed_html_source(self.get_html_by_url(self.get_source_url()))
+            return
+        feed = self.feed if self.url_metrics is None else self.feed_measured
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        html_source = ''
+        early_exit = False
+        pre_slice = self.config.pre_slice_container
+        container_found = not pre_slice
+        scan_position = 0
+        if self.url_metrics is None:
+            response_stream = fetcher.stream(self.get_source_url())
+        else:
+            response_stream = fetcher.stream(self.get_source_url(), self.url_metrics)
+        with response_stream:
+            try:
+                for chunk in response_stream:
+                    html_source += decoder.decode(chunk)
+                    if not container_found:
+                        status, scan_position = self.config.scan_container_start(html_source, scan_position)
+                        if status == CONTAINER_NOT_FOUND:
+                            continue
+                        container_found = True
+                        if status == CONTAINER_FOUND:
+                            html_source = html_source[scan_position:]
+                        else:
+                            pre_slice = False  # the scan is ambiguous, the whole page is fed
+                    # we feed the HTML source only up to the last '<', because HTMLParser would pass the text at the end
+                    # of a chunk to handle_data() in pieces, and only the first piece of a product data would be saved
+                    cut_position = html_source.rfind('<')
+                    if cut_position > 0:
+                        if pre_slice:
+                            # a script or style not closed yet is kept until it is
+                            fed_source, cut_position = strip_script_bodies(html_source[:cut_position])
+                        else:
+                            fed_source = html_source[:cut_position]
+                        if fed_source:
+                            feed(fed_source)
+                        html_source = html_source[cut_position:]
+                html_source += decoder.decode(b'', final=True)
+                if pre_slice and container_found:
+                    stripped_source, end = strip_script_bodies(html_source)
+                    html_source = stripped_source + html_source[end:]
+                feed(html_source)
+            except ScrapingDoneException:
+                early_exit = True
+        if self.url_metrics is not None:
+            self.record_parse_metrics(early_exit)
 
 
 class URLCollector(BasicWebScraper):
@@ -180,18 +318,32 @@ class URLCollector(BasicWebScraper):
     for collecting the URL list that we will have to scrap.
     """
 
-    def __init__(self, url, config):
-        super(URLCollector, self).__init__(url, config)
+    def __init__(self, url, config, fetcher=None):
+        super(URLCollector, self).__init__(url, config, fetcher)
         self.url_list = []
+        self.seen_urls = set()
 
     def add_url_to_list(self, url):
-        """Adds the found URL to the list to be returned."""
-        self.url_list.append(url)
+        """Adds the found URL to the list to be returned, in its canonical form (see canonicalize_url()), and
+        without the scheme and the host if it is on the same site as the page. A URL already in the list, even if it
+        was written differently in the page, and a URL that is not a web page are not added."""
+        canonical_url = canonicalize_url(url, self.get_source_url())
+        if canonical_url is None:
+            return
+        canonical_url = get_site_relative_url(canonical_url, self.get_source_url())
+        if canonical_url not in self.seen_urls:
+            self.seen_urls.add(canonical_url)
+            self.url_list.append(canonical_url)
 
     def get_url_list(self):
         """Returns the list of URLs that have been found."""
         return self.url_list
 
+    def record_parse_metrics(self, early_exit):
+        """Records the counters of the finished parse, with the number of URLs found."""
+        super(URLCollector, self).record_parse_metrics(early_exit)
+        self.url_metrics.urls_collected += len(self.url_list)
+
     def handle_starttag(self, tag, attrs):
         """"""
         """Overrides method from BasicWebScraper (and HTMLParser). This is called when we find a starting tag.
@@ -199,26 +351,20 @@ class URLCollector(BasicWebScraper):
         This overridden version also checks whether we have found the required tag(s) inside the (sub)container.
         If the required tag is found and all parameters match, we add the required value (URL) to the list to be returned.
         """
+        config = self.config
         tag_found = False
         # if we are inside the (sub)container and we are looking for the the current tag, then we check whether
         # we need to filter the tag or not. if the tag is one that we are looking for, we set the tag_found to True
-        if self.is_inside_sub_container() and tag == self.config.get(TAG_NAME_TO_SEARCH):
-            if self.config.get(TAG_FILTER_ATTR_NAME) is not None:
-                for attr in attrs:
-                    if attr[0] == self.config.get(TAG_FILTER_ATTR_NAME):
-                        if attr[1].strip() == self.config.get(TAG_FILTER_ATTR_VALUE):
-                            tag_found = True
-                            break
+        if tag == config.tag_name_to_search and self.is_inside_sub_container():
+            if config.tag_filter_attr_name is not None:
+                tag_found = has_attr_value(attrs, config.tag_filter_attr_name, config.tag_filter_attr_value)
             else:
                 tag_found = True
         # if this is a tag that we are looking for, we check the attributes and add the required value (URL) to the list
         if tag_found:
             for attr in attrs:
-                if attr[0] == self.config.get(TAG_ATTR_TO_SEARCH):
-                    if self.config.get(TAG_ATTR_VALUE_PATTERN) is None:
-                        self.add_url_to_list(attr[1].strip())
-                    elif self.config.get(TAG_ATTR_VALUE_PATTERN) is not None and \
-                            self.config.get(TAG_ATTR_VALUE_PATTERN) in attr[1].strip():
+                if attr[0] == config.tag_attr_to_search and attr[1] is not None:
+                    if config.tag_attr_value_pattern is None or config.tag_attr_value_pattern in attr[1].strip():
                         self.add_url_to_list(attr[1].strip())
         super(URLCollector, self).handle_starttag(tag, attrs)
 
@@ -226,11 +372,7 @@ class URLCollector(BasicWebScraper):
         """Runs the feed() method of the HTMLParser class and when finished, returns the collected URL list."""
         if self.config is None:
             return []
-        html_source = self.get_html_by_url(self.get_source_url())
-        try:
-            self.feed(html_source)
-        except ScrapingDoneException:
-            pass
+        self.feed_source_url()
         return self.get_url_list()
 
 
@@ -240,9 +382,10 @@ class ProductScraper(BasicWebScraper):
     for collecting product information.
     """
 
-    def __init__(self, url, config):
-        super(ProductScraper, self).__init__(url, config)
-        self.product_list = []
+    def __init__(self, url, config, fetcher=None):
+        super(ProductScraper, self).__init__(url, config, fetcher)
+        self.product_columns = {}
+        self.product_count = 0
         self.current_product_dict = {}
         # self.empty_product_dict = {}
         self.data_to_be_collected = False
@@ -268,7 +411,7 @@ class ProductScraper(BasicWebScraper):
 
     def reset_current_product_dict(self):
         """Resets the current product dictionary to have empty values."""
-        for key in self.config.get(PRODUCT_INFORMATION_CONFIG):
+        for key in self.config.product_fields:
             self.current_product_dict[key] = ''
 
     def add_to_current_product_dict(self, key, value):
@@ -280,14 +423,32 @@ class ProductScraper(BasicWebScraper):
         return self.current_product_dict
 
     def exit_sub_container(self):
-        """Method to be executed upon exiting the sub-container. Appends the current product dictionary to the list."""
-        self.product_list.append(self.get_current_product_dict())
-        self.product_list = copy.deepcopy(self.product_list)  # !!!!! - I lost a lot of time here, should have known, list is by reference
+        """Method to be executed upon exiting the sub-container. Appends the values of the current product dictionary
+        to the product columns, one list for each product field. As only the values are stored, the current product
+        dictionary can be reset and reused for the next product without copying anything."""
+        for key, value in self.get_current_product_dict().items():
+            column = self.product_columns.get(key)
+            if column is None:
+                # a field that the previous products did not have stays empty for them
+                column = self.product_columns[key] = [None] * self.product_count
+            column.append(value)
+        self.product_count += 1
         self.reset_current_product_dict()
 
+    def record_parse_metrics(self, early_exit):
+        """Records the counters of the finished parse, with the number of products found."""
+        super(ProductScraper, self).record_parse_metrics(early_exit)
+        self.url_metrics.products_emitted += self.product_count
+
+    def get_product_columns(self):
+        """Returns the product information of the (sub)category as a dictionary of columns: the name of the product
+        field and the list of its values, in the order of the products."""
+        return self.product_columns
+
     def get_product_data_list(self):
-        """Returns the whole product list for the (sub)category."""
-        return self.product_list
+        """Returns the whole product list for the (sub)category, one dictionary for each product."""
+        fields = list(self.product_columns)
+        return [dict(zip(fields, values)) for values in zip(*self.product_columns.values())]
 
     def handle_starttag(self, tag, attrs):
         """"""
@@ -300,14 +461,11 @@ class ProductScraper(BasicWebScraper):
         # if we are inside the (sub)container and we are looking for the the current tag, then we check whether
         # the tag has the required attribute or not. if the tag is one that we are looking for, we get the required
         # product data and save it into the current product dictionary
+        # the compiled config tells the product field of the tag with a single dictionary lookup
         if self.is_inside_sub_container():
-            for product_info, setup in self.config.get(PRODUCT_INFORMATION_CONFIG).items():
-                if tag == setup.get(PRODUCT_INFORMATION_TAG_NAME):
-                    for attr in attrs:
-                        if attr[0] == setup.get(PRODUCT_INFORMATION_ATTR_NAME):
-                            if attr[1].strip() == setup.get(PRODUCT_INFORMATION_ATTR_VALUE):
-                                self.set_data_to_be_collected(True, product_info)
-                                break
+            product_info = self.config.get_product_field(tag, attrs)
+            if product_info is not None:
+                self.set_data_to_be_collected(True, product_info)
         super(ProductScraper, self).handle_starttag(tag, attrs)
 
     def handle_data(self, data):
@@ -319,17 +477,125 @@ class ProductScraper(BasicWebScraper):
         self.set_data_to_be_collected(False, '')
 
     def get_product_scraping_data(self):
-        """Runs the feed() method of the HTMLParser class and when finished, returns the collected product information.
+        """Runs the feed() method of the HTMLParser class and when finished, returns the collected product information
+        as columns. More info at get_product_columns().
         """
         if self.config is None:
-            return []
+            return {}
         # self.create_empty_product_dict()
-        html_source = self.get_html_by_url(self.get_source_url())
-        try:
-            self.feed(html_source)
-        except ScrapingDoneException:
-            pass
-        return self.get_product_data_list()
+        self.feed_source_url()
+        return self.get_product_columns()
+
+    def parse_product_data(self, html_source):
+        """Collects the product information from an HTML source that has already been downloaded, and returns it
+        as columns. More info at get_product_columns().
+        """
+        if self.config is None:
+            return {}
+        self.feed_html_source(html_source)
+        return self.get_product_columns()
+
+
+def init_parser_worker():
+    """Initializer of the parser worker processes. The product scraping config is compiled once, when the worker
+    starts, and then it is shared by all the pages the worker parses.
+    The instrumentation copied from the parent process (if the worker has been forked) is turned off, the workers
+    measure the pages by parse_product_pages_measured() instead."""
+    set_instrumentation(None)
+    get_config_matcher(PRODUCT_SCRAPING_CONFIG)
+
+
+def parse_product_page(url, html_source):
+    """Parses a downloaded product page in a parser worker process, and returns the product information columns."""
+    return ProductScraper(url, PRODUCT_SCRAPING_CONFIG).parse_product_data(html_source.decode('utf-8'))
+
+
+def parse_product_pages(url, html_sources):
+    """Parses the downloaded pages of a product listing in a parser worker process, and returns the product
+    information columns of all the pages together."""
+    return merge_product_columns([parse_product_page(url, html_source) for html_source in html_sources])
+
+
+def parse_product_pages_measured(url, html_sources, profile_parse):
+    """Parses the downloaded pages of a product listing in a parser worker process like parse_product_pages(), while
+    measuring it. Returns the product information columns, the URLMetrics of the parse and the raw statistics of
+    the profile."""
+    instrumentation = CrawlInstrumentation(profile_parse)
+    set_instrumentation(instrumentation)
+    try:
+        product_columns = parse_product_pages(url, html_sources)
+    finally:
+        set_instrumentation(None)
+    parse_metrics = instrumentation.url_metrics[0]
+    for page_metrics in instrumentation.url_metrics[1:]:
+        parse_metrics.add_parse_metrics(page_metrics)
+    return product_columns, parse_metrics, instrumentation.get_profile_stats()
+
+
+def merge_product_columns(product_columns_list):
+    """Returns the product information columns of more pages as the columns of one page, the products of the pages
+    one after the other. A field that some pages do not have stays empty for their products."""
+    if len(product_columns_list) == 1:
+        return product_columns_list[0]
+    merged_columns = {}
+    product_count = 0
+    for product_columns in product_columns_list:
+        count = max((len(column) for column in product_columns.values()), default=0)
+        for key, values in product_columns.items():
+            merged_columns.setdefault(key, [None] * product_count).extend(values)
+        product_count += count
+        for column in merged_columns.values():
+            column.extend([None] * (product_count - len(column)))
+    return merged_columns
+
+
+class ProductAccumulator:
+    """ProductAccumulator collects the product information of all the scraped (sub)categories and builds a single
+    DataFrame from them at the end. The values are kept in one list for each column, so adding the products of
+    a (sub)category does not copy the products added before. The main and sub-category names are stored only once,
+    and the rows refer to them by codes, so they become categorical columns in the DataFrame.
+    """
+
+    def __init__(self):
+        self.columns = {}
+        self.index = []
+        self.categ_codes = {MAIN_CATEG_COL: [], SUB_CATEG_COL: []}
+        self.categ_names = {MAIN_CATEG_COL: {}, SUB_CATEG_COL: {}}
+
+    def get_row_count(self):
+        """Returns the number of products added so far."""
+        return len(self.index)
+
+    def add_categ_codes(self, categ_col, categ_name, count):
+        """Adds the code of the category name to the category column for the given number of rows."""
+        code = self.categ_names[categ_col].setdefault(categ_name, len(self.categ_names[categ_col]))
+        self.categ_codes[categ_col].extend([code] * count)
+
+    def add_products(self, main_categ, sub_categ, product_columns):
+        """Adds the products of a (sub)category, given as columns (see ProductScraper.get_product_columns())."""
+        row_count = self.get_row_count()
+        count = max((len(column) for column in product_columns.values()), default=0)
+        for key, values in product_columns.items():
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[key] = [None] * row_count
+            column.extend(values)
+        # the columns that this (sub)category does not have stay empty for its products
+        for column in self.columns.values():
+            if len(column) < row_count + count:
+                column.extend([None] * (row_count + count - len(column)))
+        self.add_categ_codes(MAIN_CATEG_COL, main_categ, count)
+        self.add_categ_codes(SUB_CATEG_COL, sub_categ, count)
+        self.index.extend(range(count))  # every (sub)category is indexed from 0, like separate DataFrames would be
+
+    def to_dataframe(self):
+        """Builds the DataFrame of all the products added so far."""
+        if not self.index:
+            return pd.DataFrame()
+        data = {categ_col: pd.Categorical.from_codes(self.categ_codes[categ_col], list(self.categ_names[categ_col]))
+                for categ_col in (MAIN_CATEG_COL, SUB_CATEG_COL)}
+        data.update(self.columns)
+        return pd.DataFrame(data, index=self.index)
 
 
 class WebScraperRunner:
@@ -338,35 +604,525 @@ class WebScraperRunner:
     """
 
     @classmethod
-    def run_web_scraping_and_save_data(cls):
+    def get_categ_name(cls, url, position):
+        """Returns the category name from the given part of the URL path, without the ID in front of it.
+        For example '20-frukt-og-gront' becomes 'frukt-og-gront'."""
+        url_part = urllib.parse.urlsplit(url).path.split('/')[position]
+        return url_part[url_part.find('-')+1:]
+
+    @classmethod
+    def get_absolute_url(cls, url):
+        """Returns the absolute URL of a collected URL, which is relative to the site of sub_source_url_beginning
+        unless it is on another site."""
+        return urllib.parse.urljoin(load_config(SUB_SOURCE_URL_BEGINNING), url)
+
+    @classmethod
+    def collect_main_urls(cls, fetcher=None):
+        """Returns the list of the main category URLs."""
+        url = load_config(MAIN_SOURCE_URL)
+        main_url_collector = URLCollector(url, MAIN_URLS_TO_SCRAP_CONFIG, fetcher)
+        return main_url_collector.get_urls_to_scrap()
+
+    @classmethod
+    def collect_sub_urls(cls, main_url, fetcher=None):
+        """Returns the list of the sub-category URLs of the given main category."""
+        url = cls.get_absolute_url(main_url)
+        sub_url_collector = URLCollector(url, PRODUCT_SUB_URLS_TO_SCRAP_CONFIG, fetcher)
+        return sub_url_collector.get_urls_to_scrap()
+
+    @classmethod
+    def get_next_page_url(cls, html_source, page_url, page_urls):
+        """Returns the URL of the next page of a product listing, or None if the page has no next page link, the
+        listing has as many pages as max_pages, or the link goes back to a page of the listing."""
+        matcher = get_config_matcher(PRODUCT_SCRAPING_CONFIG)
+        if len(page_urls) >= matcher.max_pages:
+            return None
+        next_page_href = matcher.find_next_page_href(html_source)
+        if next_page_href is None:
+            return None
+        next_page_url = canonicalize_url(next_page_href, page_url)
+        return next_page_url if next_page_url not in page_urls else None
+
+    @classmethod
+    def download_product_pages(cls, url, fetcher=None):
+        """Downloads the pages of a product listing whole, following the next page links (see get_next_page_url()).
+        Returns the list of (ProductScraper, HTML source) of the pages, each scraper set up for its page."""
+        pages = []
+        page_urls = []
+        page_url = canonicalize_url(url, url)
+        while page_url is not None:
+            product_scrapper = ProductScraper(page_url, PRODUCT_SCRAPING_CONFIG, fetcher)
+            html_source = product_scrapper.get_html_by_url(page_url)
+            pages.append((product_scrapper, html_source))
+            page_urls.append(page_url)
+            page_url = cls.get_next_page_url(html_source, page_url, page_urls)
+        return pages
+
+    @classmethod
+    def fetch_product_pages(cls, fetcher, url, url_metrics=None):
+        """Downloads the pages of a product listing like download_product_pages(), by the fetcher only, and returns
+        the bodies of the pages. If the URLMetrics of the listing is given, all the downloads are measured into it."""
+        pages = []
+        page_urls = []
+        page_url = canonicalize_url(url, url)
+        while page_url is not None:
+            page = fetcher.fetch(page_url) if url_metrics is None else fetcher.fetch(page_url, url_metrics)
+            pages.append(page)
+            page_urls.append(page_url)
+            if not get_config_matcher(PRODUCT_SCRAPING_CONFIG).follows_next_page():
+                break
+            page_url = cls.get_next_page_url(page.decode('utf-8'), page_url, page_urls)
+        return pages
+
+    @classmethod
+    def scrape_sub_category(cls, main_url, sub_url, fetcher=None, delta_crawl=None):
+        """Scrapes the products of the given sub-category. Returns the main and sub-category names, the product
+        information columns and the content hash of the page.
+        If the next page links are followed (max_pages in the product scraping config), the pages of the listing are
+        downloaded whole, and the products of all the pages are returned together.
+        The content hash is only computed in a delta crawl (otherwise it is None): there the pages are downloaded
+        whole, and if their container regions have not changed since the last crawl, the pages are not parsed,
+        the products of the last crawl are reused."""
+        url = cls.get_absolute_url(sub_url)
+        if delta_crawl is None and not get_config_matcher(PRODUCT_SCRAPING_CONFIG).follows_next_page():
+            product_columns = ProductScraper(url, PRODUCT_SCRAPING_CONFIG, fetcher).get_product_scraping_data()
+            return cls.get_categ_name(main_url, 2), cls.get_categ_name(sub_url, 3), product_columns, None
+        pages = cls.download_product_pages(url, fetcher)
+        content_hash = None
+        product_columns = None
+        if delta_crawl is not None:
+            content_hash = delta_crawl.get_pages_content_hash([html_source for _, html_source in pages])
+            product_columns = delta_crawl.get_unchanged_columns(sub_url, content_hash)
+        if product_columns is None:
+            product_columns = merge_product_columns([product_scrapper.parse_product_data(html_source)
+                                                     for product_scrapper, html_source in pages])
+        return cls.get_categ_name(main_url, 2), cls.get_categ_name(sub_url, 3), product_columns, content_hash
+
+    @classmethod
+    def save_sub_category(cls, main_url, sub_url, scraped_data, result_sink, crawl_journal, delta_crawl=None):
+        """Pushes the products of a sub-category into the result sink. The sub-category is recorded in the crawl
+        journal when the sink has written it out, as the sink may keep it in its buffer for a while.
+        In a delta crawl, the products are saved into the new snapshot, and only their changes since the last crawl
+        are pushed into the result sink."""
+        main_categ, sub_categ, product_columns, content_hash = scraped_data
+        if delta_crawl is not None:
+            product_columns = delta_crawl.save_and_diff(main_url, sub_url, content_hash, product_columns)
+        product_accumulator = ProductAccumulator()
+        product_accumulator.add_products(main_categ, sub_categ, product_columns)
+        crawl_journal.add_pending(main_url, sub_url, product_accumulator.get_row_count())
+        if result_sink.write(product_accumulator.to_dataframe()):
+            crawl_journal.mark_pending_done(result_sink.get_checkpoint())
+
+    @classmethod
+    def scrape_sequentially(cls, main_url_list, result_sink, crawl_journal, fetcher=None, delta_crawl=None):
+        """Scrapes the sub-categories of the main categories one after the other, and saves the products of each
+        sub-category as soon as it is finished. The sub-categories already saved in the crawl journal are skipped,
+        and so are the ones already taken from another main category."""
+        seen_sub_urls = SeenURLSet()
+        for main_url in main_url_list:
+            sub_url_list = cls.collect_sub_urls(main_url, fetcher)
+            print(sub_url_list)
+            for sub_url in sub_url_list:
+                if seen_sub_urls.add(sub_url) and not crawl_journal.is_done(main_url, sub_url):
+                    scraped_data = cls.scrape_sub_category(main_url, sub_url, fetcher, delta_crawl)
+                    cls.save_sub_category(main_url, sub_url, scraped_data, result_sink, crawl_journal, delta_crawl)
+
+    @classmethod
+    def scrape_concurrently(cls, main_url_list, result_sink, crawl_journal, fetcher=None, delta_crawl=None):
+        """Scrapes the sub-categories of the main categories in a thread pool, many pages at the same time.
+        The number of requests to the same host is limited by the fetcher.
+        The products are saved in the same order as scrape_sequentially() would save them.
+        The sub-categories already saved in the crawl journal are skipped, and so are the ones already taken from
+        another main category.
+        """
+        seen_sub_urls = SeenURLSet()
+        with ThreadPoolExecutor(max_workers=load_config(CRAWL_WORKER_COUNT)) as executor:
+            # the sub-category URLs of all main categories are collected at the same time, and the products of
+            # a main category are being scraped as soon as its sub-category URLs are available
+            sub_url_futures = [executor.submit(cls.collect_sub_urls, main_url, fetcher) for main_url in main_url_list]
+            product_futures = []
+            for main_url, sub_url_future in zip(main_url_list, sub_url_futures):
+                sub_url_list = sub_url_future.result()
+                print(sub_url_list)
+                for sub_url in sub_url_list:
+                    if seen_sub_urls.add(sub_url) and not crawl_journal.is_done(main_url, sub_url):
+                        product_futures.append((main_url, sub_url, executor.submit(cls.scrape_sub_category,
+                                                                                   main_url, sub_url, fetcher,
+                                                                                   delta_crawl)))
+            # the futures are kept in submission order, so the result does not depend on which page arrives first
+            for main_url, sub_url, product_future in product_futures:
+                cls.save_sub_category(main_url, sub_url, product_future.result(), result_sink, crawl_journal,
+                                      delta_crawl)
+
+    @classmethod
+    def fetch_page_into_queue(cls, fetcher, index, url, page_queue, stop_event):
+        """Downloads the pages of a product listing (see fetch_product_pages()) and puts them into the page queue
+        together with the index of the listing. If the download fails,
+        the exception is put into the queue instead of the page. While the queue is full, it waits, unless
+        the pipeline has been stopped.
+        If the instrumentation is on, the download is measured into a new URLMetrics, which is put into the queue too,
+        so that the parse can be added to it."""
+        instrumentation = get_instrumentation()
+        url_metrics = None
+        try:
+            if instrumentation is None:
+                page = cls.fetch_product_pages(fetcher, url)
+            else:
+                url_metrics = instrumentation.create_url_metrics(url, ProductScraper.__name__)
+                page = cls.fetch_product_pages(fetcher, url, url_metrics)
+        except Exception as exception:
+            page = exception
+        while not stop_event.is_set():
+            try:
+                page_queue.put((index, page, url_metrics), timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    @classmethod
+    def scrape_in_pipeline(cls, main_url_list, result_sink, crawl_journal, fetcher=None, delta_crawl=None):
+        """Scrapes the sub-categories in a two-stage pipeline, so that parsing is not limited to one CPU core.
+        The fetcher threads download the pages into a bounded queue, and a pool of parser worker processes
+        (parser_worker_count) turns them into product information. A full queue makes the fetchers wait, so at most
+        max_queued_pages downloaded pages are waiting for a parser.
+        As the pages are parsed in other processes, they are downloaded whole, without stopping at the end of
+        the container.
+        The products are saved in the same order as scrape_sequentially() would save them. If a page cannot be
+        downloaded or parsed, the sub-categories before it are saved before its error is raised.
+        The sub-categories already saved in the crawl journal are skipped, and so are the ones already taken from
+        another main category.
+        In a delta crawl, the pages whose container region has not changed since the last crawl are not sent to
+        the parsers.
+        """
+        if fetcher is None:
+            fetcher = get_default_fetcher()
+        seen_sub_urls = SeenURLSet()
+        parser_worker_count = load_config(PARSER_WORKER_COUNT)
+        instrumentation = get_instrumentation()
+        page_queue = queue.Queue(maxsize=load_config(MAX_QUEUED_PAGES))
+        stop_event = threading.Event()
+        fetch_executor = ThreadPoolExecutor(max_workers=load_config(CRAWL_WORKER_COUNT))
+        parse_executor = ProcessPoolExecutor(max_workers=parser_worker_count, initializer=init_parser_worker)
+        try:
+            # the parser processes are started before any fetcher thread, as a process forked while another thread
+            # holds a lock (for example the one of the config cache) would get the lock held forever
+            for started_future in [parse_executor.submit(os.getpid) for _ in range(parser_worker_count)]:
+                started_future.result()
+            sub_url_lists = list(fetch_executor.map(cls.collect_sub_urls, main_url_list,
+                                                    [fetcher] * len(main_url_list)))
+            jobs = []
+            for main_url, sub_url_list in zip(main_url_list, sub_url_lists):
+                print(sub_url_list)
+                jobs.extend((main_url, sub_url) for sub_url in sub_url_list
+                            if seen_sub_urls.add(sub_url) and not crawl_journal.is_done(main_url, sub_url))
+            for index, (main_url, sub_url) in enumerate(jobs):
+                fetch_executor.submit(cls.fetch_page_into_queue, fetcher, index, cls.get_absolute_url(sub_url),
+                                      page_queue, stop_event)
+            parse_futures = {}
+            parsed_pages = {}
+            received_count = 0
+            next_index = 0
+            while next_index < len(jobs):
+                # the parsers get new pages while they are not all busy, otherwise we wait for a parsed page
+                if received_count < len(jobs) and len(parse_futures) < parser_worker_count * 2:
+                    index, page, url_metrics = page_queue.get()
+                    received_count += 1
+                    if isinstance(page, Exception):
+                        # the error is raised in its turn, after the sub-categories before it have been saved
+                        parsed_pages[index] = page
+                        continue
+                    page_url = cls.get_absolute_url(jobs[index][1])
+                    content_hash = None
+                    if delta_crawl is not None:
+                        content_hash = delta_crawl.get_pages_content_hash([html_source.decode('utf-8')
+                                                                           for html_source in page])
+                        product_columns = delta_crawl.get_unchanged_columns(jobs[index][1], content_hash)
+                        if product_columns is not None:
+                            parsed_pages[index] = (product_columns, content_hash)
+                            continue
+                    if url_metrics is None:
+                        parse_future = parse_executor.submit(parse_product_pages, page_url, page)
+                    else:
+                        parse_future = parse_executor.submit(parse_product_pages_measured, page_url, page,
+                                                             instrumentation.profile_parse)
+                    parse_futures[parse_future] = (index, url_metrics, content_hash)
+                else:
+                    done_futures, _ = wait(parse_futures, return_when=FIRST_COMPLETED)
+                    for parse_future in done_futures:
+                        index, url_metrics, content_hash = parse_futures.pop(parse_future)
+                        if parse_future.exception() is not None:
+                            parsed_pages[index] = parse_future.exception()
+                        elif url_metrics is None:
+                            parsed_pages[index] = (parse_future.result(), content_hash)
+                        else:
+                            # the parse has been measured in the worker process, it is added to the download
+                            product_columns, parse_metrics, profile_stats = parse_future.result()
+                            url_metrics.add_parse_metrics(parse_metrics)
+                            instrumentation.add_profile_stats(profile_stats)
+                            parsed_pages[index] = (product_columns, content_hash)
+                # the parsed pages are saved in the order of the sub-categories, whichever is parsed first, and the
+                # error of a page is raised when it comes to its turn, as scrape_concurrently() would raise it
+                while next_index in parsed_pages:
+                    main_url, sub_url = jobs[next_index]
+                    parsed_page = parsed_pages.pop(next_index)
+                    if isinstance(parsed_page, Exception):
+                        raise parsed_page
+                    scraped_data = (cls.get_categ_name(main_url, 2), cls.get_categ_name(sub_url, 3), *parsed_page)
+                    cls.save_sub_category(main_url, sub_url, scraped_data, result_sink, crawl_journal, delta_crawl)
+                    next_index += 1
+        finally:
+            stop_event.set()
+            fetch_executor.shutdown(cancel_futures=True)
+            parse_executor.shutdown(cancel_futures=True)
+
+    @classmethod
+    def save_vanished_sub_categories(cls, result_sink, crawl_journal, delta_crawl):
+        """Pushes the products of the sub-categories that have been in the last crawl but not in this one into
+        the result sink, as removed products. To be called at the end of a delta crawl."""
+        for main_url, sub_url, product_columns in delta_crawl.get_vanished_sub_categories():
+            if not crawl_journal.is_done(main_url, sub_url):
+                change_columns = diff_products(product_columns, {})
+                product_accumulator = ProductAccumulator()
+                product_accumulator.add_products(cls.get_categ_name(main_url, 2), cls.get_categ_name(sub_url, 3),
+                                                 change_columns)
+                crawl_journal.add_pending(main_url, sub_url, product_accumulator.get_row_count())
+                if result_sink.write(product_accumulator.to_dataframe()):
+                    crawl_journal.mark_pending_done(result_sink.get_checkpoint())
+
+    @classmethod
+    def create_instrumentation(cls):
+        """Returns a new CrawlInstrumentation if the instrumentation is turned on in the config, otherwise None."""
+        instrumentation_config = load_config(INSTRUMENTATION_CONFIG) or {}
+        if not instrumentation_config.get(INSTRUMENTATION_ENABLED):
+            return None
+        return CrawlInstrumentation(profile_parse=instrumentation_config.get(PROFILE_PARSE, False))
+
+    @classmethod
+    def export_instrumentation(cls, instrumentation, fetcher, row_count):
+        """Writes the measurements of the run into the JSON run report and the Prometheus text file, and the profile
+        of the parse stage into its file if the parse stage has been profiled."""
+        run_info = {'rows': row_count, 'stream_metrics': fetcher.get_stream_metrics(),
+                    'cache_metrics': fetcher.get_cache_metrics(), 'policy_metrics': fetcher.get_policy_metrics(),
+                    'host_rates': fetcher.get_host_rates()}
+        instrumentation.write_run_report(RUN_REPORT_FILE, run_info)
+        instrumentation.write_prometheus_file(PROMETHEUS_FILE, run_info)
+        if instrumentation.profile_parse:
+            instrumentation.write_parse_profile(PARSE_PROFILE_FILE)
+
+    @classmethod
+    def run_web_scraping_and_save_data(cls, fetcher=None, resume=False, result_sink=None,
+                                       crawl_journal_file=None, instrumentation=None):
         """Runs the web scraping workflow, collects the product information data for each main and sub-category,
-        and then it saves the whole list into a CSV file.
-        # Improvement should be be save the currency and price separately, to have integer price fields, for example.
+        and pushes it into the output sink set in the config (CSV, JSON Lines or Parquet), sub-category by sub-category.
+        If the concurrent_crawl config is set, the pages are scraped concurrently, and if parser_worker_count is also
+        set, the pages are parsed in worker processes.
+        Every saved sub-category is recorded in the crawl journal. If resume is True, the sub-categories recorded by
+        the previous (interrupted) run are skipped, and the result file is continued from where that run stopped.
+        A result sink and a crawl journal file can be given instead of the ones set in the config and the settings.
+        If the instrumentation is turned on in the config (or a CrawlInstrumentation is given), every scraped URL is
+        measured, and the measurements are exported at the end of the run (see export_instrumentation()).
+        If the output / delta_crawl config is set, the run is a delta crawl: the unchanged pages are not parsed again,
+        and only the products added, removed or price-changed since the last finished crawl are pushed into the delta
+        result sink (see DeltaCrawl).
+        If the output / typed_prices config is set, the prices are saved as float32 numbers with their currency and
+        unit in separate columns (see add_typed_price_columns()).
+        Returns the number of products in the result file.
         # Many improvements could be done ...
         """
-        product_df = pd.DataFrame()
-        if load_config(MAIN_URL_COLLECTION_NEEDED):
-            url = load_config(MAIN_SOURCE_URL)
-            main_url_collector = URLCollector(url, MAIN_URLS_TO_SCRAP_CONFIG)
-            main_url_list = main_url_collector.get_urls_to_scrap()
+        if fetcher is None:
+            fetcher = get_default_fetcher()
+        if instrumentation is None:
+            instrumentation = cls.create_instrumentation()
+        set_instrumentation(instrumentation)
+        crawl_journal = CrawlJournal(crawl_journal_file if crawl_journal_file is not None else CRAWL_JOURNAL_FILE)
+        crawl_journal.open(resume)
+        output_config = load_config(OUTPUT_CONFIG)
+        delta_crawl = None
+        if output_config.get(DELTA_CRAWL):
+            delta_crawl = DeltaCrawl(DELTA_STATE_FILE)
+            delta_crawl.open(resume)
+        if result_sink is None:
+            result_sink = create_output_sink(output_config.get(OUTPUT_SINK, 'csv'),
+                                             output_config.get(MAX_BUFFERED_ROWS, 5000), delta=delta_crawl is not None,
+                                             transform=add_typed_price_columns if output_config.get(TYPED_PRICES)
+                                             else None)
+        result_sink.open(crawl_journal.get_last_checkpoint())
+        try:
+            if load_config(MAIN_URL_COLLECTION_NEEDED):
+                main_url_list = cls.collect_main_urls(fetcher)
+                print(main_url_list)
+
+                if load_config(PRODUCT_SUB_URL_COLL_NEEDED):
+                    if load_config(CONCURRENT_CRAWL) and load_config(PARSER_WORKER_COUNT):
+                        cls.scrape_in_pipeline(main_url_list, result_sink, crawl_journal, fetcher, delta_crawl)
+                    elif load_config(CONCURRENT_CRAWL):
+                        cls.scrape_concurrently(main_url_list, result_sink, crawl_journal, fetcher, delta_crawl)
+                    else:
+                        cls.scrape_sequentially(main_url_list, result_sink, crawl_journal, fetcher, delta_crawl)
+                    if delta_crawl is not None:
+                        cls.save_vanished_sub_categories(result_sink, crawl_journal, delta_crawl)
+            result_sink.flush()
+            crawl_journal.mark_pending_done(result_sink.get_checkpoint())
+            if delta_crawl is not None:
+                delta_crawl.finish()  # the crawl is finished, the next one is compared to this one
+        except BaseException:
+            cls.save_buffered_sub_categories(result_sink, crawl_journal)
+            raise
+        finally:
+            set_instrumentation(None)
+            result_sink.close_output()
+            crawl_journal.close()
+            if delta_crawl is not None:
+                delta_crawl.close()
+        print(crawl_journal.get_row_count())
+        if instrumentation is not None:
+            cls.export_instrumentation(instrumentation, fetcher, crawl_journal.get_row_count())
+        return crawl_journal.get_row_count()
+
+    @classmethod
+    def save_buffered_sub_categories(cls, result_sink, crawl_journal):
+        """Writes out the products still in the buffer of the result sink when the run fails, and records their
+        sub-categories in the crawl journal, so a resumed run does not scrape them again: only the sub-categories in
+        flight are lost. Nothing is saved if the sink itself has failed, as its buffer may have been lost. An error
+        while saving is printed, and the error of the run is the one raised."""
+        if result_sink.failed:
+            return
+        try:
+            result_sink.flush()
+            crawl_journal.mark_pending_done(result_sink.get_checkpoint())
+        except Exception as exception:
+            print('The buffered products could not be saved: {}'.format(exception))
+
+    @classmethod
+    def create_url_frontier(cls, frontier_file=None):
+        """Returns a new URLFrontier with the lease timeout and the number of retries set in the config."""
+        frontier_config = load_config(FRONTIER_CONFIG) or {}
+        return URLFrontier(frontier_file if frontier_file is not None else FRONTIER_STATE_FILE,
+                           frontier_config.get(LEASE_TIMEOUT, 300), frontier_config.get(MAX_RETRIES, 3))
+
+    @classmethod
+    def process_frontier_item(cls, frontier, worker_id, item, fetcher):
+        """Processes an item claimed from the URL frontier. The URLs collected from the main source URL or from
+        a main category are added to the frontier at once. Returns the scraped data of a sub-category (see
+        scrape_sub_category()), or None for the other items."""
+        kind, url, main_url = item
+        if kind == ITEM_ROOT:
+            main_url_list = cls.collect_main_urls(fetcher)
             print(main_url_list)
+            # the sub-categories are not scraped without collecting their URLs, like in a crawl without the frontier
+            frontier.add_children(worker_id, kind, url, ITEM_MAIN,
+                                  main_url_list if load_config(PRODUCT_SUB_URL_COLL_NEEDED) else [])
+            return None
+        if kind == ITEM_MAIN:
+            sub_url_list = cls.collect_sub_urls(url, fetcher)
+            print(sub_url_list)
+            frontier.add_children(worker_id, kind, url, ITEM_SUB, sub_url_list, main_url=url)
+            return None
+        return cls.scrape_sub_category(main_url, url, fetcher)
 
-            if load_config(PRODUCT_SUB_URL_COLL_NEEDED):
-                for main_url in main_url_list:
-                    url = load_config(SUB_SOURCE_URL_BEGINNING) + main_url
-                    sub_url_collector = URLCollector(url, PRODUCT_SUB_URLS_TO_SCRAP_CONFIG)
-                    sub_url_list = sub_url_collector.get_urls_to_scrap()
-                    print(sub_url_list)
-
-                    for sub_url in sub_url_list:
-                        url = load_config(SUB_SOURCE_URL_BEGINNING) + sub_url
-                        product_scrapper = ProductScraper(url, PRODUCT_SCRAPING_CONFIG)
-                        product_data = product_scrapper.get_product_scraping_data()
-                        cur_product_df = pd.DataFrame(product_data)
-                        cur_product_df.insert(0, MAIN_CATEG_COL, main_url.split('/')[2][main_url.split('/')[2].find('-')+1:])
-                        cur_product_df.insert(1, SUB_CATEG_COL, sub_url.split('/')[3][sub_url.split('/')[3].find('-')+1:])
-                        product_df = product_df.append(cur_product_df)
-        print(len(product_df))
-        print(product_df.head())
-        product_df.to_csv(RESULT_FILE)
-        return product_df
+    @classmethod
+    def run_frontier_worker(cls, worker_id, fetcher=None, frontier_file=None, result_sink=None):
+        """Runs a worker of a crawl shared through the URL frontier, until every URL of the frontier is done or
+        failed. The worker claims the URLs one by one: it collects the main and sub-category URLs into the frontier,
+        and pushes the products of the sub-categories into its own output, in the frontier result directory (see
+        get_worker_result_path()). The sub-categories are marked done in the frontier when the output has written
+        them out.
+        A worker that has crashed can be restarted with the same worker ID: its output is continued from the last
+        checkpoint saved in the frontier, and its unfinished URLs are claimed again. The leases of the worker are
+        renewed by a LeaseHeartbeat while it runs.
+        The frontier worker does not support the delta crawl. Returns the number of products written by the worker.
+        """
+        if fetcher is None:
+            fetcher = get_default_fetcher()
+        frontier = cls.create_url_frontier(frontier_file)
+        frontier.open()
+        if load_config(MAIN_URL_COLLECTION_NEEDED):
+            frontier.seed(load_config(MAIN_SOURCE_URL))
+        checkpoint = frontier.register_worker(worker_id)
+        poll_interval = (load_config(FRONTIER_CONFIG) or {}).get(POLL_INTERVAL, 1)
+        if result_sink is None:
+            output_config = load_config(OUTPUT_CONFIG)
+            sink_name = output_config.get(OUTPUT_SINK, 'csv')
+            os.makedirs(FRONTIER_RESULT_DIR, exist_ok=True)
+            result_sink = create_output_sink(sink_name, output_config.get(MAX_BUFFERED_ROWS, 5000),
+                                             transform=add_typed_price_columns if output_config.get(TYPED_PRICES)
+                                             else None, result_path=get_worker_result_path(sink_name, worker_id))
+        result_sink.open(checkpoint)
+        lease_heartbeat = LeaseHeartbeat(frontier, worker_id)
+        lease_heartbeat.start()
+        pending_items = []
+        pending_rows = 0
+        row_count = 0
+        try:
+            while True:
+                item = frontier.claim(worker_id)
+                if item is None:
+                    # the products held in the buffer are written out, so that their sub-categories are done
+                    result_sink.flush()
+                    if pending_items:
+                        row_count += cls.complete_frontier_items(frontier, worker_id, result_sink, pending_items,
+                                                                 pending_rows)
+                        pending_items, pending_rows = [], 0
+                    if frontier.is_finished():
+                        break
+                    time.sleep(poll_interval)  # the other workers may still add URLs or fail
+                    continue
+                try:
+                    scraped_data = cls.process_frontier_item(frontier, worker_id, item, fetcher)
+                except Exception as exception:
+                    print('Failed: {} {}'.format(item[1], exception))
+                    frontier.fail(worker_id, item[0], item[1], exception)
+                    continue
+                if scraped_data is None:
+                    continue
+                product_accumulator = ProductAccumulator()
+                product_accumulator.add_products(*scraped_data[:3])
+                pending_items.append((item[0], item[1]))
+                pending_rows += product_accumulator.get_row_count()
+                if result_sink.write(product_accumulator.to_dataframe()):
+                    row_count += cls.complete_frontier_items(frontier, worker_id, result_sink, pending_items,
+                                                             pending_rows)
+                    pending_items, pending_rows = [], 0
+            for kind, url, error in frontier.get_failed_items():
+                print('Failed for good: {} {} ({})'.format(kind, url, error))
+        finally:
+            lease_heartbeat.stop()
+            result_sink.close_output()
+            frontier.close()
+        print(row_count)
+        return row_count
+
+    @classmethod
+    def complete_frontier_items(cls, frontier, worker_id, result_sink, items, rows):
+        """Marks the frontier items whose products the output has written out as done (see URLFrontier.complete()),
+        and returns their number of products. If the worker has lost the lease of any of them, they are dropped from
+        the output by opening it again at the last checkpoint saved in the frontier, and 0 is returned: the items
+        are scraped again by whichever worker claims them."""
+        if frontier.complete(worker_id, items, result_sink.get_checkpoint(), rows):
+            return rows
+        print('Lost the lease of {}, they are dropped from the output'.format(', '.join(url for _, url in items)))
+        result_sink.close_output()
+        result_sink.open(frontier.get_checkpoint(worker_id))
+        return 0
+
+    @classmethod
+    def run_frontier_crawl(cls, worker_count, resume=False, frontier_file=None):
+        """Runs a crawl shared through the URL frontier by the given number of worker processes on this machine
+        (worker-0, worker-1, ...). Without resume a new crawl is started: the frontier is emptied. Workers on other
+        machines can join the crawl by run_frontier_worker(), with other worker IDs.
+        Returns the number of products written by all the workers, including the ones of the resumed run."""
+        frontier = cls.create_url_frontier(frontier_file)
+        frontier.open(reset=not resume)
+        frontier.close()
+        if not resume:
+            shutil.rmtree(FRONTIER_RESULT_DIR, ignore_errors=True)  # the outputs of the workers of the last crawl
+        worker_ids = ['worker-{}'.format(number) for number in range(worker_count)]
+        with ProcessPoolExecutor(max_workers=worker_count) as executor:
+            # the workers get the fetcher of their own process
+            list(executor.map(cls.run_frontier_worker, worker_ids, [None] * worker_count,
+                              [frontier_file] * worker_count))
+        frontier.open()
+        try:
+            return frontier.get_row_count()
+        finally:
+            frontier.close()